@@ -0,0 +1,209 @@
+import os
+import math
+import time
+import random
+import threading
+from collections import deque
+import metrics
+
+# Admission control for upstream LLM calls. RAGManager.stream_response takes a
+# slot before opening a completion stream and gives it back when the stream
+# ends or is closed, so at most LLM_MAX_CONCURRENCY generations run at once and
+# no user holds more than LLM_MAX_PER_USER (in flight or queued). Requests
+# beyond the global limit wait in a FIFO queue of LLM_QUEUE_SIZE for up to
+# LLM_QUEUE_TIMEOUT_SECONDS; anything that can't be admitted raises Rejected,
+# which main.py turns into a 429 (this user) or 503 (everyone) with a
+# Retry-After header. Upstream
+# throttling (429/503 from the inference API) is retried with jittered
+# exponential backoff while the slot is held.
+
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", 16))
+LLM_MAX_PER_USER = int(os.getenv("LLM_MAX_PER_USER", 2))
+LLM_QUEUE_SIZE = int(os.getenv("LLM_QUEUE_SIZE", 16))
+LLM_QUEUE_TIMEOUT_SECONDS = float(os.getenv("LLM_QUEUE_TIMEOUT_SECONDS", 10))
+LLM_RETRY_ATTEMPTS = int(os.getenv("LLM_RETRY_ATTEMPTS", 3))
+LLM_RETRY_BASE_SECONDS = float(os.getenv("LLM_RETRY_BASE_SECONDS", 0.5))
+LLM_RETRY_MAX_SECONDS = float(os.getenv("LLM_RETRY_MAX_SECONDS", 8))
+THROTTLED_STATUSES = (429, 503)
+
+IN_FLIGHT = metrics.Gauge("researchhub_llm_in_flight", "LLM generations currently holding a slot.")
+QUEUE_DEPTH = metrics.Gauge("researchhub_llm_queue_depth", "Requests waiting for an LLM slot.")
+QUEUE_WAIT = metrics.Histogram(
+    "researchhub_llm_queue_wait_seconds",
+    "Time requests spent waiting for an LLM slot (admitted requests only).",
+)
+REJECTED = metrics.Counter("researchhub_llm_rejected_total", "Requests turned away by admission control.", labels=("reason",))
+UPSTREAM_RETRIES = metrics.Counter("researchhub_llm_upstream_retries_total", "Completion calls retried after upstream throttling.")
+IN_FLIGHT.set(0)
+QUEUE_DEPTH.set(0)
+
+
+class Rejected(Exception):
+    def __init__(self, status_code: int, detail: str, retry_after: int):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+        self.retry_after = retry_after
+
+
+class Slot:
+    def __init__(self, limiter, user_id):
+        self.limiter = limiter
+        self.user_id = user_id
+        self.acquired_at = time.perf_counter()
+        self.released = False
+
+    def release(self):
+        self.limiter._release(self)
+
+    def hold(self, stream):
+        return HeldStream(self, stream)
+
+
+class HeldStream:
+    # Iterates a completion stream and gives the slot back once it is exhausted,
+    # fails, is closed, or is dropped without ever being read (e.g. the client
+    # went away before the response started)
+    def __init__(self, slot: Slot, stream):
+        self.slot = slot
+        self.stream = iter(stream)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            return next(self.stream)
+        except BaseException:
+            self.slot.release()
+            raise
+
+    def close(self):
+        self.slot.release()
+        close = getattr(self.stream, "close", None)
+        if close:
+            try:
+                close()
+            except ValueError:
+                # A worker thread is still inside next(); the stream is
+                # closed when it is garbage collected after that read returns
+                pass
+
+    def __del__(self):
+        self.slot.release()
+
+
+class Limiter:
+    def __init__(self, max_concurrency=LLM_MAX_CONCURRENCY, max_per_user=LLM_MAX_PER_USER, queue_size=LLM_QUEUE_SIZE, queue_timeout=LLM_QUEUE_TIMEOUT_SECONDS):
+        self.max_concurrency = max_concurrency
+        self.max_per_user = max_per_user
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        self.per_user = {}
+        self.waiters = deque()
+        self.avg_hold_seconds = 5.0 # moving average of generation time, for Retry-After
+        # Re-entrant: HeldStream.__del__ can run from garbage collection on a
+        # thread that is already inside the limiter
+        self._lock = threading.RLock()
+
+    def retry_after(self) -> int:
+        # Rough time until a slot frees up for the back of the queue
+        rounds = (len(self.waiters) + 1) / max(1, self.max_concurrency)
+        return max(1, math.ceil(self.avg_hold_seconds * rounds))
+
+    def _reject(self, status_code, reason, detail):
+        REJECTED.inc(1, reason)
+        raise Rejected(status_code, detail, self.retry_after())
+
+    def acquire(self, user_id) -> Slot:
+        started = time.perf_counter()
+        with self._lock:
+            if self.per_user.get(user_id, 0) >= self.max_per_user:
+                self._reject(429, "per_user", "Too many requests in progress. Please wait for your previous answer to finish.")
+            if self.active < self.max_concurrency and not self.waiters:
+                self._admit(user_id)
+                QUEUE_WAIT.observe(0.0)
+                return Slot(self, user_id)
+            if len(self.waiters) >= self.queue_size:
+                self._reject(503, "queue_full", "The assistant is busy. Please try again shortly.")
+            waiter = {"user_id": user_id, "event": threading.Event(), "admitted": False}
+            self.waiters.append(waiter)
+            self.per_user[user_id] = self.per_user.get(user_id, 0) + 1
+            QUEUE_DEPTH.set(len(self.waiters))
+
+        if not waiter["event"].wait(self.queue_timeout):
+            with self._lock:
+                if not waiter["admitted"]:
+                    self.waiters.remove(waiter)
+                    self._forget(user_id)
+                    QUEUE_DEPTH.set(len(self.waiters))
+                    self._reject(503, "queue_timeout", "The assistant is busy. Please try again shortly.")
+        QUEUE_WAIT.observe(time.perf_counter() - started)
+        return Slot(self, user_id)
+
+    def _admit(self, user_id):
+        # Caller holds the lock; queued users were already counted in per_user
+        self.active += 1
+        self.per_user[user_id] = self.per_user.get(user_id, 0) + 1
+        IN_FLIGHT.set(self.active)
+
+    def _forget(self, user_id):
+        self.per_user[user_id] -= 1
+        if not self.per_user[user_id]:
+            del self.per_user[user_id]
+
+    def _release(self, slot: Slot):
+        held = time.perf_counter() - slot.acquired_at
+        with self._lock:
+            if slot.released:
+                return
+            slot.released = True
+            self.avg_hold_seconds = 0.9 * self.avg_hold_seconds + 0.1 * held
+            self.active -= 1
+            self._forget(slot.user_id)
+            while self.waiters and self.active < self.max_concurrency:
+                waiter = self.waiters.popleft()
+                waiter["admitted"] = True
+                self.active += 1
+                waiter["event"].set()
+            IN_FLIGHT.set(self.active)
+            QUEUE_DEPTH.set(len(self.waiters))
+
+
+llm_limiter = Limiter()
+
+
+def _status_code(error):
+    response = getattr(error, "response", None)
+    return getattr(response, "status_code", None)
+
+
+def _retry_after_header(error):
+    response = getattr(error, "response", None)
+    try:
+        return float(response.headers.get("Retry-After"))
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+
+def with_backoff(call):
+    # Retries call() when the upstream answers 429/503. Sleeps are "full
+    # jitter" (uniform up to the exponential bound) so a burst of throttled
+    # requests doesn't retry in lockstep; an upstream Retry-After is honoured.
+    for attempt in range(LLM_RETRY_ATTEMPTS + 1):
+        try:
+            return call()
+        except Exception as e:
+            if _status_code(e) not in THROTTLED_STATUSES:
+                raise
+            retry_after = _retry_after_header(e)
+            if attempt == LLM_RETRY_ATTEMPTS:
+                REJECTED.inc(1, "upstream_throttled")
+                raise Rejected(503, "The language model is rate limited. Please try again shortly.", math.ceil(retry_after or LLM_RETRY_MAX_SECONDS))
+            delay = random.uniform(0, min(LLM_RETRY_MAX_SECONDS, LLM_RETRY_BASE_SECONDS * 2 ** attempt))
+            if retry_after is not None:
+                delay = max(delay, min(retry_after, LLM_RETRY_MAX_SECONDS))
+            UPSTREAM_RETRIES.inc()
+            print(f"LLM throttled ({_status_code(e)}), retrying in {delay:.2f}s")
+            time.sleep(delay)
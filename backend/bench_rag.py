@@ -0,0 +1,285 @@
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import shutil
+import tempfile
+import tracemalloc
+import hashlib
+import numpy as np
+import faiss
+
+try:
+    import resource
+except ImportError: # Windows
+    resource = None
+
+# Offline micro-benchmark for RAGManager ingestion and search.
+#
+#   python bench_rag.py                              # default corpus sizes, all formats
+#   python bench_rag.py --docs 10,100 --formats txt,pdf --output before.json
+#   python bench_rag.py --embedder model             # real sentence-transformer (must be cached)
+#
+# Generates synthetic TXT/DOCX/PDF corpora, ingests them into a fresh user
+# index inside a temp directory and writes one JSON result file, so runs from
+# different commits can be diffed. Nothing here touches the network: the
+# default "hashing" embedder stands in for the sentence-transformer, which
+# keeps embed timings out of the picture unless --embedder model is passed.
+
+import rag
+import metrics
+
+FORMATS = ("txt", "docx", "pdf")
+
+
+class HashingEmbedder:
+    # Deterministic bag-of-words hashing into the same 384 dims as all-MiniLM-L6-v2
+    def __init__(self, dimension=384):
+        self.dimension = dimension
+
+    def get_sentence_embedding_dimension(self):
+        return self.dimension
+
+    def encode(self, texts, batch_size=32, **kwargs):
+        vectors = np.zeros((len(texts), self.dimension), dtype="float32")
+        for row, text in enumerate(texts):
+            for word in text.lower().split():
+                bucket = int.from_bytes(hashlib.blake2b(word.encode("utf-8"), digest_size=4).digest(), "little")
+                vectors[row, bucket % self.dimension] += 1.0
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return vectors / norms
+
+
+# --- synthetic corpora -----------------------------------------------------
+
+def make_vocabulary(rng, size=5000):
+    letters = "abcdefghijklmnopqrstuvwxyz"
+    return ["".join(rng.choice(letters) for _ in range(rng.randint(3, 10))) for _ in range(size)]
+
+
+def make_pages(rng, vocabulary, pages, words_per_page):
+    # Zipf-ish word frequencies so queries hit a realistic mix of common and rare terms
+    weights = [1.0 / (rank + 1) for rank in range(len(vocabulary))]
+    return [" ".join(rng.choices(vocabulary, weights=weights, k=words_per_page)) for _ in range(pages)]
+
+
+def write_txt(path, pages):
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("\n\n".join(pages))
+
+
+def write_docx(path, pages):
+    import docx
+    document = docx.Document()
+    for i, page in enumerate(pages):
+        document.add_paragraph(page)
+        if i < len(pages) - 1:
+            document.add_page_break()
+    document.save(path)
+
+
+def write_pdf(path, pages, words_per_line=12):
+    # Hand-rolled single-font PDF so the suite needs no PDF-writing dependency
+    objects = ["<< /Type /Catalog /Pages 2 0 R >>", None, "<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    page_ids = []
+    for page in pages:
+        words = page.split()
+        lines = [" ".join(words[i:i + words_per_line]) for i in range(0, len(words), words_per_line)]
+        stream = "BT /F1 10 Tf 12 TL 40 800 Td " + " ".join(f"({line}) Tj T*" for line in lines) + " ET"
+        objects.append(f"<< /Length {len(stream)} >>\nstream\n{stream}\nendstream")
+        content_id = len(objects)
+        objects.append(f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] /Resources << /Font << /F1 3 0 R >> >> /Contents {content_id} 0 R >>")
+        page_ids.append(len(objects))
+    objects[1] = f"<< /Type /Pages /Kids [{' '.join(f'{i} 0 R' for i in page_ids)}] /Count {len(page_ids)} >>"
+
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(out))
+        out += f"{number} 0 obj\n{body}\nendobj\n".encode("latin-1")
+    xref = len(out)
+    out += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode("latin-1")
+    for offset in offsets:
+        out += f"{offset:010d} 00000 n \n".encode("latin-1")
+    out += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode("latin-1")
+    with open(path, "wb") as f:
+        f.write(out)
+
+
+WRITERS = {"txt": write_txt, "docx": write_docx, "pdf": write_pdf}
+
+
+def generate_corpus(directory, fmt, docs, pages, words_per_page, seed):
+    rng = random.Random(seed)
+    vocabulary = make_vocabulary(rng)
+    paths = []
+    for n in range(docs):
+        path = os.path.join(directory, f"doc_{n:05d}.{fmt}")
+        WRITERS[fmt](path, make_pages(rng, vocabulary, pages, words_per_page))
+        paths.append(path)
+    return paths, vocabulary
+
+
+# --- measurements ----------------------------------------------------------
+
+def percentiles(samples_ms):
+    values = np.array(samples_ms)
+    return {
+        "p50_ms": round(float(np.percentile(values, 50)), 3),
+        "p95_ms": round(float(np.percentile(values, 95)), 3),
+        "p99_ms": round(float(np.percentile(values, 99)), 3),
+        "mean_ms": round(float(values.mean()), 3),
+    }
+
+
+def directory_size(path):
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
+
+
+def stage_seconds(before, after):
+    stages = {}
+    for labels, (count, total) in after.items():
+        prev_count, prev_total = before.get(labels, (0, 0.0))
+        if count > prev_count:
+            stages[labels[0]] = round(total - prev_total, 4)
+    return stages
+
+
+def bench_ingest(user_id, paths, pages, bulk):
+    manager = rag.RAGManager(user_id)
+    before = metrics.STAGE_DURATION.totals()
+    tracemalloc.start()
+    started = time.perf_counter()
+    if bulk:
+        manager.add_documents([
+            {"file_name": os.path.basename(path), "chunks": manager.chunk_text(manager.extract_text(path))}
+            for path in paths
+        ])
+    else:
+        for path in paths:
+            manager.add_document(path, os.path.basename(path))
+    elapsed = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    index_dir = manager.store.directory
+    chunks = manager.store.ntotal
+    result = {
+        "seconds": round(elapsed, 4),
+        "pages_per_sec": round(len(paths) * pages / elapsed, 2),
+        "chunks_per_sec": round(chunks / elapsed, 2),
+        "chunks": chunks,
+        "segments": len(manager.store.current().segments),
+        "python_peak_mb": round(peak / 1024 / 1024, 2),
+        "index_bytes": directory_size(index_dir),
+        "stage_seconds": stage_seconds(before, metrics.STAGE_DURATION.totals()),
+    }
+    manager.store.compact(full=True)
+    result["index_bytes_compacted"] = directory_size(index_dir)
+    return manager, result
+
+
+def bench_search(manager, vocabulary, queries, top_k, seed):
+    rng = random.Random(seed)
+    texts = [" ".join(rng.sample(vocabulary[:500], 4)) for _ in range(queries)]
+    snapshot = manager.store.current()
+    vectors = rag.get_embedding_model(snapshot.model).encode(texts)
+
+    end_to_end, index_only = [], []
+    for text, vector in zip(texts, vectors):
+        started = time.perf_counter()
+        manager.search(text, top_k=top_k)
+        end_to_end.append((time.perf_counter() - started) * 1000)
+
+        started = time.perf_counter()
+        snapshot.search(vector.reshape(1, -1), top_k)
+        index_only.append((time.perf_counter() - started) * 1000)
+
+    return {
+        "ntotal": snapshot.ntotal,
+        "queries": queries,
+        "top_k": top_k,
+        "end_to_end": percentiles(end_to_end),
+        "index_only": percentiles(index_only),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline RAGManager ingestion/search benchmark")
+    parser.add_argument("--docs", default="10,50,200", help="comma-separated corpus sizes (documents)")
+    parser.add_argument("--pages", type=int, default=5, help="pages per document")
+    parser.add_argument("--words-per-page", type=int, default=400)
+    parser.add_argument("--formats", default=",".join(FORMATS))
+    parser.add_argument("--modes", default="bulk,single", help="ingest via add_documents (bulk) and/or add_document (single)")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--top-k", type=int, default=3)
+    parser.add_argument("--embedder", choices=("hashing", "model"), default="hashing")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", default="bench_rag_results.json")
+    args = parser.parse_args()
+
+    output = os.path.abspath(args.output)
+    if args.embedder == "hashing":
+        rag.embedding_models[rag.EMBEDDING_MODEL_NAME] = HashingEmbedder()
+    else:
+        os.environ.setdefault("HF_HUB_OFFLINE", "1")
+        rag.get_embedding_model()
+
+    sizes = [int(n) for n in args.docs.split(",")]
+    formats = [f for f in args.formats.split(",") if f]
+    modes = [m for m in args.modes.split(",") if m]
+
+    runs = []
+    workdir = tempfile.mkdtemp(prefix="bench_rag_")
+    os.chdir(workdir) # RAGManager keeps its indices/ relative to the working directory
+    user_id = 0
+    for fmt in formats:
+        for docs in sizes:
+            corpus_dir = os.path.join(workdir, f"corpus_{fmt}_{docs}")
+            os.makedirs(corpus_dir)
+            paths, vocabulary = generate_corpus(corpus_dir, fmt, docs, args.pages, args.words_per_page, args.seed)
+            for mode in modes:
+                user_id += 1
+                manager, ingest = bench_ingest(user_id, paths, args.pages, bulk=(mode == "bulk"))
+                search = bench_search(manager, vocabulary, args.queries, args.top_k, args.seed)
+                run = {
+                    "format": fmt,
+                    "docs": docs,
+                    "pages": docs * args.pages,
+                    "mode": mode,
+                    "ingest": ingest,
+                    "search": search,
+                }
+                runs.append(run)
+                print(
+                    f"{fmt:>4} {docs:>5} docs {mode:>6}: {ingest['pages_per_sec']:>9} pages/s "
+                    f"{ingest['chunks_per_sec']:>9} chunks/s peak {ingest['python_peak_mb']:>7} MB "
+                    f"index {ingest['index_bytes_compacted'] / 1024:>9.1f} KB | search ntotal={search['ntotal']} "
+                    f"p50={search['end_to_end']['p50_ms']}ms p99={search['end_to_end']['p99_ms']}ms"
+                )
+
+    results = {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "embedder": args.embedder,
+            "python": sys.version.split()[0],
+            "platform": platform.platform(),
+            "faiss": getattr(faiss, "__version__", "unknown"),
+            "max_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1) if resource else None,
+            "args": vars(args),
+        },
+        "runs": runs,
+    }
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2)
+    os.chdir(os.path.dirname(output))
+    shutil.rmtree(workdir, ignore_errors=True)
+    print(f"Results written to {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import shutil
+import tempfile
+import threading
+import numpy as np
+from sqlalchemy.orm import sessionmaker
+
+# Chat-message write throughput for the SQLite setups in database.py.
+#
+#   python bench_sqlite.py                                # 16 concurrent chats, 50 turns each
+#   python bench_sqlite.py --threads 32 --turns 100 --output sqlite.json
+#
+# Each thread plays one chat: save the user message, read the recent history,
+# save the bot message, like chat_query does. Compared modes:
+#
+#   default      rollback journal, one commit per message (the old setup)
+#   wal          WAL + synchronous=NORMAL + busy_timeout + mmap, one commit per message
+#   wal+writer   same pragmas, messages group-committed by message_writer.MessageWriter
+#
+# Every mode gets a fresh database file in a temp directory.
+
+os.environ.setdefault("DATABASE_URL", "sqlite://") # keep database.py off the real DB on import
+
+import models
+from database import create_db_engine
+from message_writer import MessageWriter
+
+MODES = ("default", "wal", "wal+writer")
+
+
+def percentiles(samples_ms):
+    values = np.array(samples_ms)
+    return {
+        "p50_ms": round(float(np.percentile(values, 50)), 3),
+        "p95_ms": round(float(np.percentile(values, 95)), 3),
+        "p99_ms": round(float(np.percentile(values, 99)), 3),
+    }
+
+
+def run_mode(mode, workdir, threads, turns, content_bytes):
+    path = os.path.join(workdir, f"{mode.replace('+', '_')}.db")
+    engine = create_db_engine(f"sqlite:///{path}", sqlite_tuning=(mode != "default"))
+    models.Base.metadata.create_all(bind=engine)
+    Session = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+    db = Session()
+    user = models.User(name="bench", email="bench@example.com", password_hash="x", is_verified=True)
+    db.add(user)
+    db.commit()
+    chats = [models.Chat(user_id=user.id, chat_title=f"chat {n}") for n in range(threads)]
+    db.add_all(chats)
+    db.commit()
+    chat_ids = [chat.id for chat in chats]
+    db.close()
+
+    writer = MessageWriter(url=f"sqlite:///{path}") if mode == "wal+writer" else None
+    content = "x" * content_bytes
+    latencies, errors = [], []
+    lock = threading.Lock()
+
+    def save(db, chat_id, sender):
+        started = time.perf_counter()
+        if writer:
+            writer.submit(chat_id, sender, content).result()
+        else:
+            db.add(models.Message(chat_id=chat_id, sender=sender, content=content))
+            db.commit()
+        return (time.perf_counter() - started) * 1000
+
+    def chat(chat_id):
+        samples = []
+        for _ in range(turns):
+            db = Session() # one session per turn, like one per request
+            try:
+                samples.append(save(db, chat_id, "user"))
+                db.query(models.Message).filter(models.Message.chat_id == chat_id).order_by(models.Message.id.desc()).limit(20).all()
+                samples.append(save(db, chat_id, "bot"))
+            except Exception as e:
+                db.rollback()
+                with lock:
+                    errors.append(str(e).splitlines()[0])
+            finally:
+                db.close()
+        with lock:
+            latencies.extend(samples)
+
+    started = time.perf_counter()
+    workers = [threading.Thread(target=chat, args=(chat_id,)) for chat_id in chat_ids]
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    elapsed = time.perf_counter() - started
+    if writer:
+        writer.close()
+
+    db = Session()
+    saved = db.query(models.Message).count()
+    db.close()
+    engine.dispose()
+    return {
+        "mode": mode,
+        "messages": saved,
+        "seconds": round(elapsed, 3),
+        "messages_per_sec": round(saved / elapsed, 1),
+        "write_latency": percentiles(latencies) if latencies else None,
+        "errors": len(errors),
+        "error_samples": sorted(set(errors))[:3],
+        "commits": writer.batches if writer else saved,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="SQLite chat-message write throughput")
+    parser.add_argument("--threads", type=int, default=16, help="concurrent chats")
+    parser.add_argument("--turns", type=int, default=50, help="question/answer pairs per chat")
+    parser.add_argument("--content-bytes", type=int, default=1000)
+    parser.add_argument("--modes", default=",".join(MODES))
+    parser.add_argument("--output", default="bench_sqlite_results.json")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="bench_sqlite_")
+    runs = []
+    try:
+        for mode in [m for m in args.modes.split(",") if m]:
+            run = run_mode(mode, workdir, args.threads, args.turns, args.content_bytes)
+            runs.append(run)
+            latency = run["write_latency"] or {}
+            print(
+                f"{mode:>10}: {run['messages_per_sec']:>8} msg/s  p50={latency.get('p50_ms')}ms "
+                f"p99={latency.get('p99_ms')}ms  commits={run['commits']}  errors={run['errors']}"
+            )
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    results = {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": sys.version.split()[0],
+            "platform": platform.platform(),
+            "args": vars(args),
+        },
+        "runs": runs,
+    }
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {os.path.abspath(args.output)}")
+
+
+if __name__ == "__main__":
+    main()
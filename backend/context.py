@@ -0,0 +1,121 @@
+import os
+from typing import List
+import metrics
+
+# Context assembly for generate_response: search returns a wider candidate set,
+# then pack_context merges chunks that are adjacent in the same document
+# (RAGManager.chunk_text overlaps consecutive chunks by CHUNK_OVERLAP words, so
+# sending both verbatim repeats that text) and fills a token budget with the
+# highest-scoring merged spans.
+#
+# Savings are reported against the prompt this replaced, which sent the top
+# PREVIOUS_TOP_K chunks verbatim; the candidates beyond those were never sent.
+
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", 2000))
+CONTEXT_CANDIDATES = int(os.getenv("CONTEXT_CANDIDATES", 10))
+CHUNK_SIZE = 500 # words, RAGManager.chunk_text defaults
+CHUNK_OVERLAP = 50
+MIN_TRUNCATED_TOKENS = 64
+PREVIOUS_TOP_K = 3
+
+OVERLAP_TOKENS_REMOVED = metrics.Histogram(
+    "researchhub_context_overlap_tokens_removed",
+    "Prompt tokens per query dropped by merging the overlap of adjacent chunks.",
+    buckets=(0, 50, 100, 250, 500, 1000, 2000, 4000, 8000),
+)
+
+
+def estimate_tokens(text: str) -> int:
+    # Roughly 4 tokens per 3 English words for Llama-style tokenizers
+    return (len(text.split()) * 4 + 2) // 3
+
+
+def _document_key(hit: dict):
+    return hit.get("doc_id") or hit["file_name"]
+
+
+def merge_adjacent(hits: List[dict]) -> List[dict]:
+    # Groups hits by document and stitches runs of consecutive chunks together,
+    # dropping the overlapping words at each seam. Hits without a chunk number
+    # (indexed before chunk numbers were recorded) are kept as-is.
+    spans, by_document = [], {}
+    for hit in hits:
+        if hit.get("chunk") is None:
+            spans.append({"file_name": hit["file_name"], "content": hit["content"], "score": hit.get("score", 0), "chunks": []})
+        else:
+            by_document.setdefault(_document_key(hit), {})[hit["chunk"]] = hit
+
+    for chunks in by_document.values():
+        span = None
+        for number in sorted(chunks):
+            hit = chunks[number]
+            if span is not None and number == span["chunks"][-1] + 1:
+                span["words"].extend(hit["content"].split()[CHUNK_OVERLAP:])
+                if hit.get("score", 0) > span["score"]:
+                    span["score"], span["best_chunk"] = hit.get("score", 0), number
+                span["chunks"].append(number)
+                continue
+            if span is not None:
+                spans.append(span)
+            span = {
+                "file_name": hit["file_name"],
+                "words": hit["content"].split(),
+                "score": hit.get("score", 0),
+                "chunks": [number],
+                "best_chunk": number,
+            }
+        spans.append(span)
+
+    for span in spans:
+        if "words" in span:
+            span["content"] = " ".join(span.pop("words"))
+    spans.sort(key=lambda span: span["score"], reverse=True)
+    return spans
+
+
+def _window(span: dict, max_words: int) -> List[str]:
+    # Keeps max_words around the best-scoring chunk of a merged span
+    words = span["content"].split()
+    start = 0
+    if span["chunks"]:
+        start = (span["best_chunk"] - span["chunks"][0]) * (CHUNK_SIZE - CHUNK_OVERLAP)
+    start = max(0, min(start, len(words) - max_words))
+    return words[start:start + max_words]
+
+
+def pack_context(hits: List[dict], token_budget: int = CONTEXT_TOKEN_BUDGET):
+    # Returns (spans, stats); spans are in relevance order and fit the budget.
+    # hits must be in relevance order. tokens_saved is measured against the
+    # top PREVIOUS_TOP_K hits sent verbatim and is negative when the budget
+    # lets in more context than that.
+    if not hits:
+        return [], {}
+    spans = merge_adjacent(hits)
+    merged_tokens = sum(estimate_tokens(span["content"]) for span in spans)
+
+    packed, used = [], 0
+    for span in spans:
+        tokens = estimate_tokens(span["content"])
+        remaining = token_budget - used
+        if tokens > remaining:
+            if remaining < MIN_TRUNCATED_TOKENS:
+                continue
+            span = dict(span, content=" ".join(_window(span, remaining * 3 // 4)), truncated=True)
+            tokens = estimate_tokens(span["content"])
+        packed.append(span)
+        used += tokens
+
+    raw_tokens = sum(estimate_tokens(hit["content"]) for hit in hits)
+    previous_tokens = sum(estimate_tokens(hit["content"]) for hit in hits[:PREVIOUS_TOP_K])
+    stats = {
+        "candidates": len(hits),
+        "spans": len(packed),
+        "raw_tokens": raw_tokens,
+        "overlap_tokens_removed": raw_tokens - merged_tokens,
+        "packed_tokens": used,
+        "previous_tokens": previous_tokens,
+        "tokens_saved": previous_tokens - used,
+        "token_budget": token_budget,
+    }
+    OVERLAP_TOKENS_REMOVED.observe(stats["overlap_tokens_removed"])
+    return packed, stats
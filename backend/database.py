@@ -1,5 +1,5 @@
 import os
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 from dotenv import load_dotenv
@@ -15,18 +15,41 @@ DATABASE_URL = DATABASE_URL.strip('"').strip("'")
 if DATABASE_URL.startswith("mysql://"):
     DATABASE_URL = DATABASE_URL.replace("mysql://", "mysql+pymysql://", 1)
 
-# Check if it's SQLite and add specific args
-if DATABASE_URL.startswith("sqlite"):
-    engine = create_engine(
-        DATABASE_URL, connect_args={"check_same_thread": False}
-    )
-else:
-    engine = create_engine(
-        DATABASE_URL,
-        pool_pre_ping=True,        # Detects broken connections
-        pool_recycle=3600,         # Recycle connections every hour
-        echo=False
+# SQLite tuning for concurrent chats: WAL lets readers run alongside the
+# writer, synchronous=NORMAL only fsyncs at checkpoints (still safe against
+# app crashes in WAL mode), busy_timeout waits for the write lock instead of
+# failing with "database is locked", and mmap serves reads from the page cache.
+SQLITE_TUNING = os.getenv("SQLITE_TUNING", "true").lower() in ("1", "true", "yes")
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", 5000))
+SQLITE_MMAP_SIZE = int(os.getenv("SQLITE_MMAP_SIZE", 256 * 1024 * 1024))
+
+
+def create_db_engine(url: str, sqlite_tuning: bool = SQLITE_TUNING):
+    # Check if it's SQLite and add specific args
+    if not url.startswith("sqlite"):
+        return create_engine(
+            url,
+            pool_pre_ping=True,        # Detects broken connections
+            pool_recycle=3600,         # Recycle connections every hour
+            echo=False
+        )
+
+    db_engine = create_engine(
+        url, connect_args={"check_same_thread": False}
     )
+    if sqlite_tuning:
+        @event.listens_for(db_engine, "connect")
+        def set_sqlite_pragmas(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            cursor.execute("PRAGMA journal_mode=WAL")
+            cursor.execute("PRAGMA synchronous=NORMAL")
+            cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+            cursor.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE}")
+            cursor.close()
+    return db_engine
+
+
+engine = create_db_engine(DATABASE_URL)
 
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
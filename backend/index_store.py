@@ -0,0 +1,839 @@
+import os
+import json
+import shutil
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import List
+import faiss
+import numpy as np
+import metrics
+import lexical
+
+try:
+    import fcntl
+except ImportError: # Windows dev machines: only in-process locking
+    fcntl = None
+
+# Segmented on-disk layout for a user's vector index:
+#
+#   indices/user_{id}/manifest.json      live segment list, tombstones, id counters
+#   indices/user_{id}/seg_000001.index   immutable FAISS segment (IndexIDMap2)
+#   indices/user_{id}/seg_000001.npy     chunk metadata for that segment
+#   indices/user_{id}/seg_000001.lex     BM25 postings for that segment (lexical.py)
+#
+# Uploads append a new segment, deletes only record tombstoned chunk ids in the
+# manifest, and a background compactor folds segments back together. Compaction
+# is size-tiered: it merges the cheapest run of adjacent segments (or rewrites a
+# segment that is mostly tombstones) rather than the whole index, so each chunk
+# is rewritten a logarithmic number of times instead of on every compaction.
+# The merged segment is built outside the writer lock. Every file
+# is written to a temp path and renamed into place, and the manifest is always
+# written last, so a crash can never leave a half-written index behind.
+#
+# Concurrency: writers for a user are serialized by a per-store lock (plus an
+# flock on indices/user_{id}/.lock across worker processes). Readers never take
+# the lock; they grab the current immutable Snapshot and search that, while
+# writers build a new Snapshot and swap it in once the manifest is on disk.
+
+# Manifests written before indexes recorded their embedding model
+LEGACY_MODEL = "all-MiniLM-L6-v2"
+LEGACY_DIMENSION = 384
+
+MAX_SEGMENTS = int(os.getenv("INDEX_MAX_SEGMENTS", 8))
+MAX_TOMBSTONE_RATIO = float(os.getenv("INDEX_MAX_TOMBSTONE_RATIO", 0.3))
+MERGE_WIDTH = int(os.getenv("INDEX_MERGE_WIDTH", 4))
+OPEN_INDEX_LIMIT = int(os.getenv("INDEX_OPEN_LIMIT", 256))
+
+
+def _atomic_write(path: str, write_fn):
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    write_fn(tmp_path)
+    with open(tmp_path, "rb+") as f:
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def _save_metadata(path: str, metadata: List[dict]):
+    def write(tmp_path):
+        with open(tmp_path, "wb") as f:
+            np.save(f, np.array(metadata, dtype=object), allow_pickle=True)
+    _atomic_write(path, write)
+
+
+def _load_metadata(path: str) -> List[dict]:
+    return np.load(path, allow_pickle=True).tolist()
+
+
+class Segment:
+    def __init__(self, name: str, index, metadata: List[dict], postings=None, postings_path: str = None):
+        self.name = name
+        self.index = index
+        self.metadata = metadata
+        self.by_id = {item["id"]: item for item in metadata}
+        self.min_id = min(self.by_id) if metadata else None
+        self.max_id = max(self.by_id) if metadata else None
+        self._postings = postings
+        self.postings_path = postings_path
+        self._groups = None
+
+    @property
+    def groups(self):
+        # (chunk ids per document, chunk ids per tenant) in this segment, built
+        # once since segments never change. Chunks indexed before document ids
+        # were recorded are keyed by file name; only shared stores have tenants.
+        if self._groups is None:
+            documents, tenants = {}, {}
+            for item in self.metadata:
+                key = ("doc", item["doc_id"]) if item.get("doc_id") is not None else ("file", item["file_name"])
+                documents.setdefault(key, []).append(item["id"])
+                if "user_id" in item:
+                    tenants.setdefault(item["user_id"], []).append(item["id"])
+            self._groups = (documents, tenants)
+        return self._groups
+
+    @property
+    def postings(self):
+        # Segments written before postings were stored build them from their
+        # metadata on first use and save them, so that only happens once
+        if self._postings is None:
+            postings = lexical.Postings.build(self.metadata)
+            if self.postings_path:
+                try:
+                    _atomic_write(self.postings_path, postings.save)
+                except OSError as e:
+                    # Compacted or discarded meanwhile; the postings still serve this snapshot
+                    print(f"Could not save {self.postings_path}: {e}")
+            self._postings = postings
+        return self._postings
+
+    def overlaps(self, ranges) -> bool:
+        if self.min_id is None:
+            return False
+        return any(start <= self.max_id and end > self.min_id for start, end in ranges)
+
+    def vectors(self):
+        # Vectors are added in metadata order, so row i belongs to metadata[i]
+        flat = faiss.downcast_index(self.index.index)
+        return flat.reconstruct_n(0, flat.ntotal)
+
+
+class IndexRetired(Exception):
+    # Raised by writes to an index version that a re-embedding migration has replaced
+    pass
+
+
+class Snapshot:
+    # Immutable view of a store; never mutated after construction. The header
+    # records which embedding model produced the vectors.
+    def __init__(self, segments=(), tombstones=frozenset(), next_id=0, next_segment=1, version=None, header=None):
+        self.segments = tuple(segments)
+        self.tombstones = frozenset(tombstones)
+        self.next_id = next_id
+        self.next_segment = next_segment
+        self.version = version
+        self.header = dict(header or {"model": LEGACY_MODEL, "dimension": LEGACY_DIMENSION})
+
+    @property
+    def model(self) -> str:
+        return self.header["model"]
+
+    @property
+    def dimension(self) -> int:
+        return self.header["dimension"]
+
+    @property
+    def retired(self) -> bool:
+        return self.header.get("retired", False)
+
+    @property
+    def ntotal(self) -> int:
+        return sum(seg.index.ntotal for seg in self.segments) - len(self.tombstones)
+
+    def live_metadata(self) -> List[dict]:
+        tombstones = self.tombstones
+        return [item for seg in self.segments for item in seg.metadata if item["id"] not in tombstones]
+
+    def dead_counts(self) -> List[int]:
+        # Tombstoned chunks per segment
+        counts = getattr(self, "_dead_counts", None)
+        if counts is None:
+            counts = self._dead_counts = [sum(1 for chunk_id in self.tombstones if chunk_id in seg.by_id) for seg in self.segments]
+        return counts
+
+    def _live_ids(self, group: int, key) -> List[int]:
+        # Live chunk ids of one document (group 0) or tenant (group 1), gathered
+        # from the per-segment groups: costs that key's chunks, not the store's
+        tombstones = self.tombstones
+        return [chunk_id for seg in self.segments for chunk_id in seg.groups[group].get(key, ()) if chunk_id not in tombstones]
+
+    def tenant_ids(self, user_id: int) -> List[int]:
+        return self._live_ids(1, user_id)
+
+    def tenant_ranges(self, user_id: int):
+        return id_ranges(self.tenant_ids(user_id))
+
+    def tenant_count(self, user_id: int) -> int:
+        return len(self.tenant_ids(user_id))
+
+    def document_ranges(self, document_ids=(), file_names=()):
+        # Half-open [start, end) id ranges covering the given documents. A
+        # document's chunks are appended in one go, so each is usually one range.
+        ids = []
+        for doc_id in document_ids or ():
+            ids.extend(self._live_ids(0, ("doc", doc_id)))
+        for file_name in file_names or ():
+            ids.extend(self._live_ids(0, ("file", file_name)))
+        return id_ranges(ids)
+
+    def search(self, query_vectors: np.ndarray, top_k: int, ranges=None):
+        # ranges restricts the search to those chunk ids (see document_ranges)
+        return self.search_batch(query_vectors, top_k, ranges=ranges)[0]
+
+    def _tombstone_array(self):
+        tombstones = getattr(self, "_tombstone_ids", None)
+        if tombstones is None:
+            tombstones = self._tombstone_ids = np.array(sorted(self.tombstones), dtype="int64")
+        return tombstones
+
+    def lexical_search(self, query: str, top_k: int, ranges=None):
+        # BM25 over live chunks in ranges (all of them if None); see lexical.search
+        if ranges is not None and not ranges:
+            return []
+        tombstones = self._tombstone_array()
+        if ranges is None:
+            stats = getattr(self, "_lexical_stats", None)
+            if stats is None:
+                stats = self._lexical_stats = lexical.corpus_stats(self.segments, tombstones)
+        else:
+            stats = lexical.corpus_stats([seg for seg in self.segments if seg.overlaps(ranges)], tombstones, ranges)
+        return lexical.search(self.segments, tombstones, stats, query, top_k, ranges=ranges)
+
+    def search_batch(self, query_vectors: np.ndarray, top_k: int, ranges=None):
+        # One FAISS search per segment for all n queries (an n x k result
+        # matrix); returns a ranked hit list per query row
+        query_vectors = np.asarray(query_vectors, dtype="float32").reshape(-1, self.dimension)
+        results = [[] for _ in range(len(query_vectors))]
+        if ranges is not None and not ranges:
+            return results
+
+        keep = [] # FAISS selectors only hold raw pointers to their children
+        selector = None
+        if ranges is not None:
+            selector = _range_selector(ranges, keep)
+        if self.tombstones:
+            excluded = faiss.IDSelectorBatch(np.array(sorted(self.tombstones), dtype="int64"))
+            keep.append(excluded)
+            live = faiss.IDSelectorNot(excluded)
+            keep.append(live)
+            selector = live if selector is None else faiss.IDSelectorAnd(selector, live)
+        params = faiss.SearchParameters(sel=selector) if selector is not None else None
+
+        for seg in self.segments:
+            if seg.index.ntotal == 0:
+                continue
+            if ranges is not None and not seg.overlaps(ranges):
+                continue
+            k = min(top_k, seg.index.ntotal)
+            distances, ids = seg.index.search(query_vectors, k, params=params)
+            for hits, row_distances, row_ids in zip(results, distances, ids):
+                for distance, chunk_id in zip(row_distances, row_ids):
+                    item = seg.by_id.get(int(chunk_id))
+                    if item is not None:
+                        hits.append((float(distance), item))
+
+        for hits in results:
+            hits.sort(key=lambda hit: hit[0])
+            del hits[top_k:]
+        return results
+
+
+MAX_RANGE_SELECTORS = 16
+
+
+def id_ranges(ids):
+    # Collapses ids into sorted half-open [start, end) runs
+    ranges = []
+    for chunk_id in sorted(set(ids)):
+        if ranges and ranges[-1][1] == chunk_id:
+            ranges[-1][1] = chunk_id + 1
+        else:
+            ranges.append([chunk_id, chunk_id + 1])
+    return [tuple(r) for r in ranges]
+
+
+def intersect_ranges(a, b):
+    result, i, j = [], 0, 0
+    while i < len(a) and j < len(b):
+        start, end = max(a[i][0], b[j][0]), min(a[i][1], b[j][1])
+        if start < end:
+            result.append((start, end))
+        if a[i][1] < b[j][1]:
+            i += 1
+        else:
+            j += 1
+    return result
+
+
+def _range_selector(ranges, keep):
+    if len(ranges) > MAX_RANGE_SELECTORS:
+        ids = np.concatenate([np.arange(start, end, dtype="int64") for start, end in ranges])
+        selector = faiss.IDSelectorBatch(ids)
+        keep.append(selector)
+        return selector
+    selector = None
+    for start, end in ranges:
+        part = faiss.IDSelectorRange(start, end)
+        keep.append(part)
+        if selector is not None:
+            keep.append(selector)
+            selector = faiss.IDSelectorOr(selector, part)
+        else:
+            selector = part
+    keep.append(selector)
+    return selector
+
+
+class SegmentedIndex:
+    def __init__(self, directory: str, dimension: int = LEGACY_DIMENSION, legacy_prefix: str = None, model: str = LEGACY_MODEL):
+        # model/dimension only apply to a brand-new index; existing ones keep
+        # whatever their manifest says
+        self.directory = directory
+        self.manifest_path = os.path.join(directory, "manifest.json")
+        self.lock_path = os.path.join(directory, ".lock")
+        self.snapshot = Snapshot(header={"model": model, "dimension": dimension})
+        self._lock = threading.RLock()
+        self._lock_depth = 0
+        self._refresh_lock = threading.Lock()
+        self._swap_lock = threading.Lock()
+        self._compact_lock = threading.Lock()
+
+        if not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+
+        with self.write_lock():
+            if not os.path.exists(self.manifest_path) and legacy_prefix and os.path.exists(f"{legacy_prefix}.index"):
+                self._import_legacy(legacy_prefix)
+        self.refresh(wait=True)
+
+    @property
+    def dimension(self) -> int:
+        return self.snapshot.dimension
+
+    @property
+    def model(self) -> str:
+        return self.snapshot.model
+
+    # --- locking -----------------------------------------------------------
+
+    @contextmanager
+    def write_lock(self):
+        # Re-entrant within a thread; only the outermost holder takes the flock
+        with self._lock:
+            self._lock_depth += 1
+            try:
+                if fcntl is None or self._lock_depth > 1:
+                    yield
+                    return
+                with open(self.lock_path, "a") as lock_file:
+                    fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+                    try:
+                        # Another worker process may have written since we last looked
+                        self.refresh(wait=True)
+                        yield
+                    finally:
+                        fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+            finally:
+                self._lock_depth -= 1
+
+    def _manifest_version(self):
+        try:
+            stat = os.stat(self.manifest_path)
+        except FileNotFoundError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+    # --- persistence -------------------------------------------------------
+
+    def _segment_paths(self, name: str):
+        return segment_paths(self.directory, name)
+
+    def refresh(self, wait: bool = False):
+        # Reload the manifest if another process changed it; segments already in
+        # memory are reused. Readers never wait here: if some other thread is
+        # already reloading they just keep serving the snapshot they have.
+        version = self._manifest_version()
+        if version is None or version == self.snapshot.version:
+            return
+        if not self._refresh_lock.acquire(blocking=wait):
+            return
+        try:
+            for attempt in range(3):
+                base = self.snapshot
+                version = self._manifest_version()
+                if version == base.version:
+                    return
+                try:
+                    snapshot = self._read_snapshot(base, version)
+                except FileNotFoundError:
+                    # A compaction swapped segments underneath us
+                    if attempt == 2:
+                        raise
+                    continue
+                with self._swap_lock:
+                    if self.snapshot is base:
+                        self.snapshot = snapshot
+                return
+        finally:
+            self._refresh_lock.release()
+
+    def _read_snapshot(self, base: Snapshot, version) -> Snapshot:
+        with open(self.manifest_path, "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+        loaded = {seg.name: seg for seg in base.segments}
+        segments = []
+        for name in manifest.get("segments", []):
+            if name in loaded:
+                segments.append(loaded[name])
+                continue
+            index_path, metadata_path, postings_path = self._segment_paths(name)
+            with metrics.span("index_load"):
+                postings = lexical.Postings.load(postings_path) if os.path.exists(postings_path) else None
+                try:
+                    index = faiss.read_index(index_path)
+                except RuntimeError:
+                    # FAISS reports a missing file as a RuntimeError
+                    if not os.path.exists(index_path):
+                        raise FileNotFoundError(index_path)
+                    raise
+                segments.append(Segment(name, index, _load_metadata(metadata_path), postings, postings_path))
+        return Snapshot(
+            segments,
+            manifest.get("tombstones", []),
+            manifest.get("next_id", 0),
+            manifest.get("next_segment", 1),
+            version,
+            manifest.get("header"),
+        )
+
+    def _commit(self, snapshot: Snapshot):
+        manifest = {
+            "segments": [seg.name for seg in snapshot.segments],
+            "tombstones": sorted(snapshot.tombstones),
+            "next_id": snapshot.next_id,
+            "next_segment": snapshot.next_segment,
+            "header": snapshot.header,
+        }
+
+        def write(tmp_path):
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(manifest, f)
+        _atomic_write(self.manifest_path, write)
+        snapshot.version = self._manifest_version()
+        with self._swap_lock:
+            self.snapshot = snapshot
+
+    def _write_segment(self, name: str, vectors: np.ndarray, metadata: List[dict], postings=None) -> Segment:
+        index = faiss.IndexIDMap2(faiss.IndexFlatL2(self.dimension))
+        if len(metadata):
+            ids = np.array([item["id"] for item in metadata], dtype="int64")
+            with metrics.span("index_add"):
+                index.add_with_ids(np.asarray(vectors, dtype="float32"), ids)
+
+        if postings is None:
+            postings = lexical.Postings.build(metadata)
+        index_path, metadata_path, postings_path = self._segment_paths(name)
+        with metrics.span("index_write"):
+            _atomic_write(index_path, lambda tmp_path: faiss.write_index(index, tmp_path))
+            _save_metadata(metadata_path, metadata)
+            _atomic_write(postings_path, postings.save)
+        return Segment(name, index, metadata, postings)
+
+    def _remove_segment_files(self, segment: Segment):
+        for path in self._segment_paths(segment.name):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def _import_legacy(self, legacy_prefix: str):
+        # Convert a pre-segment user_{id}.index / _metadata.npy pair into segment 1
+        legacy_index_path = f"{legacy_prefix}.index"
+        legacy_metadata_path = f"{legacy_prefix}_metadata.npy"
+        index = faiss.read_index(legacy_index_path)
+        metadata = _load_metadata(legacy_metadata_path) if os.path.exists(legacy_metadata_path) else []
+        count = min(index.ntotal, len(metadata))
+
+        items = []
+        for i in range(count):
+            item = dict(metadata[i])
+            item["id"] = i
+            items.append(item)
+        vectors = index.reconstruct_n(0, count) if count else np.zeros((0, self.dimension), dtype="float32")
+
+        self.snapshot = Snapshot(header={"model": LEGACY_MODEL, "dimension": index.d})
+        segment = self._write_segment("seg_000001", vectors, items)
+        self._commit(Snapshot([segment], (), count, 2, header=self.snapshot.header))
+
+        os.remove(legacy_index_path)
+        if os.path.exists(legacy_metadata_path):
+            os.remove(legacy_metadata_path)
+        print(f"Migrated legacy index {legacy_index_path} into {self.directory} ({count} chunks)")
+
+    # --- reads -------------------------------------------------------------
+
+    def current(self) -> Snapshot:
+        self.refresh()
+        return self.snapshot
+
+    @property
+    def ntotal(self) -> int:
+        return self.current().ntotal
+
+    def live_metadata(self) -> List[dict]:
+        return self.current().live_metadata()
+
+    def search(self, query_vectors: np.ndarray, top_k: int, ranges=None):
+        return self.current().search(query_vectors, top_k, ranges=ranges)
+
+    def search_batch(self, query_vectors: np.ndarray, top_k: int, ranges=None):
+        return self.current().search_batch(query_vectors, top_k, ranges=ranges)
+
+    # --- writes ------------------------------------------------------------
+
+    def append(self, vectors: np.ndarray, items: List[dict]):
+        if not items:
+            return
+        with self.write_lock():
+            current = self.snapshot
+            if current.retired:
+                raise IndexRetired(self.directory)
+            metadata = []
+            for offset, item in enumerate(items):
+                item = dict(item)
+                item["id"] = current.next_id + offset
+                metadata.append(item)
+            name = f"seg_{current.next_segment:06d}"
+            segment = self._write_segment(name, vectors, metadata)
+            self._commit(Snapshot(
+                current.segments + (segment,),
+                current.tombstones,
+                current.next_id + len(metadata),
+                current.next_segment + 1,
+                header=current.header,
+            ))
+
+    def delete_where(self, predicate, tenant: int = None) -> int:
+        # tenant limits the scan to that tenant's chunks in a shared store
+        with self.write_lock():
+            current = self.snapshot
+            if current.retired:
+                raise IndexRetired(self.directory)
+            if tenant is None:
+                candidates = current.live_metadata()
+            else:
+                candidates = [seg.by_id[chunk_id] for seg in current.segments for chunk_id in seg.groups[1].get(tenant, ()) if chunk_id not in current.tombstones]
+            dead = {item["id"] for item in candidates if predicate(item)}
+            if not dead:
+                return 0
+            self._commit(Snapshot(
+                current.segments,
+                current.tombstones | dead,
+                current.next_id,
+                current.next_segment,
+                header=current.header,
+            ))
+            return len(dead)
+
+    def retire(self):
+        # Marks this index version as replaced; later writes raise IndexRetired
+        # so callers reopen the current version instead of writing here
+        with self.write_lock():
+            current = self.snapshot
+            self._commit(Snapshot(
+                current.segments,
+                current.tombstones,
+                current.next_id,
+                current.next_segment,
+                header=dict(current.header, retired=True),
+            ))
+
+    # --- maintenance -------------------------------------------------------
+
+    def remove_stray_files(self, older_than: float):
+        # Segment and temp files that no manifest references: left behind when a
+        # writer died between writing a segment and committing the manifest, or
+        # mid atomic write. Returns (files, bytes) removed.
+        files = size = 0
+        with self.write_lock():
+            for entry in find_stray_files(self.directory, [seg.name for seg in self.snapshot.segments], older_than):
+                size += entry.stat().st_size
+                os.remove(entry.path)
+                files += 1
+        return files, size
+
+    # --- compaction --------------------------------------------------------
+
+    def _merge_plan(self, snapshot: Snapshot, full: bool = False, max_tombstone_ratio: float = MAX_TOMBSTONE_RATIO):
+        # (start, end) slice of snapshot.segments to merge next, or None. Too
+        # many segments: the adjacent run of MERGE_WIDTH with the fewest live
+        # chunks, so big old segments are only touched once small ones have
+        # grown to match them. Otherwise the first segment whose share of
+        # tombstones is above max_tombstone_ratio is rewritten on its own.
+        segments = snapshot.segments
+        if full:
+            return (0, len(segments)) if len(segments) > 1 or snapshot.tombstones else None
+        dead = snapshot.dead_counts()
+        if len(segments) > MAX_SEGMENTS:
+            width = max(2, min(MERGE_WIDTH, len(segments)))
+            live = [seg.index.ntotal - d for seg, d in zip(segments, dead)]
+            start = min(range(len(segments) - width + 1), key=lambda i: sum(live[i:i + width]))
+            return start, start + width
+        for i, (seg, d) in enumerate(zip(segments, dead)):
+            if d and d / max(1, seg.index.ntotal) > max_tombstone_ratio:
+                return i, i + 1
+        return None
+
+    def needs_compaction(self) -> bool:
+        return self._merge_plan(self.snapshot) is not None
+
+    def compact(self, full: bool = False, max_tombstone_ratio: float = MAX_TOMBSTONE_RATIO):
+        # Runs merges until there is nothing left to do; full=True merges the
+        # whole index into one segment. Each merged segment is built from an
+        # immutable snapshot without holding the writer lock, so uploads and
+        # deletes go on meanwhile; only the commit takes the lock. Returns
+        # (segments merged, tombstones dropped).
+        merged_total = dropped_total = 0
+        with self._compact_lock:
+            while True:
+                snapshot = self.current()
+                plan = None if snapshot.retired else self._merge_plan(snapshot, full, max_tombstone_ratio)
+                if plan is None:
+                    break
+                result = self._merge(snapshot, *plan)
+                if result is None:
+                    break
+                merged_total += result[0]
+                dropped_total += result[1]
+                full = False
+        return merged_total, dropped_total
+
+    def _merge(self, snapshot: Snapshot, start: int, end: int):
+        merging = snapshot.segments[start:end]
+        with self.write_lock():
+            # Reserve a segment name so concurrent appends can't reuse it
+            current = self.snapshot
+            if current.retired:
+                return None
+            name = f"seg_{current.next_segment:06d}"
+            self._commit(Snapshot(current.segments, current.tombstones, current.next_id, current.next_segment + 1, header=current.header))
+
+        vectors, metadata, dropped = [], [], set()
+        for seg in merging:
+            seg_vectors = seg.vectors() if seg.index.ntotal else None
+            for row, item in enumerate(seg.metadata):
+                if item["id"] in snapshot.tombstones:
+                    dropped.add(item["id"])
+                    continue
+                vectors.append(seg_vectors[row])
+                metadata.append(item)
+        vectors = np.array(vectors, dtype="float32").reshape(-1, snapshot.dimension)
+        # Nothing left alive: the run is just dropped
+        merged = ()
+        if metadata:
+            postings = lexical.Postings.merge([seg.postings for seg in merging], dropped)
+            merged = (self._write_segment(name, vectors, metadata, postings),)
+
+        with self.write_lock():
+            current = self.snapshot
+            names = [seg.name for seg in current.segments]
+            run = [seg.name for seg in merging]
+            if current.retired or run[0] not in names or names[names.index(run[0]):names.index(run[0]) + len(run)] != run:
+                # Another process compacted or retired this index meanwhile
+                for seg in merged:
+                    self._remove_segment_files(seg)
+                return None
+            at = names.index(run[0])
+            # Chunks deleted while the merge ran are still in current.tombstones
+            # and stay tombstoned; only the ones left out of the merge are dropped
+            self._commit(Snapshot(
+                current.segments[:at] + merged + current.segments[at + len(run):],
+                current.tombstones - dropped,
+                current.next_id,
+                current.next_segment,
+                header=current.header,
+            ))
+        for seg in merging:
+            self._remove_segment_files(seg)
+        print(f"Compacted {len(merging)} segments in {self.directory} ({len(dropped)} tombstones dropped)")
+        return len(merging), len(dropped)
+
+
+_stores = OrderedDict() # least recently used first
+_stores_lock = threading.Lock()
+_opening = {}
+
+
+def get_store(directory: str, dimension: int = LEGACY_DIMENSION, legacy_prefix: str = None, model: str = LEGACY_MODEL) -> SegmentedIndex:
+    # One shared store per directory per process, so every request for a user
+    # sees the same snapshot and goes through the same writer lock. Opening
+    # one can wait on another process's flock, so it happens under a
+    # per-directory lock rather than _stores_lock, and other users' lookups
+    # don't queue behind it. At most OPEN_INDEX_LIMIT stores stay in memory;
+    # the least recently used are dropped. A request still holding a dropped
+    # store keeps working: a reopened one for the same directory is a second
+    # flock holder, so writes stay serialized.
+    with _stores_lock:
+        store = _stores.get(directory)
+        if store is not None:
+            _stores.move_to_end(directory)
+            return store
+        opening = _opening.setdefault(directory, threading.Lock())
+    with opening:
+        with _stores_lock:
+            store = _stores.get(directory)
+        if store is None:
+            store = SegmentedIndex(directory, dimension, legacy_prefix=legacy_prefix, model=model)
+        with _stores_lock:
+            store = _stores.setdefault(directory, store)
+            _stores.move_to_end(directory)
+            _opening.pop(directory, None)
+            while len(_stores) > OPEN_INDEX_LIMIT:
+                _stores.popitem(last=False)
+    return store
+
+
+# Index versions: a root such as indices/user_{id} holds version 1 directly;
+# re-embedding migrations (reembed.py) build version n+1 in root/v{n+1} and
+# then atomically repoint root/CURRENT at it.
+
+def current_version(root: str):
+    # Returns (version number, directory holding that version's manifest)
+    try:
+        with open(os.path.join(root, "CURRENT"), "r", encoding="utf-8") as f:
+            pointer = json.load(f)
+    except FileNotFoundError:
+        return 1, root
+    return pointer["version"], os.path.join(root, pointer["directory"])
+
+
+def switch_version(root: str, version: int, directory_name: str):
+    def write(tmp_path):
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"version": version, "directory": directory_name}, f)
+    _atomic_write(os.path.join(root, "CURRENT"), write)
+
+
+def open_root(root: str, dimension: int, model: str, legacy_prefix: str = None) -> SegmentedIndex:
+    version, directory = current_version(root)
+    return get_store(directory, dimension, legacy_prefix=legacy_prefix if version == 1 else None, model=model)
+
+
+# Helpers for maintenance.py, which walks every index on disk
+
+def read_manifest(directory: str):
+    try:
+        with open(os.path.join(directory, "manifest.json"), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def segment_paths(directory: str, name: str):
+    base = os.path.join(directory, name)
+    return f"{base}.index", f"{base}.npy", f"{base}.lex"
+
+
+def read_segment_metadata(directory: str, name: str) -> List[dict]:
+    return _load_metadata(segment_paths(directory, name)[1])
+
+
+def find_stray_files(directory: str, segment_names, older_than: float):
+    # Segment and temp files older than older_than that none of segment_names own
+    referenced = {os.path.basename(path) for name in segment_names for path in segment_paths(directory, name)}
+    stray = []
+    for entry in os.scandir(directory):
+        if not entry.is_file() or not (entry.name.endswith(".tmp") or (entry.name.startswith("seg_") and entry.name not in referenced)):
+            continue
+        if entry.stat().st_mtime < older_than:
+            stray.append(entry)
+    return stray
+
+
+def peek_store(directory: str) -> SegmentedIndex:
+    # The process-wide store if one is open, otherwise a throwaway instance so a
+    # pass over every index doesn't keep them all in memory. Both go through
+    # the same flock, so they can't write over each other.
+    with _stores_lock:
+        store = _stores.get(directory)
+    return store or SegmentedIndex(directory)
+
+
+def _remove_files(paths):
+    files = size = 0
+    for path in paths:
+        try:
+            size += os.path.getsize(path)
+            os.remove(path)
+            files += 1
+        except FileNotFoundError:
+            pass
+    return files, size
+
+
+def remove_retired_versions(root: str, older_than: float):
+    # Deletes versions that a re-embedding migration replaced, once they have
+    # been retired for a while (long enough for every worker to have reopened
+    # the current version). Version 1 lives in the root itself, so only its
+    # own files go. Returns (files, bytes) removed.
+    version, _ = current_version(root)
+    files = size = 0
+    for old in range(1, version):
+        directory = root if old == 1 else os.path.join(root, f"v{old}")
+        manifest = read_manifest(directory)
+        if manifest is None or not manifest.get("header", {}).get("retired"):
+            continue
+        if os.path.getmtime(os.path.join(directory, "manifest.json")) >= older_than:
+            continue
+        with _stores_lock:
+            _stores.pop(directory, None)
+        paths = [os.path.join(directory, name) for name in os.listdir(directory) if name != "CURRENT"]
+        removed = _remove_files(path for path in paths if os.path.isfile(path))
+        files, size = files + removed[0], size + removed[1]
+        if old > 1:
+            os.rmdir(directory)
+    return files, size
+
+
+def discard_root(root: str):
+    # Deletes every version of an index root, e.g. for a user that no longer
+    # exists. Returns (files, bytes) removed.
+    with _stores_lock:
+        for directory in [d for d in _stores if d == root or d.startswith(root + os.sep)]:
+            del _stores[directory]
+    paths = [f"{root}.index", f"{root}_metadata.npy"]
+    for parent, _, names in os.walk(root):
+        paths.extend(os.path.join(parent, name) for name in names)
+    removed = _remove_files(paths)
+    shutil.rmtree(root, ignore_errors=True)
+    return removed
+
+
+_compacting = set()
+_compacting_lock = threading.Lock()
+
+
+def compact_in_background(store: SegmentedIndex):
+    with _compacting_lock:
+        if store.directory in _compacting:
+            return
+        _compacting.add(store.directory)
+
+    def run():
+        try:
+            store.compact()
+        except Exception as e:
+            print(f"Compaction error for {store.directory}: {e}")
+        finally:
+            with _compacting_lock:
+                _compacting.discard(store.directory)
+
+    threading.Thread(target=run, daemon=True).start()
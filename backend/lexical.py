@@ -0,0 +1,240 @@
+import re
+import math
+from itertools import chain, filterfalse
+from typing import List
+import numpy as np
+
+# BM25 inverted index for lexical and hybrid retrieval. Each index segment gets
+# its own postings (seg_000001.lex next to the .index/.npy pair), written when
+# the segment is written, so an upload only adds one segment's postings and a
+# delete is just the tombstones the manifest already records. Compaction
+# merges the segments' postings arrays rather than re-tokenizing their chunks.
+# Corpus statistics (live chunk count, average length, document frequencies)
+# are computed at query time over live chunks in scope, so tombstoned chunks
+# and other tenants never count.
+#
+# Tokens keep identifiers whole ("brca1", "smith2020", "eq-3.2", "10.1038/nature")
+# and also index their parts, so both "eq-3.2" and "eq" match.
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+MAX_TOKEN_CHARS = 64
+
+TOKEN_PATTERN = re.compile(r"[^\W_]+(?:[._:/\-][^\W_]+)*")
+WORD_PATTERN = re.compile(r"[^\W_]+")
+STOPWORDS = frozenset(
+    "a an and are as at be by for from has have in into is it its of on or that the "
+    "this to was were what when where which who why how with do does did".split()
+)
+
+
+def tokenize(text: str) -> List[str]:
+    # Indexing side, so it has to be cheap: one regex pass, lowercased, and the
+    # per-token filters run in C. Tokens that aren't alphanumeric have joiners
+    # ("eq-3.2") and add their parts too.
+    terms = TOKEN_PATTERN.findall(text.lower())
+    for term in list(filterfalse(str.isalnum, terms)):
+        terms.extend(WORD_PATTERN.findall(term))
+    terms = list(filterfalse(STOPWORDS.__contains__, terms))
+    if terms and max(map(len, terms)) > MAX_TOKEN_CHARS:
+        terms = [term[:MAX_TOKEN_CHARS] for term in terms]
+    return terms
+
+
+def query_terms(query: str) -> dict:
+    # term -> whether it is an identifier-like token (digits, inner capitals,
+    # joiners), the kind of query an exact match answers best. Only queries
+    # need the flag, so indexing skips it.
+    terms = dict.fromkeys(tokenize(query), False)
+    for raw in TOKEN_PATTERN.findall(query):
+        if raw.isalpha() and not any(c.isupper() for c in raw[1:]):
+            continue
+        term = raw.lower()[:MAX_TOKEN_CHARS]
+        if term in terms:
+            terms[term] = True
+    return terms
+
+
+class Postings:
+    # One segment's postings in flat arrays: term i's chunk ids and term
+    # frequencies are ids/tfs[offsets[i]:offsets[i + 1]], in ascending id order
+    def __init__(self, terms, offsets, ids, tfs, doc_ids, doc_lengths):
+        self.terms = terms
+        self.offsets = offsets
+        self.ids = ids
+        self.tfs = tfs
+        self.doc_ids = doc_ids
+        self.doc_lengths = doc_lengths
+        self.positions = {str(term): i for i, term in enumerate(terms)}
+
+    @classmethod
+    def build(cls, metadata: List[dict]) -> "Postings":
+        items = sorted(metadata, key=lambda item: item["id"])
+        tokens = [tokenize(item.get("content", "")) for item in items]
+        doc_lengths = list(map(len, tokens))
+        tokens = list(chain.from_iterable(tokens))
+        terms = sorted(set(tokens))
+        position = {term: i for i, term in enumerate(terms)}
+
+        # One (term, chunk) key per token; counting equal keys gives the tfs,
+        # already grouped by term in sorted order and by ascending id within
+        docs = max(1, len(items))
+        term_ids = np.fromiter(map(position.__getitem__, tokens), dtype="int64", count=len(tokens))
+        rows = np.repeat(np.arange(len(items), dtype="int64"), doc_lengths)
+        keys, tfs = np.unique(term_ids * docs + rows, return_counts=True)
+        doc_ids = np.array([item["id"] for item in items], dtype="int64")
+        return cls(
+            np.array(terms, dtype="U"),
+            np.searchsorted(keys // docs, np.arange(len(terms) + 1)).astype("int64"),
+            doc_ids[keys % docs],
+            tfs.astype("int32"),
+            doc_ids,
+            np.array(doc_lengths, dtype="int32"),
+        )
+
+    @classmethod
+    def merge(cls, parts: List["Postings"], dropped=()) -> "Postings":
+        # Combines the postings of several segments without re-tokenizing,
+        # leaving out the chunks in dropped (tombstones the merge drops).
+        # Segments hold disjoint id ranges, so taking them in id order keeps
+        # every term's ids ascending through a stable sort on the term alone.
+        parts = sorted(parts, key=lambda part: part.doc_ids[0] if len(part.doc_ids) else 0)
+        dropped = np.array(sorted(dropped), dtype="int64")
+        vocabulary, inverse = np.unique(np.concatenate([part.terms for part in parts]), return_inverse=True)
+        ranks, ids, tfs = [], [], []
+        base = 0
+        for part in parts:
+            ranks.append(inverse[base + np.repeat(np.arange(len(part.terms)), np.diff(part.offsets))])
+            ids.append(part.ids)
+            tfs.append(part.tfs)
+            base += len(part.terms)
+        ranks, ids, tfs = np.concatenate(ranks), np.concatenate(ids), np.concatenate(tfs)
+        doc_ids = np.concatenate([part.doc_ids for part in parts])
+        doc_lengths = np.concatenate([part.doc_lengths for part in parts])
+        if len(dropped):
+            keep = ~np.isin(ids, dropped)
+            ranks, ids, tfs = ranks[keep], ids[keep], tfs[keep]
+            keep = ~np.isin(doc_ids, dropped)
+            doc_ids, doc_lengths = doc_ids[keep], doc_lengths[keep]
+
+        order = np.argsort(ranks, kind="stable")
+        ranks, ids, tfs = ranks[order], ids[order], tfs[order]
+        # Terms only the dropped chunks had disappear
+        used = np.unique(ranks)
+        return cls(
+            vocabulary[used],
+            np.searchsorted(ranks, np.append(used, len(vocabulary))).astype("int64"),
+            ids.astype("int64"),
+            tfs.astype("int32"),
+            doc_ids.astype("int64"),
+            doc_lengths.astype("int32"),
+        )
+
+    def save(self, path: str):
+        with open(path, "wb") as f:
+            np.savez(
+                f,
+                terms=self.terms,
+                offsets=self.offsets,
+                ids=self.ids,
+                tfs=self.tfs,
+                doc_ids=self.doc_ids,
+                doc_lengths=self.doc_lengths,
+            )
+
+    @classmethod
+    def load(cls, path: str) -> "Postings":
+        with np.load(path) as data:
+            return cls(data["terms"], data["offsets"], data["ids"], data["tfs"], data["doc_ids"], data["doc_lengths"])
+
+    def lookup(self, term: str):
+        # (ids, tfs, doc lengths) for a term, or None if no chunk here has it
+        i = self.positions.get(term)
+        if i is None:
+            return None
+        start, end = self.offsets[i], self.offsets[i + 1]
+        ids = self.ids[start:end]
+        return ids, self.tfs[start:end], self.doc_lengths[np.searchsorted(self.doc_ids, ids)]
+
+
+def in_ranges(ids: np.ndarray, ranges) -> np.ndarray:
+    # Mask of ids inside sorted half-open [start, end) ranges
+    starts = np.array([start for start, _ in ranges], dtype="int64")
+    ends = np.array([end for _, end in ranges], dtype="int64")
+    position = np.searchsorted(starts, ids, side="right") - 1
+    return (position >= 0) & (ids < ends[np.maximum(position, 0)])
+
+
+def _live(ids: np.ndarray, tombstones: np.ndarray, ranges) -> np.ndarray:
+    mask = np.ones(len(ids), dtype=bool)
+    if len(tombstones):
+        mask &= ~np.isin(ids, tombstones)
+    if ranges is not None:
+        mask &= in_ranges(ids, ranges)
+    return mask
+
+
+def corpus_stats(segments, tombstones: np.ndarray, ranges=None):
+    # (live chunk count, average chunk length in tokens) over the scope
+    count = length = 0
+    for seg in segments:
+        postings = seg.postings
+        mask = _live(postings.doc_ids, tombstones, ranges)
+        count += int(mask.sum())
+        length += int(postings.doc_lengths[mask].sum())
+    return count, (length / count if count else 0.0)
+
+
+def search(segments, tombstones: np.ndarray, stats, query: str, top_k: int, ranges=None):
+    # Returns [(bm25 score, item, coverage, identifiers_matched)], best first.
+    # coverage is the idf-weighted share of the query's terms the chunk
+    # contains; identifiers_matched is True if the query has identifier-like
+    # terms and the chunk contains all of them.
+    terms = query_terms(query)
+    count, avg_length = stats
+    if not terms or not count:
+        return []
+    if ranges is not None:
+        segments = [seg for seg in segments if seg.overlaps(ranges)]
+
+    matched_ids, scores, weights, identifier_hits = [], [], [], []
+    total_weight = 0.0
+    identifiers = sum(terms.values())
+    for term, identifier in terms.items():
+        parts = []
+        for seg in segments:
+            found = seg.postings.lookup(term)
+            if found is None:
+                continue
+            ids, tfs, lengths = found
+            mask = _live(ids, tombstones, ranges)
+            if mask.any():
+                parts.append((ids[mask], tfs[mask], lengths[mask]))
+        df = sum(len(ids) for ids, _, _ in parts)
+        idf = math.log(1 + (count - df + 0.5) / (df + 0.5))
+        total_weight += idf
+        for ids, tfs, lengths in parts:
+            tfs = tfs.astype("float64")
+            norm = BM25_K1 * (1 - BM25_B + BM25_B * lengths / max(avg_length, 1e-9))
+            matched_ids.append(ids)
+            scores.append(idf * tfs * (BM25_K1 + 1) / (tfs + norm))
+            weights.append(np.full(len(ids), idf))
+            identifier_hits.append(np.full(len(ids), 1 if identifier else 0))
+    if not matched_ids:
+        return []
+
+    unique_ids, inverse = np.unique(np.concatenate(matched_ids), return_inverse=True)
+    totals = np.bincount(inverse, weights=np.concatenate(scores))
+    covered = np.bincount(inverse, weights=np.concatenate(weights))
+    identifier_counts = np.bincount(inverse, weights=np.concatenate(identifier_hits))
+    order = np.argsort(-totals, kind="stable")[:top_k]
+
+    hits = []
+    for position in order:
+        chunk_id = int(unique_ids[position])
+        item = next((seg.by_id[chunk_id] for seg in segments if chunk_id in seg.by_id), None)
+        if item is None:
+            continue
+        coverage = covered[position] / total_weight if total_weight else 0.0
+        hits.append((float(totals[position]), item, float(coverage), bool(identifiers and identifier_counts[position] >= identifiers)))
+    return hits
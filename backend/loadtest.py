@@ -0,0 +1,316 @@
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import shutil
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+
+# End-to-end load test for the FastAPI app, with no external services.
+#
+#   python loadtest.py --users 20 --concurrency 32 --duration 60
+#   python loadtest.py --mix query=8,dashboard=2 --ttft-ms 800 --tokens-per-sec 25
+#
+# Boots main:app under uvicorn against a throwaway SQLite database and index
+# directory, points the Hugging Face client at a local fake chat-completion
+# server (configurable time-to-first-token, token rate and throttling rate),
+# replaces DuckDuckGo with a stub, then drives a weighted mix of /login,
+# /upload, /chats/{id}/query and /dashboard-stats requests and reports
+# throughput, error rate and latency percentiles per endpoint.
+
+QUERIES = [
+    "What problem does this paper solve?",
+    "Summarize the methodology used in the study.",
+    "What are the key results?",
+    "Which datasets were used for evaluation?",
+    "What is the capital of Mongolia?", # not in the corpus, triggers the web-search prompt
+    "yes",
+    "hello",
+]
+
+WORDS = "model data analysis method result study sample protein gene network training evaluation baseline".split()
+
+
+# --- local stand-ins ---------------------------------------------------------
+
+def make_fake_llm_handler(ttft, tokens_per_sec, answer_tokens, throttle_rate):
+    class FakeChatCompletionHandler(BaseHTTPRequestHandler):
+        # OpenAI-compatible /v1/chat/completions that streams canned tokens
+        def log_message(self, format, *args):
+            pass
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length", 0))
+            body = json.loads(self.rfile.read(length) or b"{}")
+
+            if random.random() < throttle_rate:
+                self.send_response(429)
+                self.send_header("Retry-After", "1")
+                self.send_header("Content-Type", "application/json")
+                self.end_headers()
+                self.wfile.write(b'{"error": "Rate limit reached"}')
+                return
+
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.end_headers()
+            time.sleep(ttft)
+            for n in range(answer_tokens):
+                chunk = {
+                    "id": "loadtest",
+                    "object": "chat.completion.chunk",
+                    "created": int(time.time()),
+                    "model": body.get("model", "fake"),
+                    "choices": [{"index": 0, "delta": {"role": "assistant", "content": random.choice(WORDS) + " "}, "finish_reason": None}],
+                }
+                self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+                self.wfile.flush()
+                if n < answer_tokens - 1:
+                    time.sleep(1 / tokens_per_sec)
+            self.wfile.write(b"data: [DONE]\n\n")
+            self.wfile.flush()
+
+    return FakeChatCompletionHandler
+
+
+def start_fake_llm(args):
+    handler = make_fake_llm_handler(args.ttft_ms / 1000, args.tokens_per_sec, args.answer_tokens, args.llm_throttle_rate)
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+class StubDDGS:
+    latency = 0.0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def text(self, query, max_results=3):
+        time.sleep(self.latency)
+        return [
+            {"href": f"https://example.org/{n}", "body": f"Stub web result {n} for {query}."}
+            for n in range(max_results)
+        ]
+
+
+def start_app(port):
+    import uvicorn
+    import main
+    config = uvicorn.Config(main.app, host="127.0.0.1", port=port, log_level="warning")
+    server = uvicorn.Server(config)
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+    return server
+
+
+# --- workload ----------------------------------------------------------------
+
+class Recorder:
+    def __init__(self):
+        self.samples = {}
+
+    def record(self, endpoint, status, latency, ttfb=None):
+        self.samples.setdefault(endpoint, []).append((status, latency, ttfb))
+
+    def report(self, elapsed):
+        report = {}
+        for endpoint, samples in sorted(self.samples.items()):
+            latencies = np.array([s[1] for s in samples]) * 1000
+            errors = [s for s in samples if not (isinstance(s[0], int) and s[0] < 400)]
+            statuses = {}
+            for s in samples:
+                statuses[str(s[0])] = statuses.get(str(s[0]), 0) + 1
+            entry = {
+                "requests": len(samples),
+                "throughput_rps": round(len(samples) / elapsed, 2),
+                "errors": len(errors),
+                "error_rate": round(len(errors) / len(samples), 4),
+                "statuses": statuses,
+                "latency_ms": {
+                    "p50": round(float(np.percentile(latencies, 50)), 1),
+                    "p95": round(float(np.percentile(latencies, 95)), 1),
+                    "p99": round(float(np.percentile(latencies, 99)), 1),
+                    "max": round(float(latencies.max()), 1),
+                },
+            }
+            ttfbs = [s[2] * 1000 for s in samples if s[2] is not None]
+            if ttfbs:
+                entry["ttfb_ms"] = {
+                    "p50": round(float(np.percentile(ttfbs, 50)), 1),
+                    "p95": round(float(np.percentile(ttfbs, 95)), 1),
+                    "p99": round(float(np.percentile(ttfbs, 99)), 1),
+                }
+            report[endpoint] = entry
+        return report
+
+
+def synthetic_document(rng, words=1500):
+    return " ".join(rng.choice(WORDS) for _ in range(words)).encode("utf-8")
+
+
+async def timed(recorder, endpoint, coro):
+    started = time.perf_counter()
+    try:
+        response = await coro
+        recorder.record(endpoint, response.status_code, time.perf_counter() - started)
+        return response
+    except Exception as e:
+        recorder.record(endpoint, type(e).__name__, time.perf_counter() - started)
+        return None
+
+
+async def create_user(client, n):
+    import models
+    from database import SessionLocal
+
+    email = f"loadtest_{n}_{int(time.time())}@example.com"
+    password = "password123"
+    res = await client.post("/signup", json={"name": f"Load Test {n}", "email": email, "password": password})
+    res.raise_for_status()
+
+    db = SessionLocal()
+    try:
+        user = db.query(models.User).filter(models.User.email == email).first()
+        otp = db.query(models.OTP).filter(models.OTP.user_id == user.id).order_by(models.OTP.id.desc()).first()
+        otp_code = otp.otp_code
+    finally:
+        db.close()
+
+    (await client.post("/verify-otp", json={"email": email, "otp_code": otp_code})).raise_for_status()
+    res = await client.post("/login", json={"email": email, "password": password})
+    res.raise_for_status()
+    headers = {"Authorization": f"Bearer {res.json()['access_token']}"}
+
+    rng = random.Random(n)
+    files = {"file": (f"seed_{n}.txt", synthetic_document(rng), "text/plain")}
+    (await client.post("/upload", headers=headers, files=files)).raise_for_status()
+    res = await client.post("/chats", headers=headers, json={"chat_title": "Load test"})
+    res.raise_for_status()
+    return {"email": email, "password": password, "headers": headers, "chat_id": res.json()["id"]}
+
+
+async def run_operation(client, recorder, op, user, rng):
+    if op == "login":
+        await timed(recorder, "POST /login", client.post("/login", json={"email": user["email"], "password": user["password"]}))
+    elif op == "dashboard":
+        await timed(recorder, "GET /dashboard-stats", client.get("/dashboard-stats", headers=user["headers"]))
+    elif op == "upload":
+        files = {"file": (f"doc_{rng.randint(0, 10**9)}.txt", synthetic_document(rng), "text/plain")}
+        await timed(recorder, "POST /upload", client.post("/upload", headers=user["headers"], files=files))
+    elif op == "query":
+        started = time.perf_counter()
+        ttfb = None
+        try:
+            async with client.stream(
+                "POST",
+                f"/chats/{user['chat_id']}/query",
+                headers=user["headers"],
+                data={"query": rng.choice(QUERIES)},
+            ) as response:
+                async for _ in response.aiter_bytes():
+                    if ttfb is None:
+                        ttfb = time.perf_counter() - started
+            recorder.record("POST /chats/{id}/query", response.status_code, time.perf_counter() - started, ttfb)
+        except Exception as e:
+            recorder.record("POST /chats/{id}/query", type(e).__name__, time.perf_counter() - started, ttfb)
+
+
+async def run_load(base_url, args):
+    import httpx
+
+    mix = {}
+    for part in args.mix.split(","):
+        name, weight = part.split("=")
+        mix[name.strip()] = float(weight)
+    ops, weights = list(mix), list(mix.values())
+
+    limits = httpx.Limits(max_connections=args.concurrency * 2)
+    async with httpx.AsyncClient(base_url=base_url, timeout=args.timeout, limits=limits) as client:
+        print(f"[*] Creating {args.users} users...")
+        users = await asyncio.gather(*(create_user(client, n) for n in range(args.users)))
+
+        print(f"[*] Running {args.concurrency} workers for {args.duration}s with mix {mix}...")
+        recorder = Recorder()
+        deadline = time.perf_counter() + args.duration
+
+        async def worker(worker_id):
+            rng = random.Random(args.seed + worker_id)
+            while time.perf_counter() < deadline:
+                await run_operation(client, recorder, rng.choices(ops, weights)[0], rng.choice(users), rng)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker(n) for n in range(args.concurrency)))
+        return recorder.report(time.perf_counter() - started)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end load test with local LLM and web-search stand-ins")
+    parser.add_argument("--users", type=int, default=10)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=30, help="seconds of load after setup")
+    parser.add_argument("--mix", default="query=5,dashboard=3,upload=1,login=1")
+    parser.add_argument("--ttft-ms", type=float, default=300, help="fake LLM time to first token")
+    parser.add_argument("--tokens-per-sec", type=float, default=50, help="fake LLM streaming rate")
+    parser.add_argument("--answer-tokens", type=int, default=100)
+    parser.add_argument("--llm-throttle-rate", type=float, default=0.0, help="fraction of LLM calls answered with 429")
+    parser.add_argument("--web-latency-ms", type=float, default=200, help="stub DuckDuckGo latency")
+    parser.add_argument("--embedder", choices=("hashing", "model"), default="hashing")
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--port", type=int, default=8765, help="port for the app under test")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", default="loadtest_results.json")
+    args = parser.parse_args()
+
+    output = os.path.abspath(args.output)
+    workdir = tempfile.mkdtemp(prefix="loadtest_")
+    os.chdir(workdir) # uploads/ and indices/ are relative to the working directory
+
+    llm = start_fake_llm(args)
+    # Must be set before rag/database are imported
+    os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(workdir, 'loadtest.db')}"
+    os.environ["HF_INFERENCE_BASE_URL"] = f"http://127.0.0.1:{llm.server_address[1]}"
+    os.environ.setdefault("HUGGINGFACEHUB_API_TOKEN", "loadtest")
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+    import rag
+    StubDDGS.latency = args.web_latency_ms / 1000
+    rag.DDGS = StubDDGS
+    if args.embedder == "hashing":
+        from bench_rag import HashingEmbedder
+        rag.embedding_models[rag.EMBEDDING_MODEL_NAME] = HashingEmbedder()
+
+    app_server = start_app(args.port)
+    try:
+        report = asyncio.run(run_load(f"http://127.0.0.1:{args.port}", args))
+    finally:
+        app_server.should_exit = True
+        llm.shutdown()
+
+    print(f"\n{'endpoint':<26}{'reqs':>7}{'rps':>9}{'err%':>8}{'p50ms':>10}{'p95ms':>10}{'p99ms':>10}")
+    for endpoint, entry in report.items():
+        latency = entry["latency_ms"]
+        print(
+            f"{endpoint:<26}{entry['requests']:>7}{entry['throughput_rps']:>9}{entry['error_rate'] * 100:>7.1f}%"
+            f"{latency['p50']:>10}{latency['p95']:>10}{latency['p99']:>10}"
+        )
+
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump({"args": vars(args), "endpoints": report}, f, indent=2)
+    os.chdir(os.path.dirname(output))
+    shutil.rmtree(workdir, ignore_errors=True)
+    print(f"\nResults written to {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,18 +1,33 @@
-from fastapi import FastAPI, Depends, HTTPException, status, UploadFile, File, Form
+from fastapi import FastAPI, Depends, HTTPException, status, UploadFile, File, Form, Request
 from fastapi.middleware.cors import CORSMiddleware
 from sqlalchemy.orm import Session
-from typing import List
+from typing import List, Optional
 import os
+import io
+import json
+import asyncio
+import time
 import shutil
 import datetime
+import zipfile
+import tarfile
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+from fastapi.concurrency import run_in_threadpool, iterate_in_threadpool
+from fastapi.responses import PlainTextResponse
 from jose import JWTError, jwt
 
-import schemas, auth, email_utils, rag
+import schemas, auth, email_utils, rag, metrics, reembed, maintenance, admission, context, message_writer
 import models
 from database import engine, get_db
 
 
 models.Base.metadata.create_all(bind=engine)
+# create_all only indexes new tables; the OTP purge needs otp_expiry indexed
+# on databases created before that index existed too
+for index in models.OTP.__table__.indexes:
+    index.create(bind=engine, checkfirst=True)
+metrics.instrument_engine(engine)
 
 app = FastAPI(title="ResearchHUB AI API")
 
@@ -24,6 +39,51 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.on_event("startup")
+def load_embedding_model():
+    # Load the sentence-transformer up front so the first upload/query doesn't pay for it
+    rag.get_embedding_model()
+    if reembed.REEMBED_ON_STARTUP:
+        # Existing indexes built with an older EMBEDDING_MODEL are migrated in the background
+        reembed.start_background_migration()
+
+@app.on_event("startup")
+def start_maintenance():
+    if maintenance.MAINTENANCE_ENABLED:
+        maintenance.start_scheduler()
+
+@app.on_event("shutdown")
+def stop_maintenance():
+    maintenance.stop_scheduler()
+
+@app.on_event("shutdown")
+def flush_messages():
+    message_writer.writer.close()
+
+@app.middleware("http")
+async def record_timings(request: Request, call_next):
+    # Per-request stage timings; opt in per request with an X-Timing: 1 header
+    # or globally with TIMING_HEADERS=true. Streamed LLM stages finish after the
+    # headers are sent, so they only show up in /metrics.
+    timings = metrics.start_request_timings()
+    started = time.perf_counter()
+    response = await call_next(request)
+    route = request.scope.get("route")
+    metrics.REQUEST_DURATION.observe(
+        time.perf_counter() - started,
+        request.method,
+        route.path if route else "unmatched",
+        response.status_code,
+    )
+    if metrics.TIMING_HEADERS or request.headers.get("x-timing") == "1":
+        timings.append(("total", time.perf_counter() - started))
+        response.headers["Server-Timing"] = metrics.server_timing_header(timings)
+    return response
+
+@app.get("/metrics")
+def get_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
 UPLOAD_DIR = "uploads"
 if not os.path.exists(UPLOAD_DIR):
     os.makedirs(UPLOAD_DIR)
@@ -149,6 +209,18 @@ def get_stats(user: models.User = Depends(get_current_active_user), db: Session
         "query_history": final_history
     }
 
+def claim_upload_path(user_dir: str, file_name: str) -> str:
+    # Reserves a path no other document uses (notes.txt, notes_1.txt, ...), so
+    # same-named files from different folders or uploads never share one file
+    base, extension = os.path.splitext(os.path.basename(file_name))
+    for n in itertools.count():
+        file_path = os.path.join(user_dir, f"{base}_{n}{extension}" if n else f"{base}{extension}")
+        try:
+            os.close(os.open(file_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            return file_path
+        except FileExistsError:
+            continue
+
 @app.post("/upload")
 async def upload_document(
     file: UploadFile = File(...), 
@@ -170,7 +242,7 @@ async def upload_document(
     if not os.path.exists(user_dir):
         os.makedirs(user_dir)
         
-    file_path = os.path.join(user_dir, file.filename)
+    file_path = claim_upload_path(user_dir, file.filename)
     with open(file_path, "wb") as buffer:
         buffer.write(content)
         
@@ -179,12 +251,162 @@ async def upload_document(
     db.commit()
     db.refresh(db_doc)
     
-    # Process RAG
-    rag_manager = rag.RAGManager(user.id)
-    rag_manager.add_document(file_path, file.filename)
+    # Process RAG (opening a cold index takes its file lock: keep it off the event loop)
+    rag_manager = await run_in_threadpool(rag.RAGManager, user.id)
+    await run_in_threadpool(rag_manager.add_document, file_path, file.filename, doc_id=db_doc.id)
     
     return db_doc
 
+SUPPORTED_EXTENSIONS = ('.pdf', '.docx', '.txt')
+ARCHIVE_EXTENSIONS = ('.zip', '.tar', '.tar.gz', '.tgz')
+BULK_MAX_FILES = int(os.getenv("BULK_MAX_FILES", 500))
+BULK_MAX_TOTAL_SIZE = int(os.getenv("BULK_MAX_TOTAL_SIZE", 1024 * 1024 * 1024)) # 1GB
+BULK_EXTRACT_WORKERS = int(os.getenv("BULK_EXTRACT_WORKERS", 4))
+
+def expand_upload(file_name: str, content: bytes):
+    # Returns the (file_name, content) pairs to index and the names of the files
+    # skipped for their type, for a plain file or for every file inside an
+    # archive. Archive members are named by their path inside the archive.
+    lower_name = file_name.lower()
+    if not lower_name.endswith(ARCHIVE_EXTENSIONS):
+        if not lower_name.endswith(SUPPORTED_EXTENSIONS):
+            return [], [file_name]
+        return [(file_name, content)], []
+
+    members, skipped = [], []
+    if lower_name.endswith('.zip'):
+        with zipfile.ZipFile(io.BytesIO(content)) as archive:
+            for info in archive.infolist():
+                if info.is_dir() or _is_hidden(info.filename):
+                    continue
+                if info.filename.lower().endswith(SUPPORTED_EXTENSIONS):
+                    members.append((info.filename, info.file_size, lambda info=info: archive.read(info)))
+                else:
+                    skipped.append(info.filename)
+            return [(name, read()) for name, size, read in _check_members(members)], skipped
+    with tarfile.open(fileobj=io.BytesIO(content)) as archive:
+        for info in archive.getmembers():
+            if not info.isfile() or _is_hidden(info.name):
+                continue
+            if info.name.lower().endswith(SUPPORTED_EXTENSIONS):
+                members.append((info.name, info.size, lambda info=info: archive.extractfile(info).read()))
+            else:
+                skipped.append(info.name)
+        return [(name, read()) for name, size, read in _check_members(members)], skipped
+
+def _is_hidden(member_name: str) -> bool:
+    # Dotfiles such as macOS ._ resource forks are dropped without a report
+    return os.path.basename(member_name).startswith('.')
+
+def _check_members(members):
+    # Checked against the declared sizes before anything is decompressed
+    if len(members) > BULK_MAX_FILES:
+        raise HTTPException(status_code=413, detail=f"Too many files in archive. Maximum is {BULK_MAX_FILES}.")
+    if sum(size for _, size, _ in members) > BULK_MAX_TOTAL_SIZE:
+        raise HTTPException(status_code=413, detail="Archive contents too large.")
+    return members
+
+@app.post("/upload/bulk")
+async def upload_documents_bulk(
+    files: List[UploadFile] = File(...),
+    user: models.User = Depends(get_current_active_user),
+    db: Session = Depends(get_db)
+):
+    MAX_FILE_SIZE = 200 * 1024 * 1024 # 200MB
+
+    results = []
+    pending = []
+    total_size = 0
+    for file in files:
+        content = await file.read()
+        total_size += len(content)
+        if len(content) > MAX_FILE_SIZE:
+            results.append({"file_name": file.filename, "status": "failed", "error": "File too large. Maximum size is 200MB."})
+            continue
+        if total_size > BULK_MAX_TOTAL_SIZE:
+            raise HTTPException(status_code=413, detail="Upload too large.")
+        try:
+            # Decompressing up to BULK_MAX_TOTAL_SIZE must not block the event loop
+            expanded, skipped = await run_in_threadpool(expand_upload, file.filename, content)
+        except (zipfile.BadZipFile, tarfile.TarError) as e:
+            results.append({"file_name": file.filename, "status": "failed", "error": f"Could not read archive: {e}"})
+            continue
+        for name in skipped:
+            results.append({"file_name": name, "status": "skipped", "error": "Unsupported file type"})
+        pending.extend(expanded)
+
+    if len(pending) > BULK_MAX_FILES:
+        raise HTTPException(status_code=413, detail=f"Too many files. Maximum is {BULK_MAX_FILES}.")
+
+    user_dir = os.path.join(UPLOAD_DIR, str(user.id))
+    if not os.path.exists(user_dir):
+        os.makedirs(user_dir)
+
+    rag_manager = await run_in_threadpool(rag.RAGManager, user.id)
+
+    def extract(name, data):
+        file_path = claim_upload_path(user_dir, name)
+        with open(file_path, "wb") as buffer:
+            buffer.write(data)
+        try:
+            chunks = rag_manager.chunk_text(rag_manager.extract_text(file_path))
+        except Exception as e:
+            os.remove(file_path)
+            return {"file_name": name, "status": "failed", "error": f"Could not extract text: {e}"}
+        return {"file_name": name, "file_path": file_path, "chunks": chunks}
+
+    def extract_all():
+        with ThreadPoolExecutor(max_workers=BULK_EXTRACT_WORKERS) as pool:
+            return list(pool.map(lambda item: extract(*item), pending))
+
+    extracted = await run_in_threadpool(extract_all)
+
+    # One DB transaction and one index segment for the whole batch
+    documents = []
+    for item in extracted:
+        if "chunks" not in item:
+            results.append(item)
+            continue
+        db_doc = models.Document(user_id=user.id, file_name=item["file_name"], file_path=item["file_path"])
+        db.add(db_doc)
+        documents.append((item, db_doc))
+    db.flush()
+
+    try:
+        await run_in_threadpool(rag_manager.add_documents, [
+            {"file_name": item["file_name"], "doc_id": db_doc.id, "chunks": item["chunks"]}
+            for item, db_doc in documents
+        ])
+        db.commit()
+    except Exception as e:
+        # The flush assigned these ids and SQLite reuses them after a rollback,
+        # so any chunks already appended would attach to the next documents
+        try:
+            await run_in_threadpool(rag_manager.delete_documents, [db_doc.id for _, db_doc in documents])
+        except Exception as cleanup_error:
+            print(f"Bulk upload index cleanup error: {cleanup_error}")
+        db.rollback()
+        for item, _ in documents:
+            if os.path.exists(item["file_path"]):
+                os.remove(item["file_path"])
+        print(f"Bulk upload indexing error: {e}")
+        raise HTTPException(status_code=500, detail="Failed to index uploaded documents")
+
+    for item, db_doc in documents:
+        results.append({
+            "file_name": item["file_name"],
+            "status": "indexed",
+            "document_id": db_doc.id,
+            "chunks": len(item["chunks"]),
+        })
+
+    return {
+        "indexed": len(documents),
+        "failed": sum(1 for r in results if r["status"] == "failed"),
+        "skipped": sum(1 for r in results if r["status"] == "skipped"),
+        "results": results,
+    }
+
 @app.get("/documents", response_model=List[schemas.DocumentResponse])
 def get_documents(user: models.User = Depends(get_current_active_user), db: Session = Depends(get_db)):
     return db.query(models.Document).filter(models.Document.user_id == user.id).all()
@@ -195,16 +417,18 @@ def delete_document(doc_id: int, user: models.User = Depends(get_current_active_
     if not doc:
         raise HTTPException(status_code=404, detail="Document not found")
         
-    # Delete file from disk
-    if os.path.exists(doc.file_path):
-        os.remove(doc.file_path)
-        
-    # Remove from RAG index
-    rag_manager = rag.RAGManager(user.id)
-    rag_manager.delete_document(doc.file_name)
-    
+    file_path, file_name = doc.file_path, doc.file_name
     db.delete(doc)
     db.commit()
+
+    # The DB row is the source of truth: if either cleanup step fails, the
+    # maintenance reaper removes the leftover chunks/file later
+    try:
+        rag.RAGManager(user.id).delete_document(file_name, doc_id=doc_id)
+    except Exception as e:
+        print(f"Index cleanup failed for {file_name}: {e}")
+    if os.path.exists(file_path):
+        os.remove(file_path)
     return {"message": "Document deleted successfully"}
 
 @app.post("/chats", response_model=schemas.ChatResponse)
@@ -237,58 +461,299 @@ def delete_chat(chat_id: int, user: models.User = Depends(get_current_active_use
 
 from fastapi.responses import StreamingResponse
 
+# SSE frames are flushed once this many characters are buffered or this much time has passed
+SSE_FLUSH_CHARS = int(os.getenv("SSE_FLUSH_CHARS", 64))
+SSE_FLUSH_INTERVAL = float(os.getenv("SSE_FLUSH_INTERVAL_MS", 50)) / 1000
+
+def iter_stream_text(stream):
+    try:
+        for chunk in stream:
+            # Handle Groq stream objects
+            if hasattr(chunk, 'choices'):
+                if chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+            # Handle error generator yielding strings
+            elif isinstance(chunk, str):
+                yield chunk
+    except Exception as e:
+        yield f"\n[Stream Error: {str(e)}]"
+
+def close_stream(stream):
+    # Completion streams hold an LLM slot until closed; canned replies are plain iterators
+    close = getattr(stream, "close", None)
+    if close:
+        close()
+
+def sse_event(event: str, data: dict):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+async def save_message(db: Session, chat_id: int, sender: str, content: str) -> int:
+    # Group-committed by the background message writer unless it is disabled;
+    # either way the message is committed when this returns
+    if message_writer.MESSAGE_WRITER_ENABLED:
+        return await asyncio.wrap_future(message_writer.writer.submit(chat_id, sender, content))
+    message = models.Message(chat_id=chat_id, sender=sender, content=content)
+    db.add(message)
+    db.commit()
+    return message.id
+
+async def save_bot_message(db: Session, chat_id: int, parts: List[str]):
+    full_response = "".join(parts)
+    if full_response:
+        await save_message(db, chat_id, "bot", full_response)
+
+def document_scope(db: Session, user_id: int, document_ids: List[int]) -> List[str]:
+    # File names for a retrieval scope; 404s unless the user owns every document
+    docs = db.query(models.Document).filter(models.Document.id.in_(document_ids), models.Document.user_id == user_id).all()
+    if len(docs) != len(set(document_ids)):
+        raise HTTPException(status_code=404, detail="Document not found")
+    return [doc.file_name for doc in docs]
+
+def check_retrieval_mode(mode: Optional[str]):
+    if mode is not None and mode not in rag.RETRIEVAL_MODES:
+        raise HTTPException(status_code=400, detail=f"retrieval_mode must be one of: {', '.join(rag.RETRIEVAL_MODES)}")
+
 @app.post("/chats/{chat_id}/query")
 async def chat_query(
     chat_id: int, 
+    request: Request,
     query: str = Form(...), 
+    stream_format: str = Form("text"),
+    document_ids: Optional[str] = Form(None),
+    retrieval_mode: Optional[str] = Form(None),
     user: models.User = Depends(get_current_active_user), 
     db: Session = Depends(get_db)
 ):
+    started = time.perf_counter()
     chat = db.query(models.Chat).filter(models.Chat.id == chat_id, models.Chat.user_id == user.id).first()
     if not chat:
         raise HTTPException(status_code=404, detail="Chat not found")
     
+    # Optional comma-separated document ids to restrict retrieval to
+    scope_ids, scope_names = None, None
+    if document_ids:
+        try:
+            # "," alone is no scope at all, not a scope matching nothing
+            scope_ids = [int(doc_id) for doc_id in document_ids.split(",") if doc_id.strip()] or None
+        except ValueError:
+            raise HTTPException(status_code=400, detail="document_ids must be a comma-separated list of integers")
+        if scope_ids:
+            scope_names = document_scope(db, user.id, scope_ids)
+    check_retrieval_mode(retrieval_mode)
+
     # Save user message
-    user_msg = models.Message(chat_id=chat_id, sender="user", content=query)
-    db.add(user_msg)
-    db.commit()
+    user_msg_id = await save_message(db, chat_id, "user", query)
     
     # Get chat history
     history = []
-    messages = db.query(models.Message).filter(models.Message.chat_id == chat_id).order_by(models.Message.timestamp.asc()).all()
-    for m in messages[:-1]: # exclude the current query
+    messages = db.query(models.Message).filter(
+        models.Message.chat_id == chat_id,
+        models.Message.id != user_msg_id, # exclude the current query
+    ).order_by(models.Message.timestamp.asc(), models.Message.id.asc()).all()
+    for m in messages:
         role = "assistant" if m.sender == "bot" else "user"
         history.append({"role": role, "content": m.content})
-        
-    rag_manager = rag.RAGManager(user.id)
-    stream = rag_manager.generate_response(query, history)
-    
-    async def event_generator():
-        full_response = ""
+    # Hand the pooled connection back while the answer streams; the session
+    # checks one out again if it is used later (rejections, saving the reply)
+    user_id = user.id
+    db.close()
+
+    # Opening a cold index loads it from disk under a file lock, so this and
+    # retrieval both run in worker threads
+    rag_manager = await run_in_threadpool(rag.RAGManager, user_id)
+    prepare_started = time.perf_counter()
+    # Sources are known once retrieval returns
+    prepared = await run_in_threadpool(rag_manager.prepare_response, query, history, document_ids=scope_ids, file_names=scope_names, mode=retrieval_mode)
+
+    async def open_stream():
+        # In a worker thread: waiting for an LLM slot must not block the event loop
         try:
-            for chunk in stream:
-                # Handle Groq stream objects
-                if hasattr(chunk, 'choices'):
-                    if chunk.choices[0].delta.content:
-                        content = chunk.choices[0].delta.content
-                        full_response += content
-                        yield content
-                # Handle error generator yielding strings
-                elif isinstance(chunk, str):
-                    full_response += chunk
-                    yield chunk
-        except Exception as e:
-            error_msg = f"\n[Stream Error: {str(e)}]"
-            full_response += error_msg
-            yield error_msg
-        
-        # Save bot response after stream ends
-        if full_response:
-            bot_msg = models.Message(chat_id=chat_id, sender="bot", content=full_response)
-            db.add(bot_msg)
+            return await run_in_threadpool(rag_manager.stream_response, prepared)
+        except admission.Rejected:
+            # Nothing was answered, so don't leave the question dangling in the chat
+            db.query(models.Message).filter(models.Message.id == user_msg_id).delete()
             db.commit()
+            raise
+
+    use_sse = stream_format == "sse" or "text/event-stream" in request.headers.get("accept", "")
+    if not use_sse:
+        try:
+            stream = await open_stream()
+        except admission.Rejected as e:
+            raise HTTPException(status_code=e.status_code, detail=e.detail, headers={"Retry-After": str(e.retry_after)})
+
+        async def text_generator():
+            parts = []
+            try:
+                # The completion stream is synchronous: read it from worker threads
+                async for content in iterate_in_threadpool(iter_stream_text(stream)):
+                    parts.append(content)
+                    yield content
+            finally:
+                # Frees the LLM slot now if the client went away mid-stream
+                close_stream(stream)
+            
+            # Save bot response after stream ends
+            await save_bot_message(db, chat_id, parts)
 
-    return StreamingResponse(event_generator(), media_type="text/plain")
+        return StreamingResponse(text_generator(), media_type="text/plain")
+
+    async def sse_generator():
+        yield sse_event("sources", {
+            "source": rag_manager.source_info,
+            "documents": rag_manager.sources,
+            "context": rag_manager.context_stats,
+        })
+        try:
+            stream = await open_stream()
+        except admission.Rejected as e:
+            # Too late for a status code; the client gets the same detail as an event
+            yield sse_event("error", {"status": e.status_code, "detail": e.detail, "retry_after": e.retry_after})
+            return
+        prepare_ms = (time.perf_counter() - prepare_started) * 1000
+
+        parts = []
+        buffer = []
+        buffered_chars = 0
+        frames = 0
+        first_token_ms = None
+        last_flush = time.perf_counter()
+        tokens = iterate_in_threadpool(iter_stream_text(stream))
+        next_token = None
+        try:
+            while True:
+                # Wait for the next token, but no longer than the flush interval
+                # while something is buffered, so slow streams still get frames
+                if next_token is None:
+                    next_token = asyncio.ensure_future(tokens.__anext__())
+                timeout = max(0.0, SSE_FLUSH_INTERVAL - (time.perf_counter() - last_flush)) if buffer else None
+                done, _ = await asyncio.wait({next_token}, timeout=timeout)
+                now = time.perf_counter()
+                if not done:
+                    yield sse_event("token", {"text": "".join(buffer)})
+                    frames += 1
+                    buffer, buffered_chars, last_flush = [], 0, now
+                    continue
+                try:
+                    content = next_token.result()
+                except StopAsyncIteration:
+                    next_token = None
+                    break
+                next_token = None
+                if first_token_ms is None:
+                    first_token_ms = (now - started) * 1000
+                parts.append(content)
+                buffer.append(content)
+                buffered_chars += len(content)
+                if buffered_chars >= SSE_FLUSH_CHARS or now - last_flush >= SSE_FLUSH_INTERVAL:
+                    yield sse_event("token", {"text": "".join(buffer)})
+                    frames += 1
+                    buffer, buffered_chars, last_flush = [], 0, now
+        finally:
+            # Frees the LLM slot however the loop ended; closing twice is harmless
+            close_stream(stream)
+            if next_token is not None:
+                # Client went away mid-stream; the worker thread finishes its
+                # read on its own. Let the cancelled read unwind before closing.
+                next_token.cancel()
+                await asyncio.wait({next_token})
+            await tokens.aclose()
+        if buffer:
+            yield sse_event("token", {"text": "".join(buffer)})
+            frames += 1
+
+        await save_bot_message(db, chat_id, parts)
+        yield sse_event("done", {
+            "prepare_ms": round(prepare_ms, 1),
+            "ttft_ms": round(first_token_ms, 1) if first_token_ms is not None else None,
+            "total_ms": round((time.perf_counter() - started) * 1000, 1),
+            "chunks": len(parts),
+            "frames": frames,
+            "chars": sum(len(p) for p in parts),
+        })
+
+    return StreamingResponse(
+        sse_generator(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+BATCH_MAX_QUERIES = int(os.getenv("BATCH_MAX_QUERIES", 50))
+BATCH_MAX_TOP_K = 20
+BATCH_ANSWER_CONCURRENCY = int(os.getenv("BATCH_ANSWER_CONCURRENCY", 4))
+
+def public_chunk(hit: dict):
+    return {
+        "file_name": hit["file_name"],
+        "document_id": hit.get("doc_id"),
+        "chunk": hit.get("chunk"),
+        "content": hit["content"],
+        "score": hit["score"],
+    }
+
+@app.post("/query/batch")
+async def batch_query(
+    batch: schemas.BatchQueryRequest,
+    user: models.User = Depends(get_current_active_user),
+    db: Session = Depends(get_db)
+):
+    # Retrieval for a list of questions against the same corpus: one encode
+    # pass and one batched index search. With answer=true each question also
+    # gets an LLM answer, a few at a time, without being saved to a chat.
+    queries = [query.strip() for query in batch.queries]
+    if not queries or not all(queries):
+        raise HTTPException(status_code=400, detail="queries must be a non-empty list of non-empty strings")
+    if len(queries) > BATCH_MAX_QUERIES:
+        raise HTTPException(status_code=413, detail=f"Too many queries. Maximum is {BATCH_MAX_QUERIES}.")
+    if not 1 <= batch.top_k <= BATCH_MAX_TOP_K:
+        raise HTTPException(status_code=400, detail=f"top_k must be between 1 and {BATCH_MAX_TOP_K}")
+    check_retrieval_mode(batch.retrieval_mode)
+    # An empty list means no scope, like leaving document_ids out; searching
+    # with it would silently return nothing
+    scope_ids = batch.document_ids or None
+    scope_names = document_scope(db, user.id, scope_ids) if scope_ids else None
+
+    started = time.perf_counter()
+    rag_manager = await run_in_threadpool(rag.RAGManager, user.id)
+    # Answers need the wider candidate set that generate_response would fetch itself
+    fetch_k = max(batch.top_k, context.CONTEXT_CANDIDATES) if batch.answer else batch.top_k
+    hits = await run_in_threadpool(
+        rag_manager.search_many, queries, fetch_k,
+        document_ids=scope_ids, file_names=scope_names, mode=batch.retrieval_mode,
+    )
+    retrieval_ms = (time.perf_counter() - started) * 1000
+    results = [
+        {"query": query, "chunks": [public_chunk(hit) for hit in query_hits[:batch.top_k]]}
+        for query, query_hits in zip(queries, hits)
+    ]
+
+    answer_ms = None
+    if batch.answer:
+        def answer(query, candidates):
+            # Own manager per question: generate_response keeps per-answer state on it
+            manager = rag.RAGManager(user.id)
+            try:
+                stream = manager.generate_response(query, [], candidates=candidates)
+                text = "".join(iter_stream_text(stream))
+            except admission.Rejected as e:
+                return {"error": e.detail, "retry_after": e.retry_after}
+            return {"answer": text, "source": manager.source_info, "sources": manager.sources}
+
+        def answer_all():
+            # Stay within the per-user LLM limit so the batch doesn't reject itself
+            workers = max(1, min(BATCH_ANSWER_CONCURRENCY, admission.LLM_MAX_PER_USER))
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                return list(pool.map(answer, queries, hits))
+
+        answer_started = time.perf_counter()
+        for result, answered in zip(results, await run_in_threadpool(answer_all)):
+            result.update(answered)
+        answer_ms = round((time.perf_counter() - answer_started) * 1000, 1)
+
+    return {
+        "results": results,
+        "timings": {"retrieval_ms": round(retrieval_ms, 1), "answer_ms": answer_ms},
+    }
 
 if __name__ == "__main__":
     import uvicorn
@@ -0,0 +1,308 @@
+import os
+import time
+import json
+import bisect
+import datetime
+import threading
+from contextlib import contextmanager
+import index_store
+import tenant_store
+import metrics
+import models
+from database import SessionLocal
+
+try:
+    import fcntl
+except ImportError: # Windows dev machines: no cross-process exclusion
+    fcntl = None
+
+# In-process maintenance scheduler. Every MAINTENANCE_INTERVAL_SECONDS the API
+# runs each task below in turn:
+#
+#   otp_purge         delete expired OTP rows in batches
+#   upload_reaper     delete files in uploads/ that no Document row points at
+#   index_reaper      drop indexes of deleted users, retired index versions,
+#                     stray segment/temp files and chunks whose document is gone
+#   idle_compaction   rewrite segments holding tombstones (and merge if there
+#                     are too many) in indexes that haven't been written to
+#                     for a while
+#
+# Each task gets MAINTENANCE_TASK_SECONDS of run time, checked between units of
+# work (a batch, a user directory, an index), and picks up where the previous
+# run stopped. Files and chunks younger than ORPHAN_GRACE_SECONDS are never
+# touched, since uploads write to disk before the DB commit. Only one worker
+# process runs maintenance at a time. Run `python maintenance.py` for a single
+# pass from the command line.
+
+MAINTENANCE_ENABLED = os.getenv("MAINTENANCE_ENABLED", "true").lower() in ("1", "true", "yes")
+MAINTENANCE_INTERVAL_SECONDS = int(os.getenv("MAINTENANCE_INTERVAL_SECONDS", 900))
+MAINTENANCE_TASK_SECONDS = float(os.getenv("MAINTENANCE_TASK_SECONDS", 10))
+OTP_PURGE_BATCH_SIZE = int(os.getenv("OTP_PURGE_BATCH_SIZE", 1000))
+ORPHAN_GRACE_SECONDS = int(os.getenv("ORPHAN_GRACE_SECONDS", 3600))
+IDLE_COMPACTION_SECONDS = int(os.getenv("IDLE_COMPACTION_SECONDS", 600))
+UPLOAD_DIR = "uploads"
+
+last_report = {}
+_cursors = {}
+
+
+def _resume(task: str, keys):
+    # Starts after the last key the previous (possibly time-limited) run finished
+    keys = sorted(keys)
+    start = bisect.bisect_right(keys, _cursors[task]) if task in _cursors else 0
+    return keys[start:] + keys[:start]
+
+
+def _user_id(root: str):
+    name = os.path.basename(root)
+    return int(name[len("user_"):]) if name.startswith("user_") and name[len("user_"):].isdigit() else None
+
+
+def _newest_mtime(root: str) -> float:
+    paths = [path for path in (root, f"{root}.index") if os.path.exists(path)]
+    for parent, _, names in os.walk(root):
+        paths.extend(os.path.join(parent, name) for name in names)
+    return max((os.path.getmtime(path) for path in paths), default=0)
+
+
+# --- tasks ---------------------------------------------------------------
+
+def purge_expired_otps(deadline: float):
+    db = SessionLocal()
+    deleted = batches = 0
+    try:
+        now = datetime.datetime.utcnow()
+        while time.monotonic() < deadline:
+            ids = [row.id for row in db.query(models.OTP.id).filter(models.OTP.otp_expiry <= now).limit(OTP_PURGE_BATCH_SIZE)]
+            if not ids:
+                return {"deleted": deleted, "batches": batches, "complete": True}
+            db.query(models.OTP).filter(models.OTP.id.in_(ids)).delete(synchronize_session=False)
+            db.commit()
+            deleted += len(ids)
+            batches += 1
+        return {"deleted": deleted, "batches": batches, "complete": False}
+    finally:
+        db.close()
+
+
+def reap_orphaned_uploads(deadline: float):
+    report = {"files": 0, "bytes": 0, "complete": True}
+    if not os.path.isdir(UPLOAD_DIR):
+        return report
+    cutoff = time.time() - ORPHAN_GRACE_SECONDS
+    db = SessionLocal()
+    try:
+        # An empty users table more likely means the wrong DATABASE_URL than no
+        # users; reaping then would delete every upload
+        if db.query(models.User.id).first() is None:
+            return report
+        for name in _resume("upload_reaper", os.listdir(UPLOAD_DIR)):
+            if time.monotonic() >= deadline:
+                report["complete"] = False
+                break
+            user_dir = os.path.join(UPLOAD_DIR, name)
+            # Only uploads/{user_id} directories are ours to clean up
+            if not name.isdigit() or not os.path.isdir(user_dir):
+                continue
+            rows = db.query(models.Document.file_path).filter(models.Document.user_id == int(name))
+            known = {os.path.normpath(row.file_path) for row in rows}
+            for entry in os.scandir(user_dir):
+                if not entry.is_file() or os.path.normpath(entry.path) in known:
+                    continue
+                stat = entry.stat()
+                if stat.st_mtime < cutoff:
+                    os.remove(entry.path)
+                    report["files"] += 1
+                    report["bytes"] += stat.st_size
+            _cursors["upload_reaper"] = name
+    finally:
+        db.close()
+    return report
+
+
+def _orphaned_chunks(db, directory: str, manifest: dict, cutoff: float, user_id: int = None):
+    # Tombstones chunks in segments older than the grace period whose document
+    # row is gone (e.g. the index delete failed after the DB commit). user_id
+    # None means the shared store, where this also catches tenants that were
+    # promoted but whose shared copies were never tombstoned. Works from the
+    # manifest and segment metadata; the store (and its vectors) is only
+    # opened if there is something to tombstone.
+    tombstones = set(manifest.get("tombstones", []))
+    items = []
+    for name in manifest.get("segments", []):
+        try:
+            if os.path.getmtime(index_store.segment_paths(directory, name)[0]) >= cutoff:
+                continue
+            metadata = index_store.read_segment_metadata(directory, name)
+        except FileNotFoundError:
+            # Compacted since the manifest was read; a later run sees the merged segment
+            continue
+        items.extend(item for item in metadata if item["id"] not in tombstones)
+    if not items:
+        return 0
+
+    shared = user_id is None
+    user_ids = {item.get("user_id") for item in items} if shared else {user_id}
+    rows = db.query(models.Document.user_id, models.Document.id, models.Document.file_name).filter(models.Document.user_id.in_(user_ids))
+    doc_ids, file_names = set(), set()
+    for row in rows:
+        doc_ids.add((row.user_id, row.id))
+        file_names.add((row.user_id, row.file_name))
+    promoted = {uid for uid in user_ids if shared and tenant_store.has_dedicated_index(uid)}
+
+    def orphaned(item):
+        owner = item.get("user_id") if shared else user_id
+        if owner in promoted:
+            return True
+        if item.get("doc_id") is not None:
+            return (owner, item["doc_id"]) not in doc_ids
+        return (owner, item["file_name"]) not in file_names
+
+    dead = {item["id"] for item in items if orphaned(item)}
+    if not dead:
+        return 0
+    try:
+        return index_store.peek_store(directory).delete_where(lambda item: item["id"] in dead)
+    except index_store.IndexRetired:
+        # Migrated meanwhile; the new version is checked on a later run
+        return 0
+
+
+def reap_orphaned_indices(deadline: float):
+    report = {"roots": 0, "files": 0, "bytes": 0, "chunks": 0, "complete": True}
+    cutoff = time.time() - ORPHAN_GRACE_SECONDS
+    db = SessionLocal()
+    try:
+        users = {row.id for row in db.query(models.User.id)}
+        for root in _resume("index_reaper", tenant_store.index_roots()):
+            if time.monotonic() >= deadline:
+                report["complete"] = False
+                break
+            _cursors["index_reaper"] = root
+            shared = root == tenant_store.SHARED_DIR
+            user_id = _user_id(root)
+            if not shared and user_id is None:
+                continue
+            if not shared and user_id not in users:
+                # An empty users table more likely means the wrong DATABASE_URL than no users
+                if not users or _newest_mtime(root) >= cutoff:
+                    continue
+                files, size = index_store.discard_root(root)
+                report["roots"] += 1
+            else:
+                files, size = index_store.remove_retired_versions(root, cutoff)
+                _, directory = index_store.current_version(root)
+                manifest = index_store.read_manifest(directory)
+                if manifest is not None and not manifest.get("header", {}).get("retired"):
+                    if index_store.find_stray_files(directory, manifest.get("segments", []), cutoff):
+                        # Re-checked under the store's write lock before anything is removed
+                        stray = index_store.peek_store(directory).remove_stray_files(cutoff)
+                        files, size = files + stray[0], size + stray[1]
+                    report["chunks"] += _orphaned_chunks(db, directory, manifest, cutoff, user_id)
+            report["files"] += files
+            report["bytes"] += size
+    finally:
+        db.close()
+    return report
+
+
+def compact_idle_indices(deadline: float):
+    report = {"compacted": 0, "segments_merged": 0, "tombstones_dropped": 0, "complete": True}
+    idle_since = time.time() - IDLE_COMPACTION_SECONDS
+    for root in _resume("idle_compaction", tenant_store.index_roots()):
+        if time.monotonic() >= deadline:
+            report["complete"] = False
+            break
+        _cursors["idle_compaction"] = root
+        _, directory = index_store.current_version(root)
+        manifest = index_store.read_manifest(directory)
+        if manifest is None or manifest.get("header", {}).get("retired"):
+            continue
+        if len(manifest.get("segments", [])) <= index_store.MAX_SEGMENTS and not manifest.get("tombstones"):
+            continue
+        if os.path.getmtime(os.path.join(directory, "manifest.json")) >= idle_since:
+            continue
+        # Idle, so drop every tombstone; segments without any are left alone
+        merged, dropped = index_store.peek_store(directory).compact(max_tombstone_ratio=0)
+        if merged:
+            report["compacted"] += 1
+            report["segments_merged"] += merged
+            report["tombstones_dropped"] += dropped
+    return report
+
+
+TASKS = (
+    ("otp_purge", purge_expired_otps),
+    ("upload_reaper", reap_orphaned_uploads),
+    ("index_reaper", reap_orphaned_indices),
+    ("idle_compaction", compact_idle_indices),
+)
+
+
+# --- scheduler -----------------------------------------------------------
+
+@contextmanager
+def _exclusive():
+    # Yields False if another worker process is already running maintenance
+    if fcntl is None:
+        yield True
+        return
+    os.makedirs(tenant_store.INDEX_ROOT, exist_ok=True)
+    with open(os.path.join(tenant_store.INDEX_ROOT, ".maintenance.lock"), "a") as lock_file:
+        try:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+
+def run_once(task_seconds: float = MAINTENANCE_TASK_SECONDS):
+    global last_report
+    with _exclusive() as acquired:
+        if not acquired:
+            return None
+        report = {}
+        for name, task in TASKS:
+            started = time.monotonic()
+            try:
+                with metrics.span(f"maintenance_{name}"):
+                    result = task(started + task_seconds)
+            except Exception as e:
+                result = {"error": str(e)}
+            result["seconds"] = round(time.monotonic() - started, 3)
+            report[name] = result
+    print(f"Maintenance: {report}")
+    last_report = report
+    return report
+
+
+_stop = threading.Event()
+_thread = None
+
+
+def start_scheduler():
+    global _thread
+    if _thread is not None and _thread.is_alive():
+        return
+
+    def loop():
+        while True:
+            run_once()
+            if _stop.wait(MAINTENANCE_INTERVAL_SECONDS):
+                return
+
+    _stop.clear()
+    _thread = threading.Thread(target=loop, daemon=True)
+    _thread.start()
+
+
+def stop_scheduler():
+    _stop.set()
+
+
+if __name__ == "__main__":
+    print(json.dumps(run_once(), indent=2))
@@ -0,0 +1,109 @@
+import os
+import time
+import queue
+import threading
+from concurrent.futures import Future
+from sqlalchemy.orm import sessionmaker
+import models
+from database import DATABASE_URL, create_db_engine
+
+# Group commits for chat messages. Instead of every chat request committing its
+# own INSERT (one fsync and one trip through SQLite's single write lock each),
+# requests hand messages to one background thread, which writes everything
+# queued up meanwhile (up to MESSAGE_BATCH_SIZE) in a single transaction.
+# MESSAGE_FLUSH_INTERVAL_MS > 0 also waits that long for more messages, trading
+# latency for bigger batches. submit() returns a Future that resolves to the
+# message id once its batch is committed, so callers can still wait for
+# durability. Messages are written in submission order.
+#
+# The writer has its own engine: request sessions keep their pooled connection
+# while they wait on it, so sharing the app's pool could starve it.
+
+MESSAGE_WRITER_ENABLED = os.getenv("MESSAGE_WRITER_ENABLED", "true").lower() in ("1", "true", "yes")
+MESSAGE_BATCH_SIZE = int(os.getenv("MESSAGE_BATCH_SIZE", 100))
+MESSAGE_FLUSH_INTERVAL_MS = float(os.getenv("MESSAGE_FLUSH_INTERVAL_MS", 0))
+
+
+class MessageWriter:
+    def __init__(self, url=DATABASE_URL, batch_size=MESSAGE_BATCH_SIZE, flush_interval_ms=MESSAGE_FLUSH_INTERVAL_MS):
+        self.url = url
+        self.engine = None
+        self.session_factory = None
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval_ms / 1000
+        self.batches = 0
+        self.written = 0
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def submit(self, chat_id: int, sender: str, content: str) -> Future:
+        future = Future()
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                if self.engine is None:
+                    self.engine = create_db_engine(self.url)
+                    self.session_factory = sessionmaker(autocommit=False, autoflush=False, bind=self.engine)
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+            self._queue.put((chat_id, sender, content, future))
+        return future
+
+    def close(self):
+        # Writes whatever is queued, then stops the thread
+        with self._lock:
+            if self._thread is None:
+                return
+            self._queue.put(None)
+            thread, self._thread = self._thread, None
+        thread.join()
+        self.engine.dispose()
+
+    def _run(self):
+        while True:
+            first = self._queue.get()
+            if first is None:
+                return
+            batch = [first]
+            deadline = time.monotonic() + self.flush_interval
+            stop = False
+            while len(batch) < self.batch_size:
+                try:
+                    item = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if item is None:
+                    stop = True
+                    break
+                batch.append(item)
+            self._write(batch)
+            if stop:
+                return
+
+    def _write(self, batch):
+        db = self.session_factory()
+        try:
+            rows = [models.Message(chat_id=chat_id, sender=sender, content=content) for chat_id, sender, content, _ in batch]
+            db.add_all(rows)
+            db.flush()
+            ids = [row.id for row in rows]
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            if len(batch) > 1:
+                # Don't let one bad message (e.g. its chat was just deleted) fail the rest
+                for item in batch:
+                    self._write([item])
+                return
+            print(f"Message writer: could not save message: {e}")
+            batch[0][3].set_exception(e)
+            return
+        finally:
+            db.close()
+        self.batches += 1
+        self.written += len(ids)
+        for message_id, (_, _, _, future) in zip(ids, batch):
+            future.set_result(message_id)
+
+
+writer = MessageWriter()
@@ -24,7 +24,7 @@ class OTP(Base):
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
     otp_code = Column(String(10), nullable=False)
-    otp_expiry = Column(DateTime, nullable=False)
+    otp_expiry = Column(DateTime, nullable=False, index=True)
 
     user = relationship("User", back_populates="otps")
 
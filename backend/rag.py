@@ -1,42 +1,111 @@
 import os
+import time
 from typing import List
 from dotenv import load_dotenv
 import PyPDF2
 import docx
-import faiss
 import numpy as np
 from sentence_transformers import SentenceTransformer
 from duckduckgo_search import DDGS
+import index_store
+import tenant_store
+import metrics
+import context
+import admission
 
 load_dotenv()
 
 HUGGINGFACEHUB_API_TOKEN = os.getenv("HUGGINGFACEHUB_API_TOKEN")
 
+# HF_INFERENCE_BASE_URL points the client at any OpenAI-compatible server instead
+# (a self-hosted TGI endpoint, or loadtest.py's local fake)
+HF_INFERENCE_BASE_URL = os.getenv("HF_INFERENCE_BASE_URL")
+
 from huggingface_hub import InferenceClient
-client = InferenceClient(api_key=HUGGINGFACEHUB_API_TOKEN)
+if HF_INFERENCE_BASE_URL:
+    client = InferenceClient(base_url=HF_INFERENCE_BASE_URL, api_key=HUGGINGFACEHUB_API_TOKEN)
+else:
+    client = InferenceClient(api_key=HUGGINGFACEHUB_API_TOKEN)
 DEFAULT_MODEL = "meta-llama/Llama-3.3-70B-Instruct"
 print(f"Using Hugging Face Inference Client with model {DEFAULT_MODEL}")
 
-# Initialize embedding model
-embedding_model = SentenceTransformer('all-MiniLM-L6-v2')
+# EMBEDDING_MODEL is what new indexes are built with. Existing indexes record
+# the model that produced them and keep being queried with it until reembed.py
+# has migrated them. Models are loaded on first use (and can be swapped out,
+# e.g. by bench_rag.py).
+EMBEDDING_MODEL_NAME = os.getenv("EMBEDDING_MODEL", index_store.LEGACY_MODEL)
+KNOWN_DIMENSIONS = {
+    "all-MiniLM-L6-v2": 384,
+    "all-MiniLM-L12-v2": 384,
+    "all-mpnet-base-v2": 768,
+    "BAAI/bge-small-en-v1.5": 384,
+    "BAAI/bge-base-en-v1.5": 768,
+}
+embedding_models = {}
+
+def get_embedding_model(name: str = None):
+    name = name or EMBEDDING_MODEL_NAME
+    if name not in embedding_models:
+        embedding_models[name] = SentenceTransformer(name)
+    return embedding_models[name]
+
+def embedding_dimension(name: str = None) -> int:
+    name = name or EMBEDDING_MODEL_NAME
+    if name in KNOWN_DIMENSIONS:
+        return KNOWN_DIMENSIONS[name]
+    return get_embedding_model(name).get_sentence_embedding_dimension()
+
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", 64))
+
+# Retrieval modes: "dense" (FAISS only), "lexical" (BM25 only, nothing is
+# embedded) or "hybrid" (both, merged with reciprocal rank fusion). In hybrid
+# mode a query whose best BM25 hit contains all of its identifier-like terms
+# ("BRCA1", "smith2020", "eq-3.2") and at least LEXICAL_SHORTCUT_COVERAGE of its
+# idf-weighted terms is answered from the lexical hits alone, without embedding
+# the query; a coverage above 1 turns the shortcut off. Scores are only
+# comparable within a mode: cosine similarity for dense, BM25 for lexical, and
+# fused rank for hybrid (1.0 = first in both lists).
+RETRIEVAL_MODES = ("dense", "lexical", "hybrid")
+RETRIEVAL_MODE = os.getenv("RETRIEVAL_MODE", "hybrid")
+RRF_K = int(os.getenv("RRF_K", 60))
+LEXICAL_SHORTCUT_COVERAGE = float(os.getenv("LEXICAL_SHORTCUT_COVERAGE", 0.8))
+
+LEXICAL_SHORTCUTS = metrics.Counter("researchhub_lexical_shortcuts_total", "Hybrid queries answered from BM25 hits without embedding the query.")
+
+
+def fuse_ranked(dense: List[dict], lexical_hits: List[dict], top_k: int) -> List[dict]:
+    # Reciprocal rank fusion, keyed by chunk id
+    fused = {}
+    for hits in (dense, lexical_hits):
+        for rank, hit in enumerate(hits):
+            entry = fused.setdefault(hit["id"], [0.0, hit])
+            entry[0] += 1 / (RRF_K + rank + 1)
+    best = 2 / (RRF_K + 1)
+    ranked = sorted(fused.values(), key=lambda entry: entry[0], reverse=True)[:top_k]
+    return [dict(hit, score=round(score / best, 4)) for score, hit in ranked]
 
 class RAGManager:
     def __init__(self, user_id: int):
         self.user_id = user_id
-        self.index_path = f"indices/user_{user_id}.index"
-        self.docs_metadata_path = f"indices/user_{user_id}_metadata.npy"
-        self.dimension = 384 # For all-MiniLM-L6-v2
         
         if not os.path.exists("indices"):
             os.makedirs("indices")
             
-        if os.path.exists(self.index_path):
-            self.index = faiss.read_index(self.index_path)
-            self.metadata = np.load(self.docs_metadata_path, allow_pickle=True).tolist()
-        else:
-            self.index = faiss.IndexFlatL2(self.dimension)
-            self.metadata = []
+        # Dedicated indices/user_{id} store, or this user's slice of the shared
+        # store when tenant packing is on. Older indices/user_{id}.index files
+        # are migrated into segments on first load.
+        self._open_store()
+        # Filled in by generate_response so callers can report where an answer came from
+        self.source_info = ""
+        self.sources = []
+        self.context_stats = {}
+
+    def _open_store(self):
+        # Also used to pick up the new version after a re-embedding switch-over
+        self.store = tenant_store.open_user_store(self.user_id, EMBEDDING_MODEL_NAME, embedding_dimension())
+        self.dimension = self.store.dimension
 
+    @metrics.timed("extract")
     def extract_text(self, file_path: str):
         extension = os.path.splitext(file_path)[1].lower()
         text = ""
@@ -54,7 +123,8 @@ class RAGManager:
                 text = f.read()
         return text
 
-    def chunk_text(self, text: str, chunk_size=500, overlap=50):
+    @metrics.timed("chunk")
+    def chunk_text(self, text: str, chunk_size=context.CHUNK_SIZE, overlap=context.CHUNK_OVERLAP):
         words = text.split()
         chunks = []
         for i in range(0, len(words), chunk_size - overlap):
@@ -62,41 +132,75 @@ class RAGManager:
             chunks.append(chunk)
         return chunks
 
-    def add_document(self, file_path: str, file_name: str):
+    def add_document(self, file_path: str, file_name: str, doc_id: int = None):
         text = self.extract_text(file_path)
         chunks = self.chunk_text(text)
-        
-        if not chunks:
-            return
-            
-        embeddings = embedding_model.encode(chunks)
-        self.index.add(np.array(embeddings).astype('float32'))
-        
-        for chunk in chunks:
-            self.metadata.append({"file_name": file_name, "content": chunk})
-            
-        faiss.write_index(self.index, self.index_path)
-        np.save(self.docs_metadata_path, self.metadata)
+        self.add_documents([{"file_name": file_name, "doc_id": doc_id, "chunks": chunks}])
 
-    def delete_document(self, file_name: str):
-        # Filter out the deleted document from metadata
-        new_metadata = [item for item in self.metadata if item['file_name'] != file_name]
-        
-        if len(new_metadata) == len(self.metadata):
-            return # Document not found
-            
-        self.metadata = new_metadata
-        
-        # Rebuild the index from scratch
-        self.index = faiss.IndexFlatL2(self.dimension)
-        if self.metadata:
-            chunks = [item['content'] for item in self.metadata]
-            embeddings = embedding_model.encode(chunks)
-            self.index.add(np.array(embeddings).astype('float32'))
-            
-        faiss.write_index(self.index, self.index_path)
-        np.save(self.docs_metadata_path, self.metadata)
+    def add_documents(self, documents: List[dict]):
+        # Pools chunks from many files into one encode pass and one index segment
+        items = []
+        for document in documents:
+            for number, chunk in enumerate(document["chunks"]):
+                items.append({
+                    "file_name": document["file_name"],
+                    "doc_id": document.get("doc_id"),
+                    "chunk": number,
+                    "content": chunk,
+                })
+
+        if not items:
+            return 0
 
+        while True:
+            # Embed with whatever model the index was built with
+            model = self.store.current().model
+            with metrics.span("embed"):
+                embeddings = get_embedding_model(model).encode([item["content"] for item in items], batch_size=EMBED_BATCH_SIZE)
+            try:
+                self.store.append(np.array(embeddings).astype('float32'), items)
+                break
+            except index_store.IndexRetired:
+                # A re-embedding migration switched versions; retry against the new one
+                self._open_store()
+        self._maybe_compact()
+        return len(items)
+
+    def delete_document(self, file_name: str, doc_id: int = None):
+        # Deleted chunks are tombstoned; the compactor drops their vectors later.
+        # Chunks are matched by document id; the file name only identifies
+        # chunks indexed before document ids were recorded.
+        def matches(item):
+            if item.get('doc_id') is not None:
+                return item['doc_id'] == doc_id
+            return item['file_name'] == file_name
+        try:
+            removed = self.store.delete_where(matches)
+        except index_store.IndexRetired:
+            self._open_store()
+            removed = self.store.delete_where(matches)
+        if removed:
+            self._maybe_compact()
+
+    def delete_documents(self, doc_ids: List[int]):
+        # Tombstones every chunk of the given document ids in one manifest commit
+        doc_ids = set(doc_ids)
+        def matches(item):
+            return item.get('doc_id') in doc_ids
+        try:
+            removed = self.store.delete_where(matches)
+        except index_store.IndexRetired:
+            self._open_store()
+            removed = self.store.delete_where(matches)
+        if removed:
+            self._maybe_compact()
+        return removed
+
+    def _maybe_compact(self):
+        if self.store.needs_compaction():
+            index_store.compact_in_background(self.store)
+
+    @metrics.timed("web_search")
     def search_web(self, query: str):
         try:
             with DDGS() as ddgs:
@@ -107,24 +211,75 @@ class RAGManager:
             print(f"Web search error: {e}")
             return ""
 
-    def search(self, query: str, top_k=3):
-        if self.index.ntotal == 0:
-            return []
-            
-        query_embedding = embedding_model.encode([query])
-        distances, indices = self.index.search(np.array(query_embedding).astype('float32'), top_k)
-        
-        results = []
-        for idx in indices[0]:
-            if idx != -1 and idx < len(self.metadata):
-                results.append(self.metadata[idx])
+    def search(self, query: str, top_k=3, document_ids: List[int] = None, file_names: List[str] = None, mode: str = None):
+        return self.search_many([query], top_k, document_ids=document_ids, file_names=file_names, mode=mode)[0]
+
+    def search_many(self, queries: List[str], top_k=3, document_ids: List[int] = None, file_names: List[str] = None, mode: str = None):
+        # One encode pass and one batched index search for all queries; returns
+        # a ranked hit list per query. document_ids scopes the search to those
+        # documents through FAISS id selectors; file_names covers chunks indexed
+        # before document ids were recorded. mode is one of RETRIEVAL_MODES.
+        mode = mode or RETRIEVAL_MODE
+        snapshot = self.store.current()
+        if snapshot.ntotal == 0 or not queries:
+            return [[] for _ in queries]
+
+        ranges = None
+        if document_ids is not None or file_names is not None:
+            ranges = snapshot.document_ranges(document_ids, file_names)
+            if not ranges:
+                return [[] for _ in queries]
+
+        results = [None] * len(queries)
+        lexical_hits = [[] for _ in queries]
+        if mode != "dense":
+            with metrics.span("lexical_search"):
+                found = [snapshot.lexical_search(query, top_k, ranges=ranges) for query in queries]
+            lexical_hits = [[dict(item, score=round(score, 4)) for score, item, _, _ in hits] for hits in found]
+            if mode == "lexical":
+                return lexical_hits
+            for i, hits in enumerate(found):
+                if hits and hits[0][3] and hits[0][2] >= LEXICAL_SHORTCUT_COVERAGE:
+                    results[i] = lexical_hits[i]
+                    LEXICAL_SHORTCUTS.inc()
+
+        pending = [i for i, hits in enumerate(results) if hits is None]
+        if not pending:
+            return results
+        with metrics.span("query_embed"):
+            query_embeddings = get_embedding_model(snapshot.model).encode([queries[i] for i in pending], batch_size=EMBED_BATCH_SIZE)
+        with metrics.span("index_search"):
+            dense = snapshot.search_batch(np.array(query_embeddings).astype('float32'), top_k, ranges=ranges)
+        for i, hits in zip(pending, dense):
+            # Embeddings are normalized, so L2 distance maps onto cosine similarity
+            hits = [dict(item, score=round(1 - distance / 2, 4)) for distance, item in hits]
+            results[i] = hits if mode == "dense" else fuse_ranked(hits, lexical_hits[i], top_k)
         return results
 
-    def generate_response(self, query: str, chat_history: List[dict] = []):
+    def generate_response(self, query: str, chat_history: List[dict] = [], document_ids: List[int] = None, file_names: List[str] = None, candidates: List[dict] = None, mode: str = None):
+        # candidates lets a caller that already searched (the batch endpoint) skip retrieval
+        prepared = self.prepare_response(query, chat_history, document_ids, file_names, candidates, mode)
+        return self.stream_response(prepared)
+
+    def prepare_response(self, query: str, chat_history: List[dict] = [], document_ids: List[int] = None, file_names: List[str] = None, candidates: List[dict] = None, mode: str = None):
+        # Retrieval and prompt assembly, without touching the LLM: fills in
+        # source_info/sources/context_stats, so callers can report sources
+        # before waiting for a slot. Returns what stream_response needs.
         try:
-            # Check if user has ANY documents uploaded
-            has_documents = self.index.ntotal > 0
-            context_docs = self.search(query) if has_documents else []
+            if candidates is None:
+                # Check if user has ANY documents uploaded
+                has_documents = self.store.ntotal > 0
+                # Over-fetch candidates, then merge overlapping chunks and trim to the token budget
+                candidates = self.search(
+                    query,
+                    top_k=context.CONTEXT_CANDIDATES,
+                    document_ids=document_ids,
+                    file_names=file_names,
+                    mode=mode,
+                ) if has_documents else []
+            context_docs, self.context_stats = context.pack_context(candidates)
+            if candidates:
+                print(f"Context for User ID {self.user_id}: {self.context_stats}")
             
             # User data isolation - ensured by self.user_id in index path
             print(f"DEBUG: Processing query for User ID: {self.user_id}")
@@ -134,6 +289,13 @@ class RAGManager:
                 context_text = "\n\n".join([doc['content'] for doc in context_docs])
                 filenames = list(set([doc['file_name'] for doc in context_docs]))
                 source_info = f"Uploaded Documents ({', '.join(filenames)})"
+                best_scores = {}
+                for doc in context_docs:
+                    best_scores[doc['file_name']] = max(doc['score'], best_scores.get(doc['file_name'], -1))
+                self.sources = [
+                    {"file_name": name, "score": score}
+                    for name, score in sorted(best_scores.items(), key=lambda kv: kv[1], reverse=True)
+                ]
             else:
                 context_text = ""
                 source_info = ""
@@ -161,6 +323,7 @@ class RAGManager:
                 print(f"User confirmed web search for: {actual_query}")
                 web_context = self.search_web(actual_query)
                 source_info = "Web Search"
+                self.sources = []
                 is_web_search_required = True
                 context_text = web_context
             elif not context_docs:
@@ -168,9 +331,8 @@ class RAGManager:
                 if any(kw in query.lower() for kw in small_talk_keywords) and len(query.split()) < 6:
                     source_info = "General Conversation"
                 else:
-                    def ask_permission_generator():
-                        yield "This information is not mentioned in your documents. Should I search the web for you? (Yes/No)"
-                    return ask_permission_generator()
+                    self.source_info = "Permission Request"
+                    return {"reply": "This information is not mentioned in your documents. Should I search the web for you? (Yes/No)"}
 
             system_prompt = f"""You are ResearchHUB AI, an expert research assistant.
             
@@ -193,19 +355,40 @@ class RAGManager:
             {context_text if context_text else "No research context available."}
             """
 
+            self.source_info = source_info
             messages = [{"role": "system", "content": system_prompt}]
             for msg in chat_history:
                 messages.append({"role": msg["role"], "content": msg["content"]})
             messages.append({"role": "user", "content": query})
-            
-            completion = client.chat_completion(
-                model=DEFAULT_MODEL,
-                messages=messages,
-                temperature=0.7,
-                max_tokens=2048,
-                stream=True
-            )
-            return completion
+            return {"messages": messages}
+        except Exception as e:
+            return {"error": e}
+
+    def stream_response(self, prepared: dict):
+        # Waits for an LLM slot (raising admission.Rejected if there is none)
+        # and opens the completion stream; the slot is held until the stream
+        # is consumed or closed
+        if "reply" in prepared:
+            return iter([prepared["reply"]])
+        try:
+            if "error" in prepared:
+                raise prepared["error"]
+            slot = admission.llm_limiter.acquire(self.user_id)
+            try:
+                llm_started = time.perf_counter()
+                completion = admission.with_backoff(lambda: client.chat_completion(
+                    model=DEFAULT_MODEL,
+                    messages=prepared["messages"],
+                    temperature=0.7,
+                    max_tokens=2048,
+                    stream=True
+                ))
+            except BaseException:
+                slot.release()
+                raise
+            return slot.hold(metrics.timed_stream(completion, llm_started))
+        except admission.Rejected:
+            raise
         except Exception as e:
             error_msg = str(e)
             print(f"Error in generate_response: {error_msg}")
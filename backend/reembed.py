@@ -0,0 +1,140 @@
+import os
+import time
+import argparse
+import threading
+import numpy as np
+import index_store
+import tenant_store
+
+# Re-embeds vector indexes when EMBEDDING_MODEL changes.
+#
+#   python reembed.py                                 # migrate every index to EMBEDDING_MODEL
+#   python reembed.py --model all-mpnet-base-v2 --user 7 --rate 50
+#
+# or set REEMBED_ON_STARTUP=true to run it in a background thread of the API.
+# Chunk text is already stored in segment metadata, so nothing is re-parsed:
+# each index root (indices/user_{id}, indices/shared) gets a new version built
+# in root/v{n+1} from the old version's live chunks, in rate-limited batches,
+# while queries keep using the old version. Every migrated chunk records its
+# source_id, so an interrupted migration picks up where it stopped. The final
+# catch-up runs under the old version's write lock: it embeds chunks uploaded
+# during the migration, mirrors deletes, repoints root/CURRENT and retires the
+# old version, so writers that still hold it get IndexRetired and reopen.
+# Retired versions stay on disk until maintenance.py removes them.
+
+REEMBED_ON_STARTUP = os.getenv("REEMBED_ON_STARTUP", "false").lower() in ("1", "true", "yes")
+REEMBED_BATCH_SIZE = int(os.getenv("REEMBED_BATCH_SIZE", 256))
+REEMBED_CHUNKS_PER_SEC = float(os.getenv("REEMBED_CHUNKS_PER_SEC", 200)) # 0 disables throttling
+
+
+def _copy(source_items, target, encoder, batch_size, chunks_per_sec):
+    # Compaction is left to the caller: merging once after the bulk copy is
+    # far cheaper than keeping the segment count down batch by batch
+    copied = 0
+    done, seen = set(), set()
+    for start in range(0, len(source_items), batch_size):
+        started = time.time()
+        with target.write_lock():
+            # Checked under the lock so two migrators never copy the same chunk
+            # twice. Only segments not seen yet are scanned, so this costs what
+            # was appended since the last batch, not the whole target.
+            for seg in target.current().segments:
+                if seg.name not in seen:
+                    seen.add(seg.name)
+                    done.update(item["source_id"] for item in seg.metadata)
+            batch = [item for item in source_items[start:start + batch_size] if item["id"] not in done]
+            if not batch:
+                continue
+            vectors = encoder.encode([item["content"] for item in batch], batch_size=min(batch_size, 64))
+            items = [dict({k: v for k, v in item.items() if k != "id"}, source_id=item["id"]) for item in batch]
+            target.append(np.array(vectors).astype("float32"), items)
+        copied += len(batch)
+        if chunks_per_sec:
+            time.sleep(max(0.0, len(batch) / chunks_per_sec - (time.time() - started)))
+    return copied
+
+
+def migrate_root(root: str, model: str, encoder, dimension: int, batch_size: int = REEMBED_BATCH_SIZE, chunks_per_sec: float = REEMBED_CHUNKS_PER_SEC):
+    # encoder is anything with a sentence-transformers style encode()
+    version, directory = index_store.current_version(root)
+    legacy_prefix = root if version == 1 and root != tenant_store.SHARED_DIR else None
+    source = index_store.get_store(directory, legacy_prefix=legacy_prefix)
+    if source.model == model or not os.path.exists(source.manifest_path):
+        return None
+
+    target_name = f"v{version + 1}"
+    target = index_store.get_store(os.path.join(root, target_name), dimension, model=model)
+    if target.model != model:
+        raise RuntimeError(f"{target.directory} holds a partial migration to {target.model}; remove it to migrate to {model}")
+
+    started = time.time()
+    copied = _copy(source.live_metadata(), target, encoder, batch_size, chunks_per_sec)
+    if target.needs_compaction():
+        # Before taking the source's write lock, so the catch-up stays short
+        target.compact()
+
+    with source.write_lock():
+        # Uploads and deletes that landed while the bulk copy ran
+        live = source.live_metadata()
+        copied += _copy(live, target, encoder, batch_size, 0)
+        live_ids = {item["id"] for item in live}
+        removed = target.delete_where(lambda item: item["source_id"] not in live_ids)
+        index_store.switch_version(root, version + 1, target_name)
+        source.retire()
+
+    if target.needs_compaction():
+        index_store.compact_in_background(target)
+    report = {
+        "root": root,
+        "from": f"v{version} ({source.model})",
+        "to": f"{target_name} ({model})",
+        "chunks": target.ntotal,
+        "embedded": copied,
+        "deleted": removed,
+        "seconds": round(time.time() - started, 2),
+    }
+    print(f"Re-embedded {root}: {report}")
+    return report
+
+
+def migrate_all(model: str = None, user_id: int = None, batch_size: int = REEMBED_BATCH_SIZE, chunks_per_sec: float = REEMBED_CHUNKS_PER_SEC):
+    import rag
+    model = model or rag.EMBEDDING_MODEL_NAME
+    encoder, dimension = rag.get_embedding_model(model), rag.embedding_dimension(model)
+    roots = [tenant_store.dedicated_dir(user_id)] if user_id is not None else tenant_store.index_roots()
+    reports = []
+    for root in roots:
+        try:
+            report = migrate_root(root, model, encoder, dimension, batch_size, chunks_per_sec)
+        except Exception as e:
+            # Leave this root on its current version; a later run resumes it
+            print(f"Re-embedding {root} failed: {e}")
+            continue
+        if report:
+            reports.append(report)
+    return reports
+
+
+_migration_thread = None
+_migration_lock = threading.Lock()
+
+
+def start_background_migration(model: str = None):
+    global _migration_thread
+    with _migration_lock:
+        if _migration_thread is not None and _migration_thread.is_alive():
+            return _migration_thread
+        _migration_thread = threading.Thread(target=migrate_all, kwargs={"model": model}, daemon=True)
+        _migration_thread.start()
+        return _migration_thread
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Re-embed vector indexes with a new embedding model")
+    parser.add_argument("--model", help="target model (default: EMBEDDING_MODEL)")
+    parser.add_argument("--user", type=int, help="only migrate this user's dedicated index")
+    parser.add_argument("--batch-size", type=int, default=REEMBED_BATCH_SIZE)
+    parser.add_argument("--rate", type=float, default=REEMBED_CHUNKS_PER_SEC, help="chunks per second, 0 for unthrottled")
+    args = parser.parse_args()
+    reports = migrate_all(args.model, args.user, args.batch_size, args.rate)
+    print(f"Migrated {len(reports)} index(es)")
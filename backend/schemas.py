@@ -66,3 +66,10 @@ class ChatResponse(ChatBase):
 
 class ChatDetail(ChatResponse):
     messages: List[MessageResponse] = []
+
+class BatchQueryRequest(BaseModel):
+    queries: List[str]
+    top_k: int = 5
+    document_ids: Optional[List[int]] = None
+    retrieval_mode: Optional[str] = None
+    answer: bool = False
@@ -0,0 +1,195 @@
+import os
+from typing import List
+import numpy as np
+import index_store
+
+# Tenant packing for long-tail users. With TENANT_PACKING enabled, users without
+# a dedicated index keep their chunks in one shared segmented store
+# (indices/shared), tagged with their user id, instead of a per-user directory.
+# Every read goes through TenantView, which restricts FAISS searches to that
+# user's chunk-id ranges, so tenants never see each other's vectors. Once a
+# user holds more than TENANT_PACK_MAX_CHUNKS chunks they are promoted: their
+# vectors are copied into indices/user_{id} and tombstoned in the shared store.
+
+TENANT_PACKING = os.getenv("TENANT_PACKING", "false").lower() in ("1", "true", "yes")
+TENANT_PACK_MAX_CHUNKS = int(os.getenv("TENANT_PACK_MAX_CHUNKS", 2000))
+INDEX_ROOT = "indices"
+SHARED_DIR = os.path.join(INDEX_ROOT, "shared")
+
+
+def dedicated_dir(user_id: int) -> str:
+    return os.path.join(INDEX_ROOT, f"user_{user_id}")
+
+
+def has_dedicated_index(user_id: int) -> bool:
+    root = dedicated_dir(user_id)
+    return (
+        os.path.exists(os.path.join(root, "manifest.json"))
+        or os.path.exists(os.path.join(root, "CURRENT"))
+        or os.path.exists(f"{root}.index")
+    )
+
+
+def open_dedicated_store(user_id: int, model: str, dimension: int):
+    # model/dimension are only used if the index doesn't exist yet
+    return index_store.open_root(dedicated_dir(user_id), dimension, model, legacy_prefix=dedicated_dir(user_id))
+
+
+def open_shared_store(model: str, dimension: int):
+    return index_store.open_root(SHARED_DIR, dimension, model)
+
+
+def index_roots():
+    # Every per-user root plus the shared store, including users whose index is
+    # still in the pre-segment layout
+    roots = set()
+    if os.path.isdir(INDEX_ROOT):
+        for name in os.listdir(INDEX_ROOT):
+            if not name.startswith("user_"):
+                continue
+            # Pre-segment indexes are loose user_{id}.index files next to the directories
+            if name.endswith(".index"):
+                name = name[:-len(".index")]
+            elif name.endswith(".npy"):
+                continue
+            roots.add(os.path.join(INDEX_ROOT, name))
+    if os.path.isdir(SHARED_DIR):
+        roots.add(SHARED_DIR)
+    return sorted(roots)
+
+
+def open_user_store(user_id: int, model: str, dimension: int):
+    if not TENANT_PACKING or has_dedicated_index(user_id):
+        return open_dedicated_store(user_id, model, dimension)
+    return TenantView(open_shared_store(model, dimension), user_id)
+
+
+class TenantSnapshot:
+    # One tenant's slice of a shared Snapshot, with the same read interface
+    def __init__(self, snapshot, user_id: int):
+        self.snapshot = snapshot
+        self.user_id = user_id
+        self.segments = snapshot.segments
+        self.ids = snapshot.tenant_ids(user_id)
+        self.ranges = index_store.id_ranges(self.ids)
+
+    @property
+    def model(self) -> str:
+        return self.snapshot.model
+
+    @property
+    def dimension(self) -> int:
+        return self.snapshot.dimension
+
+    @property
+    def ntotal(self) -> int:
+        return len(self.ids)
+
+    def live_metadata(self) -> List[dict]:
+        items = []
+        for seg in self.segments:
+            items.extend(seg.by_id[chunk_id] for chunk_id in seg.groups[1].get(self.user_id, ()) if chunk_id not in self.snapshot.tombstones)
+        return items
+
+    def document_ranges(self, document_ids=(), file_names=()):
+        ranges = self.snapshot.document_ranges(document_ids, file_names)
+        return index_store.intersect_ranges(ranges, self.ranges)
+
+    def search(self, query_vectors: np.ndarray, top_k: int, ranges=None):
+        return self.search_batch(query_vectors, top_k, ranges=ranges)[0]
+
+    def search_batch(self, query_vectors: np.ndarray, top_k: int, ranges=None):
+        scope = self.ranges if ranges is None else index_store.intersect_ranges(ranges, self.ranges)
+        return self.snapshot.search_batch(query_vectors, top_k, ranges=scope)
+
+    def lexical_search(self, query: str, top_k: int, ranges=None):
+        # BM25 statistics are computed over this tenant's chunks only
+        scope = self.ranges if ranges is None else index_store.intersect_ranges(ranges, self.ranges)
+        return self.snapshot.lexical_search(query, top_k, ranges=scope)
+
+
+class TenantView:
+    # Store-like wrapper that RAGManager uses in place of a dedicated SegmentedIndex
+    def __init__(self, shared, user_id: int):
+        self.shared = shared
+        self.user_id = user_id
+        self.directory = shared.directory
+
+    @property
+    def model(self) -> str:
+        return self.shared.model
+
+    @property
+    def dimension(self) -> int:
+        return self.shared.dimension
+
+    def current(self):
+        if has_dedicated_index(self.user_id):
+            # Promoted since this view was opened
+            return open_dedicated_store(self.user_id, self.model, self.dimension).current()
+        return TenantSnapshot(self.shared.current(), self.user_id)
+
+    @property
+    def ntotal(self) -> int:
+        return self.current().ntotal
+
+    def live_metadata(self) -> List[dict]:
+        return self.current().live_metadata()
+
+    def search(self, query_vectors: np.ndarray, top_k: int, ranges=None):
+        return self.current().search(query_vectors, top_k, ranges=ranges)
+
+    def search_batch(self, query_vectors: np.ndarray, top_k: int, ranges=None):
+        return self.current().search_batch(query_vectors, top_k, ranges=ranges)
+
+    def append(self, vectors: np.ndarray, items: List[dict]):
+        with self.shared.write_lock():
+            # Another request or worker may have promoted this user meanwhile
+            if has_dedicated_index(self.user_id):
+                open_dedicated_store(self.user_id, self.model, self.dimension).append(vectors, items)
+                return
+            self.shared.append(vectors, [dict(item, user_id=self.user_id) for item in items])
+            if self.shared.current().tenant_count(self.user_id) > TENANT_PACK_MAX_CHUNKS:
+                promote(self.shared, self.user_id)
+
+    def delete_where(self, predicate) -> int:
+        with self.shared.write_lock():
+            if has_dedicated_index(self.user_id):
+                return open_dedicated_store(self.user_id, self.model, self.dimension).delete_where(predicate)
+            return self.shared.delete_where(predicate, tenant=self.user_id)
+
+    def needs_compaction(self) -> bool:
+        return self.shared.needs_compaction()
+
+    def compact(self):
+        self.shared.compact()
+
+
+def promote(shared, user_id: int):
+    # Moves a tenant out of the shared store. The dedicated manifest is committed
+    # before the shared chunks are tombstoned, and both happen under the shared
+    # write lock, so a concurrent append can never land in the wrong place.
+    with shared.write_lock():
+        snapshot = shared.current()
+        ids = set(snapshot.tenant_ids(user_id))
+        if not ids:
+            return 0
+
+        vectors, items = [], []
+        for seg in snapshot.segments:
+            if user_id not in seg.groups[1]:
+                continue
+            seg_vectors = seg.vectors()
+            for row, item in enumerate(seg.metadata):
+                if item["id"] in ids:
+                    vectors.append(seg_vectors[row])
+                    items.append({k: v for k, v in item.items() if k not in ("id", "user_id")})
+
+        dedicated = open_dedicated_store(user_id, shared.model, shared.dimension)
+        dedicated.append(np.array(vectors, dtype="float32"), items)
+        shared.delete_where(lambda item: item["id"] in ids, tenant=user_id)
+
+    print(f"Promoted user {user_id} to a dedicated index ({len(items)} chunks)")
+    if shared.needs_compaction():
+        index_store.compact_in_background(shared)
+    return len(items)
@@ -0,0 +1,239 @@
+import gc
+import time
+import queue
+import threading
+import types
+import admission
+
+# Deterministic tests for the LLM admission limiter: per-user and queue-full
+# rejections, a queue timeout racing a release, FIFO handoff, and slots given
+# back when a held stream ends, is closed or is dropped. Nothing sleeps on a
+# guess: threads are sequenced with events and the limiter's own queue.
+# Run with `python test_admission.py` or `pytest test_admission.py`.
+
+TIMEOUT = 5
+
+
+def wait_until(condition):
+    for _ in range(TIMEOUT * 1000):
+        if condition():
+            return
+        time.sleep(0.001)
+    raise AssertionError("Timed out waiting for the limiter")
+
+
+def acquire_in_thread(limiter, user_id, results):
+    # Queues user_id behind the running slots; the Slot (or Rejected) lands in results
+    def run():
+        try:
+            results.put(limiter.acquire(user_id))
+        except admission.Rejected as e:
+            results.put(e)
+    queued = len(limiter.waiters)
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    wait_until(lambda: len(limiter.waiters) > queued or not results.empty())
+    return thread
+
+
+def assert_idle(limiter):
+    assert limiter.active == 0 and limiter.per_user == {} and not limiter.waiters, (limiter.active, limiter.per_user)
+
+
+def rejection(call):
+    try:
+        call()
+    except admission.Rejected as e:
+        return e
+    raise AssertionError("Expected Rejected")
+
+
+def test_per_user_limit_is_429_and_counts_queued_requests():
+    limiter = admission.Limiter(max_concurrency=2, max_per_user=2, queue_size=4, queue_timeout=TIMEOUT)
+    first = limiter.acquire(1)
+    other = limiter.acquire(2)
+    results = queue.Queue()
+    # User 1's second request has to queue, and still counts against them
+    acquire_in_thread(limiter, 1, results)
+    e = rejection(lambda: limiter.acquire(1))
+    assert e.status_code == 429 and e.retry_after >= 1
+
+    first.release()
+    second = results.get(timeout=TIMEOUT)
+    assert second.user_id == 1 and limiter.per_user == {1: 1, 2: 1}
+    other.release()
+    # Back under the per-user limit once one of theirs is admitted
+    third = limiter.acquire(1)
+    second.release()
+    third.release()
+    assert_idle(limiter)
+
+
+def test_full_queue_is_503():
+    limiter = admission.Limiter(max_concurrency=1, max_per_user=5, queue_size=1, queue_timeout=TIMEOUT)
+    running = limiter.acquire(1)
+    results = queue.Queue()
+    acquire_in_thread(limiter, 2, results)
+    e = rejection(lambda: limiter.acquire(3))
+    assert e.status_code == 503 and e.retry_after >= 1
+    assert limiter.per_user == {1: 1, 2: 1}, "A rejected request must not stay counted"
+
+    running.release()
+    results.get(timeout=TIMEOUT).release()
+    assert_idle(limiter)
+
+
+def test_queue_timeout_without_a_release_is_503():
+    limiter = admission.Limiter(max_concurrency=1, max_per_user=5, queue_size=4, queue_timeout=0.01)
+    running = limiter.acquire(1)
+    e = rejection(lambda: limiter.acquire(2))
+    assert e.status_code == 503 and not limiter.waiters and limiter.per_user == {1: 1}
+    running.release()
+    assert_idle(limiter)
+
+
+def test_release_that_races_a_queue_timeout_still_admits():
+    # The waiter's wait() times out, then a release hands it the slot before
+    # acquire() gets the lock back: it must take the slot, not raise and leak it
+    limiter = admission.Limiter(max_concurrency=1, max_per_user=5, queue_size=4, queue_timeout=TIMEOUT)
+    timed_out, resume = threading.Event(), threading.Event()
+    real_event = threading.Event
+
+    class TimesOut:
+        def __init__(self):
+            self.event = real_event()
+
+        def set(self):
+            self.event.set()
+
+        def wait(self, timeout):
+            timed_out.set()
+            resume.wait(TIMEOUT)
+            return False
+
+    running = limiter.acquire(1)
+    results = queue.Queue()
+    previous = admission.threading
+    admission.threading = types.SimpleNamespace(Event=TimesOut)
+    try:
+        acquire_in_thread(limiter, 2, results)
+        assert timed_out.wait(TIMEOUT)
+    finally:
+        admission.threading = previous
+    running.release()
+    resume.set()
+
+    slot = results.get(timeout=TIMEOUT)
+    assert isinstance(slot, admission.Slot), slot
+    assert limiter.active == 1 and limiter.per_user == {2: 1}
+    slot.release()
+    assert_idle(limiter)
+
+
+def test_waiters_are_admitted_in_arrival_order():
+    limiter = admission.Limiter(max_concurrency=1, max_per_user=5, queue_size=8, queue_timeout=TIMEOUT)
+    slot = limiter.acquire(0)
+    results = queue.Queue()
+    for user_id in (1, 2, 3):
+        acquire_in_thread(limiter, user_id, results)
+    assert [waiter["user_id"] for waiter in limiter.waiters] == [1, 2, 3]
+
+    admitted = []
+    for _ in range(4):
+        slot.release()
+        slot = results.get(timeout=TIMEOUT)
+        admitted.append(slot.user_id)
+        assert limiter.active == 1, "A release must hand over exactly one slot"
+        if slot.user_id == 1:
+            # Arrives after the others, so it must not get in ahead of them
+            acquire_in_thread(limiter, 4, results)
+    assert admitted == [1, 2, 3, 4]
+    slot.release()
+    assert_idle(limiter)
+
+
+def test_held_stream_releases_once_on_end_error_close_and_drop():
+    limiter = admission.Limiter(max_concurrency=4, max_per_user=4, queue_size=4, queue_timeout=TIMEOUT)
+
+    assert list(limiter.acquire(1).hold(iter(["a", "b"]))) == ["a", "b"]
+    assert_idle(limiter)
+
+    def failing():
+        yield "a"
+        raise RuntimeError("upstream went away")
+    held = limiter.acquire(1).hold(failing())
+    next(held)
+    try:
+        next(held)
+    except RuntimeError:
+        pass
+    assert_idle(limiter)
+
+    held = limiter.acquire(1).hold(iter(["a"]))
+    held.close()
+    held.close()
+    assert_idle(limiter)
+
+    # Never read at all, e.g. the client left before the response started
+    held = limiter.acquire(1).hold(iter(["a"]))
+    del held
+    gc.collect()
+    assert_idle(limiter)
+
+
+def test_close_while_another_thread_is_reading():
+    # Streams are read from worker threads, while a client disconnect closes
+    # them from the event loop
+    limiter = admission.Limiter(max_concurrency=4, max_per_user=4, queue_size=4, queue_timeout=TIMEOUT)
+    reading, finish = threading.Event(), threading.Event()
+
+    def slow():
+        reading.set()
+        finish.wait(TIMEOUT)
+        yield "late"
+    held = limiter.acquire(1).hold(slow())
+    reader = threading.Thread(target=lambda: next(held, None), daemon=True)
+    reader.start()
+    assert reading.wait(TIMEOUT)
+    held.close()
+    assert_idle(limiter)
+    finish.set()
+    reader.join(TIMEOUT)
+    assert_idle(limiter)
+
+
+def test_drop_inside_the_limiter_does_not_deadlock():
+    # Garbage collection can finalise a HeldStream on a thread that already
+    # holds the limiter's lock
+    limiter = admission.Limiter(max_concurrency=4, max_per_user=4, queue_size=4, queue_timeout=TIMEOUT)
+    holder = [limiter.acquire(1).hold(iter(["a"]))]
+
+    def drop():
+        with limiter._lock:
+            holder.clear()
+    thread = threading.Thread(target=drop, daemon=True)
+    thread.start()
+    thread.join(TIMEOUT)
+    assert not thread.is_alive(), "Releasing under the limiter's lock deadlocked"
+    assert_idle(limiter)
+
+
+if __name__ == "__main__":
+    print("--- Starting Admission Control Tests ---")
+    test_per_user_limit_is_429_and_counts_queued_requests()
+    print("[+] Per-user limit: 429, queued requests counted.")
+    test_full_queue_is_503()
+    print("[+] Full queue: 503.")
+    test_queue_timeout_without_a_release_is_503()
+    print("[+] Queue timeout: 503, nothing left counted.")
+    test_release_that_races_a_queue_timeout_still_admits()
+    print("[+] Release racing a queue timeout: slot taken, not leaked.")
+    test_waiters_are_admitted_in_arrival_order()
+    print("[+] Waiters admitted in FIFO order.")
+    test_held_stream_releases_once_on_end_error_close_and_drop()
+    print("[+] Held streams release once on end, error, close and drop.")
+    test_close_while_another_thread_is_reading()
+    print("[+] Close while another thread reads: slot released, no error.")
+    test_drop_inside_the_limiter_does_not_deadlock()
+    print("[+] Dropping a stream under the limiter lock: no deadlock.")
+    print("--- All tests completed ---")
@@ -0,0 +1,76 @@
+import context
+
+# Offline tests for context packing: merging overlapping chunks, the window
+# kept around the best chunk, and the token budget.
+# Run with `python test_context.py` or `pytest test_context.py`.
+
+STEP = context.CHUNK_SIZE - context.CHUNK_OVERLAP
+
+
+def make_hits(file_name, total_words, scores):
+    # Chunks the way RAGManager.chunk_text does, with numbered words so the
+    # merged text can be checked word for word
+    words = [f"{file_name}-w{i}" for i in range(total_words)]
+    hits = []
+    for number, start in enumerate(range(0, total_words, STEP)):
+        if number in scores:
+            hits.append({
+                "file_name": file_name,
+                "doc_id": file_name,
+                "chunk": number,
+                "content": " ".join(words[start:start + context.CHUNK_SIZE]),
+                "score": scores[number],
+            })
+    return words, hits
+
+
+def test_adjacent_chunks_merge_without_repeating_the_overlap():
+    words, hits = make_hits("a", 3 * STEP + context.CHUNK_OVERLAP, {0: 0.5, 1: 0.9, 3: 0.4})
+    spans = context.merge_adjacent(hits + [{"file_name": "old.txt", "content": "legacy chunk", "score": 0.7}])
+
+    merged = spans[0]
+    assert merged["chunks"] == [0, 1] and merged["best_chunk"] == 1 and merged["score"] == 0.9
+    assert merged["content"].split() == words[:STEP + context.CHUNK_SIZE], "Seam repeated or dropped words"
+    assert [span["score"] for span in spans] == [0.9, 0.7, 0.4]
+    assert spans[1]["content"] == "legacy chunk" and spans[1]["chunks"] == []
+    assert spans[2]["chunks"] == [3]
+
+
+def test_window_centres_on_the_best_chunk():
+    words, hits = make_hits("a", 3 * STEP + context.CHUNK_OVERLAP, {0: 0.1, 1: 0.2, 2: 0.8})
+    span = context.merge_adjacent(hits)[0]
+    assert span["chunks"] == [0, 1, 2]
+    assert context._window(span, 100) == words[2 * STEP:2 * STEP + 100]
+    # Clamped to the end of the span rather than running short
+    tail = context._window(span, context.CHUNK_SIZE + 200)
+    assert tail == words[3 * STEP + context.CHUNK_OVERLAP - (context.CHUNK_SIZE + 200):3 * STEP + context.CHUNK_OVERLAP]
+    assert context._window(dict(span, best_chunk=0), 100) == words[:100]
+
+
+def test_pack_context_fits_the_budget():
+    _, a = make_hits("a", context.CHUNK_SIZE, {0: 0.9})
+    _, b = make_hits("b", context.CHUNK_SIZE, {0: 0.8})
+    _, c = make_hits("c", context.CHUNK_SIZE, {0: 0.7})
+    chunk_tokens = context.estimate_tokens(a[0]["content"])
+    budget = chunk_tokens + chunk_tokens // 2 + context.MIN_TRUNCATED_TOKENS // 2
+
+    packed, stats = context.pack_context(a + b + c, token_budget=budget)
+    assert [span["file_name"] for span in packed] == ["a", "b"], "Third span should not fit at all"
+    assert not packed[0].get("truncated") and packed[1]["truncated"]
+    assert stats["packed_tokens"] <= budget
+    assert stats["previous_tokens"] == 3 * chunk_tokens
+    assert stats["tokens_saved"] == 3 * chunk_tokens - stats["packed_tokens"]
+    assert stats["overlap_tokens_removed"] == 0
+
+    assert context.pack_context([]) == ([], {})
+
+
+if __name__ == "__main__":
+    print("--- Starting Context Packing Tests ---")
+    test_adjacent_chunks_merge_without_repeating_the_overlap()
+    print("[+] Adjacent chunks merged without repeating the overlap.")
+    test_window_centres_on_the_best_chunk()
+    print("[+] Truncation window kept around the best chunk.")
+    test_pack_context_fits_the_budget()
+    print("[+] Packed context fits the token budget.")
+    print("--- All tests completed ---")
@@ -0,0 +1,383 @@
+import os
+import time
+import random
+import shutil
+import tempfile
+import threading
+import multiprocessing
+import numpy as np
+import index_store
+import lexical
+import tenant_store
+import reembed
+
+# Offline stress test for the per-user vector index: concurrent uploads,
+# deletes, compactions and queries against one store, then checks that no
+# chunk was lost and that readers never saw a torn index.
+# Run with `python test_index_concurrency.py` or `pytest test_index_concurrency.py`.
+
+DIMENSION = 16
+CHUNKS_PER_DOC = 5
+
+
+def make_chunks(file_name, dimension=DIMENSION):
+    vectors = np.random.rand(CHUNKS_PER_DOC, dimension).astype("float32")
+    items = [{"file_name": file_name, "content": f"{file_name} chunk {i}"} for i in range(CHUNKS_PER_DOC)]
+    return vectors, items
+
+
+def wait_for_compactions(timeout=30):
+    # Promotions compact the shared store in the background
+    deadline = time.time() + timeout
+    while index_store._compacting and time.time() < deadline:
+        time.sleep(0.05)
+
+
+def check_store(store, expected_files):
+    live = store.live_metadata()
+    counts = {}
+    for item in live:
+        counts[item["file_name"]] = counts.get(item["file_name"], 0) + 1
+    assert set(counts) == expected_files, f"Mismatched files: {set(counts) ^ expected_files}"
+    assert all(count == CHUNKS_PER_DOC for count in counts.values()), counts
+    assert store.ntotal == len(expected_files) * CHUNKS_PER_DOC
+    assert len({item["id"] for item in live}) == len(live), "Duplicate chunk ids"
+
+
+def test_concurrent_uploads_deletes_and_queries(writers=8, docs_per_writer=15, readers=4):
+    directory = tempfile.mkdtemp()
+    try:
+        store = index_store.SegmentedIndex(directory, DIMENSION)
+        deleted = set()
+        deleted_lock = threading.Lock()
+        errors = []
+        done = threading.Event()
+
+        def upload(writer_id):
+            try:
+                for n in range(docs_per_writer):
+                    file_name = f"w{writer_id}_doc{n}.txt"
+                    store.append(*make_chunks(file_name))
+                    # Delete roughly a third of what we upload, sometimes right away
+                    if random.random() < 0.33:
+                        store.delete_where(lambda item, name=file_name: item["file_name"] == name)
+                        with deleted_lock:
+                            deleted.add(file_name)
+                    if store.needs_compaction():
+                        store.compact()
+            except Exception as e:
+                errors.append(e)
+
+        def query():
+            try:
+                while not done.is_set():
+                    snapshot = store.current()
+                    total = sum(seg.index.ntotal for seg in snapshot.segments)
+                    metadata = sum(len(seg.metadata) for seg in snapshot.segments)
+                    assert total == metadata, "Index and metadata lengths diverged"
+                    for _, item in snapshot.search(np.random.rand(1, DIMENSION), 5):
+                        assert item["id"] not in snapshot.tombstones, "Search returned a deleted chunk"
+            except Exception as e:
+                errors.append(e)
+
+        reader_threads = [threading.Thread(target=query) for _ in range(readers)]
+        writer_threads = [threading.Thread(target=upload, args=(i,)) for i in range(writers)]
+        for t in reader_threads + writer_threads:
+            t.start()
+        for t in writer_threads:
+            t.join()
+        done.set()
+        for t in reader_threads:
+            t.join()
+
+        assert not errors, errors
+        uploaded = {f"w{w}_doc{n}.txt" for w in range(writers) for n in range(docs_per_writer)}
+        check_store(store, uploaded - deleted)
+        # A fresh load from disk must agree with the in-memory view
+        check_store(index_store.SegmentedIndex(directory, DIMENSION), uploaded - deleted)
+    finally:
+        shutil.rmtree(directory)
+
+
+def _process_uploader(directory, worker_id, docs):
+    np.random.seed(worker_id)
+    store = index_store.SegmentedIndex(directory, DIMENSION)
+    for n in range(docs):
+        store.append(*make_chunks(f"p{worker_id}_doc{n}.txt"))
+
+
+def test_concurrent_uploads_across_processes(workers=4, docs=10):
+    if index_store.fcntl is None:
+        print("Skipping multi-process test: no fcntl on this platform")
+        return
+    directory = tempfile.mkdtemp()
+    try:
+        procs = [multiprocessing.Process(target=_process_uploader, args=(directory, i, docs)) for i in range(workers)]
+        for p in procs:
+            p.start()
+        for p in procs:
+            p.join()
+            assert p.exitcode == 0
+
+        store = index_store.SegmentedIndex(directory, DIMENSION)
+        check_store(store, {f"p{w}_doc{n}.txt" for w in range(workers) for n in range(docs)})
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_tenant_packing_isolation_and_promotion(tenants=6, docs_per_tenant=12, threshold=30):
+    directory = tempfile.mkdtemp()
+    previous = (tenant_store.INDEX_ROOT, tenant_store.SHARED_DIR, tenant_store.TENANT_PACK_MAX_CHUNKS)
+    tenant_store.INDEX_ROOT = directory
+    tenant_store.SHARED_DIR = os.path.join(directory, "shared")
+    tenant_store.TENANT_PACK_MAX_CHUNKS = threshold
+    try:
+        shared = index_store.SegmentedIndex(tenant_store.SHARED_DIR, DIMENSION)
+        errors = []
+
+        def upload(user_id):
+            try:
+                view = tenant_store.TenantView(shared, user_id)
+                # Tenants with even ids stay small enough to remain packed
+                docs = docs_per_tenant if user_id % 2 else threshold // CHUNKS_PER_DOC - 1
+                for n in range(docs):
+                    view.append(*make_chunks(f"u{user_id}_doc{n}.txt"))
+                    for _, item in view.search(np.random.rand(1, DIMENSION), 10):
+                        assert item["file_name"].startswith(f"u{user_id}_"), "Search crossed tenants"
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=upload, args=(user_id,)) for user_id in range(1, tenants + 1)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert not errors, errors
+
+        for user_id in range(1, tenants + 1):
+            docs = docs_per_tenant if user_id % 2 else threshold // CHUNKS_PER_DOC - 1
+            assert tenant_store.has_dedicated_index(user_id) == bool(user_id % 2)
+            view = tenant_store.TenantView(shared, user_id)
+            check_store(view, {f"u{user_id}_doc{n}.txt" for n in range(docs)})
+
+        # A tenant's delete only scans, and can only remove, that tenant's chunks
+        before = shared.current().tenant_count(4)
+        assert tenant_store.TenantView(shared, 2).delete_where(lambda item: True) == before
+        assert shared.current().tenant_count(2) == 0 and shared.current().tenant_count(4) == before
+    finally:
+        wait_for_compactions()
+        tenant_store.INDEX_ROOT, tenant_store.SHARED_DIR, tenant_store.TENANT_PACK_MAX_CHUNKS = previous
+        shutil.rmtree(directory)
+
+
+def test_batched_search_matches_single_queries(queries=20, top_k=7):
+    directory = tempfile.mkdtemp()
+    try:
+        store = index_store.SegmentedIndex(directory, DIMENSION)
+        for n in range(12):
+            store.append(*make_chunks(f"doc{n}.txt"))
+        store.delete_where(lambda item: item["file_name"] in ("doc3.txt", "doc7.txt"))
+        snapshot = store.current()
+        vectors = np.random.rand(queries, DIMENSION).astype("float32")
+        ranges = snapshot.document_ranges((), [f"doc{n}.txt" for n in range(0, 12, 2)])
+        for scope in (None, ranges):
+            batched = snapshot.search_batch(vectors, top_k, ranges=scope)
+            assert len(batched) == queries
+            for row, hits in enumerate(batched):
+                single = snapshot.search(vectors[row:row + 1], top_k, ranges=scope)
+                assert [item["id"] for _, item in hits] == [item["id"] for _, item in single]
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_lexical_index_follows_appends_deletes_and_compaction():
+    directory = tempfile.mkdtemp()
+    try:
+        store = index_store.SegmentedIndex(directory, DIMENSION)
+        for n in range(10):
+            store.append(*make_chunks(f"doc{n}.txt"))
+        store.delete_where(lambda item: item["file_name"] == "doc3.txt")
+
+        def files(snapshot, query, ranges=None):
+            return {item["file_name"] for _, item, _, _ in snapshot.lexical_search(query, 50, ranges=ranges)}
+
+        def exact(snapshot, query):
+            # Files whose chunks contain the whole identifier; "txt" alone matches every chunk
+            return {item["file_name"] for _, item, _, matched in snapshot.lexical_search(query, 50) if matched}
+
+        snapshot = store.current()
+        assert exact(snapshot, "doc4.txt") == {"doc4.txt"}
+        assert exact(snapshot, "doc3.txt") == set(), "Lexical search returned a deleted chunk"
+        score, item, coverage, identifiers_matched = snapshot.lexical_search("doc4.txt", 1)[0]
+        assert identifiers_matched and coverage == 1.0
+        ranges = snapshot.document_ranges((), ["doc5.txt"])
+        assert files(snapshot, "chunk", ranges) == {"doc5.txt"}
+
+        # Segments written without postings build them from metadata on first
+        # use, and save them so the next process doesn't have to
+        os.remove(os.path.join(directory, "seg_000001.lex"))
+        reopened = index_store.SegmentedIndex(directory)
+        assert exact(reopened.current(), "doc0.txt") == {"doc0.txt"}
+        assert os.path.exists(os.path.join(directory, "seg_000001.lex"))
+        reopened.compact(full=True)
+        assert sorted(name for name in os.listdir(directory) if name.endswith(".lex")) == ["seg_000011.lex"]
+        # Compaction merges the postings; they must match a rebuild of the live chunks
+        merged = reopened.current().segments[0]
+        rebuilt = lexical.Postings.build(merged.metadata)
+        for field in ("terms", "offsets", "ids", "tfs", "doc_ids", "doc_lengths"):
+            assert np.array_equal(getattr(merged.postings, field), getattr(rebuilt, field)), field
+        top = reopened.current().lexical_search("doc0.txt doc9.txt", 2 * CHUNKS_PER_DOC)
+        assert {item["file_name"] for _, item, _, _ in top} == {"doc0.txt", "doc9.txt"}
+        assert exact(reopened.current(), "doc3.txt") == set()
+
+        shared = index_store.SegmentedIndex(os.path.join(directory, "shared"), DIMENSION)
+        for user_id in (1, 2):
+            tenant_store.TenantView(shared, user_id).append(*make_chunks(f"u{user_id}_doc.txt"))
+        tenant = tenant_store.TenantSnapshot(shared.current(), 1)
+        assert files(tenant, "chunk") == {"u1_doc.txt"}, "Lexical search crossed tenants"
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_tiered_compaction_keeps_deletes_made_while_merging():
+    directory = tempfile.mkdtemp()
+    try:
+        store = index_store.SegmentedIndex(directory, DIMENSION)
+        files = {f"doc{n}.txt" for n in range(index_store.MAX_SEGMENTS + 1)}
+        for n in range(len(files)):
+            store.append(*make_chunks(f"doc{n}.txt"))
+        before = [seg.name for seg in store.current().segments]
+        assert store.needs_compaction()
+
+        write_segment = store._write_segment
+
+        def write_and_delete(*args):
+            # A delete that lands while the merged segment is being built
+            store.delete_where(lambda item: item["file_name"] == "doc1.txt")
+            return write_segment(*args)
+
+        store._write_segment = write_and_delete
+        merged, _ = store.compact()
+        store._write_segment = write_segment
+
+        after = [seg.name for seg in store.current().segments]
+        assert merged == index_store.MERGE_WIDTH
+        assert after[1:] == before[index_store.MERGE_WIDTH:], "Compaction touched segments outside the merged run"
+        check_store(store, files - {"doc1.txt"})
+        for _, item in store.search(np.random.rand(1, DIMENSION), 50):
+            assert item["file_name"] != "doc1.txt", "Delete made during compaction was lost"
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_get_store_does_not_block_other_users():
+    directory = tempfile.mkdtemp()
+    previous = (index_store._stores.copy(), index_store.OPEN_INDEX_LIMIT)
+    index_store.OPEN_INDEX_LIMIT = 2
+    try:
+        busy_dir, other_dir = os.path.join(directory, "busy"), os.path.join(directory, "other")
+        busy = index_store.SegmentedIndex(busy_dir, DIMENSION)
+        opened = threading.Event()
+        with busy.write_lock():
+            # Opening busy_dir waits on our flock; other directories must not
+            thread = threading.Thread(target=lambda: (index_store.get_store(busy_dir, DIMENSION), opened.set()))
+            thread.start()
+            other = threading.Thread(target=index_store.get_store, args=(other_dir, DIMENSION))
+            other.start()
+            other.join(2)
+            assert not other.is_alive(), "get_store waited on another directory's flock"
+            assert not opened.is_set()
+        thread.join(10)
+        assert opened.is_set()
+
+        for n in range(3):
+            index_store.get_store(os.path.join(directory, f"user_{n}"), DIMENSION)
+        assert len(index_store._stores) == 2, "Open stores were not evicted"
+        assert list(index_store._stores)[-1] == os.path.join(directory, "user_2")
+    finally:
+        index_store._stores.clear()
+        index_store._stores.update(previous[0])
+        index_store.OPEN_INDEX_LIMIT = previous[1]
+        shutil.rmtree(directory)
+
+
+class RandomEncoder:
+    def __init__(self, dimension):
+        self.dimension = dimension
+
+    def encode(self, texts, **kwargs):
+        return np.random.rand(len(texts), self.dimension)
+
+
+def test_reembed_switches_versions_under_load(writers=4, docs_per_writer=15):
+    root = tempfile.mkdtemp()
+    try:
+        store = index_store.get_store(root, DIMENSION, model="old-model")
+        for n in range(20):
+            store.append(*make_chunks(f"seed_doc{n}.txt"))
+        store.delete_where(lambda item: item["file_name"] == "seed_doc0.txt")
+        errors, deleted = [], {"seed_doc0.txt"}
+
+        def upload(writer_id):
+            # Writers behave like RAGManager: embed for the open version, reopen on IndexRetired
+            try:
+                for n in range(docs_per_writer):
+                    file_name = f"w{writer_id}_doc{n}.txt"
+                    while True:
+                        store = index_store.open_root(root, DIMENSION, "old-model")
+                        try:
+                            store.append(*make_chunks(file_name, store.dimension))
+                            break
+                        except index_store.IndexRetired:
+                            continue
+                    while n % 4 == 0:
+                        store = index_store.open_root(root, DIMENSION, "old-model")
+                        try:
+                            store.delete_where(lambda item, name=file_name: item["file_name"] == name)
+                            deleted.add(file_name)
+                            break
+                        except index_store.IndexRetired:
+                            continue
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=upload, args=(i,)) for i in range(writers)]
+        for t in threads:
+            t.start()
+        report = reembed.migrate_root(root, "new-model", RandomEncoder(8), 8, batch_size=10, chunks_per_sec=500)
+        for t in threads:
+            t.join()
+        assert not errors, errors
+
+        assert report["to"] == "v2 (new-model)"
+        assert index_store.current_version(root) == (2, os.path.join(root, "v2"))
+        assert index_store.SegmentedIndex(root, DIMENSION).current().retired
+        migrated = index_store.open_root(root, DIMENSION, "old-model")
+        assert (migrated.model, migrated.dimension) == ("new-model", 8)
+        uploaded = {f"seed_doc{n}.txt" for n in range(20)} | {f"w{w}_doc{n}.txt" for w in range(writers) for n in range(docs_per_writer)}
+        check_store(migrated, uploaded - deleted)
+        # Already on the target model: nothing to do
+        assert reembed.migrate_root(root, "new-model", RandomEncoder(8), 8) is None
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == "__main__":
+    print("--- Starting Index Concurrency Tests ---")
+    test_concurrent_uploads_deletes_and_queries()
+    print("[+] Threaded uploads/deletes/queries: nothing lost.")
+    test_concurrent_uploads_across_processes()
+    print("[+] Multi-process uploads: nothing lost.")
+    test_tenant_packing_isolation_and_promotion()
+    print("[+] Tenant packing: searches isolated, promoted users kept every chunk.")
+    test_batched_search_matches_single_queries()
+    print("[+] Batched search: same hits as one query at a time.")
+    test_tiered_compaction_keeps_deletes_made_while_merging()
+    print("[+] Tiered compaction: merged only a run of segments, kept concurrent deletes.")
+    test_get_store_does_not_block_other_users()
+    print("[+] Store cache: opening one index doesn't block others, old ones are evicted.")
+    test_lexical_index_follows_appends_deletes_and_compaction()
+    print("[+] Lexical index: follows appends, deletes, compaction and tenants.")
+    test_reembed_switches_versions_under_load()
+    print("[+] Re-embedding: switched versions under load, nothing lost.")
+    print("--- All tests completed ---")
@@ -0,0 +1,215 @@
+import os
+import time
+import shutil
+import datetime
+import tempfile
+import numpy as np
+from sqlalchemy.orm import sessionmaker
+import database
+import models
+import index_store
+import tenant_store
+import maintenance
+
+# Offline tests for the destructive maintenance tasks: what each one reclaims,
+# and that nothing younger than ORPHAN_GRACE_SECONDS, nothing the database
+# still points at, and nothing at all when the users table is empty, is
+# touched. Each test runs against a temporary SQLite database and working
+# directory. Run with `python test_maintenance.py` or `pytest test_maintenance.py`.
+
+DIMENSION = 8
+GRACE = maintenance.ORPHAN_GRACE_SECONDS
+
+
+class Sandbox:
+    def __enter__(self):
+        self.previous_dir = os.getcwd()
+        self.previous = (maintenance.SessionLocal, tenant_store.INDEX_ROOT, tenant_store.SHARED_DIR)
+        self.workdir = tempfile.mkdtemp()
+        os.chdir(self.workdir)
+        engine = database.create_db_engine(f"sqlite:///{os.path.join(self.workdir, 'test.db')}")
+        models.Base.metadata.create_all(bind=engine)
+        self.engine = engine
+        self.Session = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+        maintenance.SessionLocal = self.Session
+        tenant_store.INDEX_ROOT = os.path.join(self.workdir, "indices")
+        tenant_store.SHARED_DIR = os.path.join(tenant_store.INDEX_ROOT, "shared")
+        maintenance._cursors.clear()
+        return self
+
+    def __exit__(self, *exc):
+        maintenance.SessionLocal, tenant_store.INDEX_ROOT, tenant_store.SHARED_DIR = self.previous
+        maintenance._cursors.clear()
+        os.chdir(self.previous_dir)
+        self.engine.dispose()
+        shutil.rmtree(self.workdir)
+
+    def add(self, *rows):
+        db = self.Session()
+        db.add_all(rows)
+        db.commit()
+        ids = [row.id for row in rows]
+        db.close()
+        return ids
+
+
+def user(user_id):
+    return models.User(id=user_id, name="u", email=f"u{user_id}@example.com", password_hash="x", is_verified=True)
+
+
+def age(*paths):
+    # Backdates files (recursively for directories) past the grace period
+    old = time.time() - 2 * GRACE
+    for path in paths:
+        if os.path.isdir(path):
+            for parent, _, names in os.walk(path):
+                for name in names:
+                    os.utime(os.path.join(parent, name), (old, old))
+                os.utime(parent, (old, old))
+        else:
+            os.utime(path, (old, old))
+
+
+def write(path, content="x"):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        f.write(content)
+    return path
+
+
+def chunks(file_name, doc_id, count=2, **extra):
+    items = [dict({"file_name": file_name, "doc_id": doc_id, "chunk": n, "content": f"{file_name} chunk {n}"}, **extra) for n in range(count)]
+    return np.random.rand(count, DIMENSION).astype("float32"), items
+
+
+def run(task):
+    return task(time.monotonic() + 60)
+
+
+def test_otp_purge_deletes_only_expired_rows_in_batches():
+    with Sandbox() as box:
+        box.add(user(1))
+        now = datetime.datetime.utcnow()
+        box.add(*[models.OTP(user_id=1, otp_code="1", otp_expiry=now - datetime.timedelta(minutes=n + 1)) for n in range(5)])
+        box.add(*[models.OTP(user_id=1, otp_code="2", otp_expiry=now + datetime.timedelta(minutes=10)) for _ in range(2)])
+
+        # Out of time before the first batch: nothing deleted, resumed next run
+        assert maintenance.purge_expired_otps(time.monotonic() - 1) == {"deleted": 0, "batches": 0, "complete": False}
+        previous = maintenance.OTP_PURGE_BATCH_SIZE
+        maintenance.OTP_PURGE_BATCH_SIZE = 2
+        try:
+            assert run(maintenance.purge_expired_otps) == {"deleted": 5, "batches": 3, "complete": True}
+        finally:
+            maintenance.OTP_PURGE_BATCH_SIZE = previous
+        db = box.Session()
+        assert db.query(models.OTP).count() == 2
+        db.close()
+
+
+def test_upload_reaper_keeps_known_young_and_foreign_files():
+    with Sandbox() as box:
+        box.add(user(1))
+        kept = write("uploads/1/paper.pdf")
+        box.add(models.Document(user_id=1, file_name="paper.pdf", file_path=kept))
+        orphan = write("uploads/1/orphan.pdf", "xyz")
+        young = write("uploads/1/young.pdf")
+        deleted_user = write("uploads/5/old.pdf")
+        foreign = write("uploads/tmp/keep.txt")
+        age(kept, orphan, deleted_user, foreign)
+
+        report = run(maintenance.reap_orphaned_uploads)
+        assert report == {"files": 2, "bytes": 4, "complete": True}, report
+        assert os.path.exists(kept) and os.path.exists(young) and os.path.exists(foreign)
+        assert not os.path.exists(orphan) and not os.path.exists(deleted_user)
+
+        # With no users at all the database is suspect: reap nothing
+        db = box.Session()
+        db.query(models.Document).delete()
+        db.query(models.User).delete()
+        db.commit()
+        db.close()
+        assert run(maintenance.reap_orphaned_uploads)["files"] == 0
+        assert os.path.exists(kept)
+
+
+def test_index_reaper_reclaims_orphans_strays_and_retired_versions():
+    with Sandbox() as box:
+        box.add(user(1))
+        doc_id, = box.add(models.Document(user_id=1, file_name="kept.txt", file_path="uploads/1/kept.txt"))
+        box.add(models.Document(user_id=1, file_name="legacy.txt", file_path="uploads/1/legacy.txt"))
+        box.add(user(2))
+        packed_id, = box.add(models.Document(user_id=2, file_name="packed.txt", file_path="uploads/2/packed.txt"))
+
+        # user_1: a retired version 1 and a current version 2 holding live,
+        # orphaned and pre-doc-id chunks, plus files no manifest references
+        root = tenant_store.dedicated_dir(1)
+        old = index_store.SegmentedIndex(root, DIMENSION)
+        old.append(*chunks("kept.txt", doc_id))
+        current = index_store.SegmentedIndex(os.path.join(root, "v2"), DIMENSION)
+        current.append(*chunks("kept.txt", doc_id))
+        current.append(*chunks("gone.txt", doc_id + 100, count=3))
+        current.append(*chunks("legacy.txt", None))
+        current.append(*chunks("lost.txt", None, count=1))
+        index_store.switch_version(root, 2, "v2")
+        old.retire()
+        stray = write(os.path.join(current.directory, "seg_000099.index"), "stray")
+        write(os.path.join(current.directory, "manifest.json.1.2.tmp"), "tmp")
+        # user_5 no longer exists. The shared store holds a packed tenant, a
+        # deleted one, and copies left behind when user 1 was promoted.
+        gone = index_store.SegmentedIndex(tenant_store.dedicated_dir(5), DIMENSION)
+        gone.append(*chunks("x.txt", 1))
+        shared = index_store.SegmentedIndex(tenant_store.SHARED_DIR, DIMENSION)
+        shared.append(*chunks("packed.txt", packed_id, user_id=2))
+        shared.append(*chunks("x.txt", 2, user_id=5))
+        shared.append(*chunks("kept.txt", doc_id, user_id=1))
+
+        # Everything is younger than the grace period
+        report = run(maintenance.reap_orphaned_indices)
+        assert report == {"roots": 0, "files": 0, "bytes": 0, "chunks": 0, "complete": True}, report
+
+        age(tenant_store.INDEX_ROOT)
+        report = run(maintenance.reap_orphaned_indices)
+        assert report["roots"] == 1 and report["chunks"] == 4 + 2 + 2, report
+        assert not os.path.exists(gone.directory)
+        assert not os.path.exists(os.path.join(root, "manifest.json")), "Retired version 1 was not removed"
+        assert os.path.exists(os.path.join(root, "CURRENT")) and not os.path.exists(stray)
+        assert sorted(name for name in os.listdir(current.directory) if name.endswith(".tmp")) == []
+
+        live = index_store.SegmentedIndex(current.directory).live_metadata()
+        assert sorted(item["file_name"] for item in live) == ["kept.txt", "kept.txt", "legacy.txt", "legacy.txt"]
+        live = index_store.SegmentedIndex(tenant_store.SHARED_DIR).live_metadata()
+        assert {item["user_id"] for item in live} == {2}
+
+        # A second pass finds nothing left to do, from manifests and segment
+        # metadata alone: no store (and no vector file) is opened
+        opened = []
+        peek_store = index_store.peek_store
+        index_store.peek_store = lambda directory: opened.append(directory) or peek_store(directory)
+        try:
+            report = run(maintenance.reap_orphaned_indices)
+        finally:
+            index_store.peek_store = peek_store
+        assert report == {"roots": 0, "files": 0, "bytes": 0, "chunks": 0, "complete": True}, report
+        assert opened == [], opened
+
+
+def test_index_reaper_keeps_indexes_when_users_table_is_empty():
+    with Sandbox():
+        gone = index_store.SegmentedIndex(tenant_store.dedicated_dir(5), DIMENSION)
+        gone.append(*chunks("x.txt", 1))
+        age(tenant_store.INDEX_ROOT)
+        assert run(maintenance.reap_orphaned_indices)["roots"] == 0
+        assert os.path.exists(os.path.join(gone.directory, "manifest.json"))
+
+
+if __name__ == "__main__":
+    print("--- Starting Maintenance Tests ---")
+    test_otp_purge_deletes_only_expired_rows_in_batches()
+    print("[+] OTP purge: only expired rows, in batches.")
+    test_upload_reaper_keeps_known_young_and_foreign_files()
+    print("[+] Upload reaper: orphans only, nothing with an empty users table.")
+    test_index_reaper_reclaims_orphans_strays_and_retired_versions()
+    print("[+] Index reaper: orphaned chunks, stray files, retired versions, deleted users.")
+    test_index_reaper_keeps_indexes_when_users_table_is_empty()
+    print("[+] Index reaper: nothing discarded with an empty users table.")
+    print("--- All tests completed ---")
@@ -0,0 +1,82 @@
+import os
+import time
+import shutil
+import tempfile
+import index_store
+import tenant_store
+import rag
+from bench_rag import HashingEmbedder
+
+# Offline tests for RAGManager on top of the index stores: uploads, scoped and
+# unscoped search in every retrieval mode, and deletes, for a tenant packed
+# into the shared store and after it is promoted to a dedicated index.
+# Embeddings come from bench_rag's hashing embedder, so no model is downloaded.
+# Run with `python test_rag.py` or `pytest test_rag.py`.
+
+
+def words(prefix, count=40):
+    return " ".join(f"{prefix}{i}" for i in range(count))
+
+
+def document(doc_id, chunks):
+    return {"file_name": f"doc{doc_id}.txt", "doc_id": doc_id, "chunks": [words(f"d{doc_id}c{n}w") for n in range(chunks)]}
+
+
+def found(manager, query, **kwargs):
+    return {(hit["doc_id"], hit["chunk"]) for hit in manager.search(query, top_k=10, **kwargs)}
+
+
+def test_packed_tenants_upload_search_delete_and_promote(threshold=6):
+    workdir = tempfile.mkdtemp()
+    previous_dir = os.getcwd()
+    previous = (tenant_store.TENANT_PACKING, tenant_store.INDEX_ROOT, tenant_store.SHARED_DIR, tenant_store.TENANT_PACK_MAX_CHUNKS)
+    previous_model = rag.embedding_models.get(rag.EMBEDDING_MODEL_NAME)
+    os.chdir(workdir)
+    tenant_store.TENANT_PACKING = True
+    tenant_store.INDEX_ROOT = os.path.join(workdir, "indices")
+    tenant_store.SHARED_DIR = os.path.join(tenant_store.INDEX_ROOT, "shared")
+    tenant_store.TENANT_PACK_MAX_CHUNKS = threshold
+    rag.embedding_models[rag.EMBEDDING_MODEL_NAME] = HashingEmbedder(rag.embedding_dimension())
+    try:
+        alice, bob = rag.RAGManager(7), rag.RAGManager(8)
+        assert isinstance(alice.store, tenant_store.TenantView)
+        assert alice.add_documents([document(1, 3)]) == 3
+        assert bob.add_documents([document(2, 3)]) == 3
+        assert not tenant_store.has_dedicated_index(7) and not tenant_store.has_dedicated_index(8)
+
+        for mode in rag.RETRIEVAL_MODES:
+            assert found(alice, "d1c1w5 d2c1w5", mode=mode) <= {(1, 0), (1, 1), (1, 2)}, f"{mode} search crossed tenants"
+            assert (1, 1) in found(alice, "d1c1w5", mode=mode)
+            assert found(alice, "d1c1w5", document_ids=[2], mode=mode) == set()
+
+        alice.delete_document("doc1.txt", doc_id=1)
+        assert found(alice, "d1c1w5") == set()
+        assert (2, 1) in found(bob, "d2c1w5"), "Deleting one tenant's document touched another's"
+
+        # Crossing the threshold promotes bob; a manager opened before that keeps working
+        assert bob.add_documents([document(3, 4)]) == 4
+        assert tenant_store.has_dedicated_index(8)
+        for manager in (bob, rag.RAGManager(8)):
+            for mode in rag.RETRIEVAL_MODES:
+                assert (3, 2) in found(manager, "d3c2w5", mode=mode)
+                assert (2, 0) in found(manager, "d2c0w5", document_ids=[2], mode=mode)
+        rag.RAGManager(8).delete_document("doc2.txt", doc_id=2)
+        assert found(rag.RAGManager(8), "d2c0w5 d3c0w5") == {(3, n) for n in range(4)}
+    finally:
+        deadline = time.time() + 30
+        while index_store._compacting and time.time() < deadline:
+            time.sleep(0.05)
+        os.chdir(previous_dir)
+        tenant_store.TENANT_PACKING, tenant_store.INDEX_ROOT, tenant_store.SHARED_DIR, tenant_store.TENANT_PACK_MAX_CHUNKS = previous
+        if previous_model is None:
+            rag.embedding_models.pop(rag.EMBEDDING_MODEL_NAME, None)
+        else:
+            rag.embedding_models[rag.EMBEDDING_MODEL_NAME] = previous_model
+        shutil.rmtree(workdir)
+
+
+if __name__ == "__main__":
+    print("--- Starting RAG Manager Tests ---")
+    test_packed_tenants_upload_search_delete_and_promote()
+    print("[+] Packed tenants: upload, search, delete and promotion.")
+    print("--- All tests completed ---")
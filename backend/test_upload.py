@@ -0,0 +1,186 @@
+import io
+import os
+import time
+import shutil
+import tarfile
+import zipfile
+import tempfile
+from fastapi.testclient import TestClient
+from sqlalchemy.orm import sessionmaker
+import database
+import models
+import index_store
+import tenant_store
+import rag
+import main
+from bench_rag import HashingEmbedder
+
+# Offline tests for /upload/bulk and claim_upload_path: archive members keep
+# their paths, unsupported members are reported as skipped, same-named files
+# never share a path, and a failed commit leaves no chunks in the index.
+# Each test runs against a temporary SQLite database and working directory,
+# with bench_rag's hashing embedder, so no model is downloaded.
+# Run with `python test_upload.py` or `pytest test_upload.py`.
+
+
+def words(prefix, count=40):
+    return " ".join(f"{prefix}{i}" for i in range(count))
+
+
+def zip_bytes(files):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w") as archive:
+        for name, text in files.items():
+            archive.writestr(name, text)
+    return buffer.getvalue()
+
+
+def tar_bytes(files):
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w:gz") as archive:
+        for name, text in files.items():
+            data = text.encode()
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            archive.addfile(info, io.BytesIO(data))
+    return buffer.getvalue()
+
+
+class Sandbox:
+    def __init__(self, fail_commit=False):
+        self.fail_commit = fail_commit
+
+    def __enter__(self):
+        self.previous_dir = os.getcwd()
+        self.previous = (tenant_store.INDEX_ROOT, tenant_store.SHARED_DIR)
+        self.previous_model = rag.embedding_models.get(rag.EMBEDDING_MODEL_NAME)
+        self.workdir = tempfile.mkdtemp()
+        os.chdir(self.workdir)
+        tenant_store.INDEX_ROOT = os.path.join(self.workdir, "indices")
+        tenant_store.SHARED_DIR = os.path.join(tenant_store.INDEX_ROOT, "shared")
+        rag.embedding_models[rag.EMBEDDING_MODEL_NAME] = HashingEmbedder(rag.embedding_dimension())
+
+        self.engine = database.create_db_engine(f"sqlite:///{os.path.join(self.workdir, 'test.db')}")
+        models.Base.metadata.create_all(bind=self.engine)
+        self.Session = sessionmaker(autocommit=False, autoflush=False, bind=self.engine)
+        db = self.Session()
+        db.add(models.User(id=1, name="u", email="u1@example.com", password_hash="x", is_verified=True))
+        db.commit()
+        self.user = db.get(models.User, 1)
+        db.expunge(self.user)
+        db.close()
+
+        def get_db():
+            db = self.Session()
+            if self.fail_commit:
+                def commit():
+                    raise RuntimeError("disk I/O error")
+                db.commit = commit
+            try:
+                yield db
+            finally:
+                db.close()
+        main.app.dependency_overrides[main.get_db] = get_db
+        main.app.dependency_overrides[main.get_current_active_user] = lambda: self.user
+        self.client = TestClient(main.app)
+        return self
+
+    def __exit__(self, *exc):
+        main.app.dependency_overrides.clear()
+        deadline = time.time() + 30
+        while index_store._compacting and time.time() < deadline:
+            time.sleep(0.05)
+        os.chdir(self.previous_dir)
+        tenant_store.INDEX_ROOT, tenant_store.SHARED_DIR = self.previous
+        if self.previous_model is None:
+            rag.embedding_models.pop(rag.EMBEDDING_MODEL_NAME, None)
+        else:
+            rag.embedding_models[rag.EMBEDDING_MODEL_NAME] = self.previous_model
+        self.engine.dispose()
+        shutil.rmtree(self.workdir)
+
+    def upload(self, *files):
+        return self.client.post("/upload/bulk", files=[("files", (name, data)) for name, data in files])
+
+    def documents(self):
+        db = self.Session()
+        rows = {doc.id: (doc.file_name, doc.file_path) for doc in db.query(models.Document).all()}
+        db.close()
+        return rows
+
+
+def test_claim_upload_path_never_reuses_a_path():
+    user_dir = tempfile.mkdtemp()
+    try:
+        first = main.claim_upload_path(user_dir, "a/notes.txt")
+        second = main.claim_upload_path(user_dir, "b/notes.txt")
+        third = main.claim_upload_path(user_dir, "notes.txt")
+        assert [os.path.basename(path) for path in (first, second, third)] == ["notes.txt", "notes_1.txt", "notes_2.txt"]
+        # Member paths never reach outside the user's directory
+        escaped = main.claim_upload_path(user_dir, "../../etc/passwd.txt")
+        assert os.path.dirname(escaped) == user_dir
+        assert sorted(os.listdir(user_dir)) == ["notes.txt", "notes_1.txt", "notes_2.txt", "passwd.txt"]
+    finally:
+        shutil.rmtree(user_dir)
+
+
+def test_bulk_upload_keeps_member_paths_and_reports_skipped_files():
+    with Sandbox() as box:
+        archive = zip_bytes({
+            "a/notes.txt": words("alpha"),
+            "b/notes.txt": words("beta"),
+            "a/readme.md": "# readme",
+            "a/.hidden.txt": "dotfile",
+        })
+        response = box.upload(
+            ("papers.zip", archive),
+            ("more.tar.gz", tar_bytes({"c/notes.txt": words("gamma"), "c/figure.png": "png"})),
+            ("plain.txt", words("delta").encode()),
+            ("image.png", b"png"),
+            ("broken.zip", b"not a zip"),
+        )
+        assert response.status_code == 200, response.text
+        body = response.json()
+        assert (body["indexed"], body["failed"], body["skipped"]) == (4, 1, 3), body
+        status = {result["file_name"]: result["status"] for result in body["results"]}
+        assert status == {
+            "a/notes.txt": "indexed",
+            "b/notes.txt": "indexed",
+            "c/notes.txt": "indexed",
+            "plain.txt": "indexed",
+            "a/readme.md": "skipped",
+            "c/figure.png": "skipped",
+            "image.png": "skipped",
+            "broken.zip": "failed",
+        }, status
+
+        documents = box.documents()
+        assert sorted(name for name, _ in documents.values()) == ["a/notes.txt", "b/notes.txt", "c/notes.txt", "plain.txt"]
+        assert len({path for _, path in documents.values()}) == 4, "Same-named members share a file"
+        prefixes = {"a/notes.txt": "alpha", "b/notes.txt": "beta", "c/notes.txt": "gamma", "plain.txt": "delta"}
+        manager = rag.RAGManager(1)
+        for doc_id, (name, _) in documents.items():
+            hits = manager.search(words(prefixes[name], 5), top_k=5, document_ids=[doc_id])
+            assert hits and {hit["file_name"] for hit in hits} == {name}, (name, hits)
+
+
+def test_bulk_upload_commit_failure_leaves_no_chunks():
+    with Sandbox(fail_commit=True) as box:
+        response = box.upload(("papers.zip", zip_bytes({"a/notes.txt": words("alpha"), "b/notes.txt": words("beta")})))
+        assert response.status_code == 500, response.text
+        assert box.documents() == {}
+        assert os.listdir(os.path.join(main.UPLOAD_DIR, "1")) == []
+        # The ids the flush handed out come back for the next upload: none of
+        # the rolled-back chunks may be found under them
+        assert rag.RAGManager(1).search(words("alpha", 5) + " " + words("beta", 5), top_k=10) == []
+
+
+if __name__ == "__main__":
+    print("--- Starting Upload Tests ---")
+    test_claim_upload_path_never_reuses_a_path()
+    print("[+] claim_upload_path: distinct paths inside the user's directory.")
+    test_bulk_upload_keeps_member_paths_and_reports_skipped_files()
+    print("[+] Bulk upload: member paths kept, skipped and failed files reported.")
+    test_bulk_upload_commit_failure_leaves_no_chunks()
+    print("[+] Bulk upload: a failed commit tombstones the appended chunks.")
+    print("--- All tests completed ---")
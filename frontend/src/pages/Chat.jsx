@@ -121,7 +121,13 @@ const Chat = () => {
                 body: new URLSearchParams({ query }),
             });
 
-            if (!response.ok) throw new Error('Chat failed');
+            if (response.status === 429 || response.status === 503) {
+                // Admission control: the server is busy, nothing was saved
+                const data = await response.json().catch(() => ({}));
+                const retryAfter = response.headers.get('Retry-After');
+                throw new Error(`${data.detail || 'The assistant is busy.'}${retryAfter ? ` Retry in ${retryAfter}s.` : ''}`);
+            }
+            if (!response.ok) throw new Error('Failed to get AI response');
 
             const reader = response.body.getReader();
             const decoder = new TextDecoder();
@@ -140,7 +146,7 @@ const Chat = () => {
                 });
             }
         } catch (error) {
-            toast.error('Failed to get AI response');
+            toast.error(error.message || 'Failed to get AI response');
             // Remove the empty bot message on error if it's still empty
             setMessages(prev => {
                 if (prev[prev.length - 1].content === '') {
@@ -56,7 +56,7 @@ const Upload = () => {
         const MAX_SIZE = 200 * 1024 * 1024; // 200MB
         const validFiles = newFiles.filter(file => {
             const isTypeValid = ['application/pdf', 'application/vnd.openxmlformats-officedocument.wordprocessingml.document', 'text/plain']
-                .includes(file.type) || file.name.endsWith('.docx') || file.name.endsWith('.pdf') || file.name.endsWith('.txt');
+                .includes(file.type) || ['.docx', '.pdf', '.txt', '.zip', '.tar', '.tar.gz', '.tgz'].some(ext => file.name.endsWith(ext));
             const isSizeValid = file.size <= MAX_SIZE;
 
             if (!isSizeValid) toast.error(`${file.name} is too large (max 200MB)`);
@@ -64,7 +64,7 @@ const Upload = () => {
         });
 
         if (validFiles.length === 0 && newFiles.length > 0) {
-            toast.error('No valid files selected (PDF, DOCX, TXT only)');
+            toast.error('No valid files selected (PDF, DOCX, TXT or ZIP/TAR archives only)');
         }
 
         setFiles(prev => [...prev, ...validFiles]);
@@ -81,12 +81,16 @@ const Upload = () => {
         const toastId = toast.loading('Processing documents and generating embeddings...');
 
         try {
-            for (const file of files) {
-                const formData = new FormData();
-                formData.append('file', file);
-                await api.post('/upload', formData);
+            const formData = new FormData();
+            files.forEach(file => formData.append('files', file));
+            const { data } = await api.post('/upload/bulk', formData);
+
+            const failed = data.results.filter(r => r.status === 'failed');
+            if (failed.length > 0) {
+                toast.error(`Indexed ${data.indexed} documents, ${failed.length} failed: ${failed.map(r => r.file_name).join(', ')}`, { id: toastId });
+            } else {
+                toast.success(`${data.indexed} documents uploaded and indexed!`, { id: toastId });
             }
-            toast.success('All documents uploaded and indexed!', { id: toastId });
             setFiles([]);
             fetchDocuments();
         } catch (error) {
@@ -118,12 +122,12 @@ const Upload = () => {
                             <UploadIcon size={40} />
                         </div>
                         <h3 className="text-2xl font-bold mb-2">Drag & drop files here</h3>
-                        <p className="text-secondary mb-8">Support for PDF, DOCX, and TXT (Max 200MB per file)</p>
+                        <p className="text-secondary mb-8">Support for PDF, DOCX, TXT and ZIP/TAR archives (Max 200MB per file)</p>
 
                         <input
                             type="file"
                             multiple
-                            accept=".pdf,.docx,.txt"
+                            accept=".pdf,.docx,.txt,.zip,.tar,.gz,.tgz"
                             className="hidden"
                             id="fileInput"
                             onChange={(e) => handleFiles(Array.from(e.target.files))}